@@ -0,0 +1,39 @@
+"""Benchmarks for the invask -> ozon sync pipeline (root main.py).
+
+Run from the repository root:
+
+    python -m benchmarks.run --sizes 10000 100000 1000000 --output bench.json
+
+The root config requires a filled .env; every setting that is missing from the environment
+gets a harmless placeholder here so the pipeline modules can be imported without one.
+No network calls are made by the benchmarks.
+"""
+import os
+
+
+PLACEHOLDER_ENV = dict(
+    INVASK_API_TOKEN='bench',
+    INVASK_API_URL='http://127.0.0.1:8765/invask/products',
+    FTP_USER='bench',
+    FTP_PASSWORD='bench',
+    OZON_API_KEY='bench',
+    OZON_MAX_ITEMS='10',
+    OZON_MIN_ITEMS='[1,]',
+    OZON_CLIENT_ID='bench',
+    OZON_STOCK_URL='http://127.0.0.1:8765/v2/product/list',
+    OZON_STOCK_UPDATE_URL='http://127.0.0.1:8765/v2/products/stocks',
+    OZON_PRICE_UPDATE_URL='http://127.0.0.1:8765/v1/product/import/prices',
+    PRICE_URL='http://127.0.0.1:8765/prices',
+    TABLE_URL='http://127.0.0.1:8765/table',
+    UPDATE_PERIOD='600',
+    PRICE_TABLE='prices.xlsx',
+    ARTICLE_COLUMN='A',
+    PRICE_COLUMN='B',
+    DELIVERY_COLUMN='C',
+    START_ROW='2',
+)
+
+
+def prepare_env() -> None:
+    for key, value in PLACEHOLDER_ENV.items():
+        os.environ.setdefault(key, value)
@@ -0,0 +1,326 @@
+"""Local stand-in for the Ozon, Wildberries, Invask, Rusklimat and Armavir apis for offline load tests.
+
+    python -m benchmarks.fake_api --port 8765 --ozon-items 60000 --invask-items 80000 --latency 80 --rate-429 0.02
+
+Point the .env of a script at it (the urls are printed on start) and run a full cycle against production
+sized catalogs without touching the seller account. Pagination follows the real apis: last_id for the
+ozon catalog, the updatedAt/nmID cursor for wildberries cards, offset/total for Invask and
+pageSize/page/totalPageCount for Rusklimat. Every endpoint can be slowed down (--latency, --jitter) and
+made to fail: 429 with Retry-After (--rate-429), 500 (--fail-rate) and per item update errors
+(--item-error-rate), the first two optionally only on some endpoints (--faults). GET /_stats returns the
+request counters per endpoint, POST /_reset clears them. The supplier feeds stay the same until POST /_republish
+changes their stocks, with --validators the Armavir feed carries an ETag and answers 304 to If-None-Match.
+"""
+import argparse
+import gzip
+import json
+import random
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.synthetic import offer_id
+
+
+class FakeState:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.stats = Counter()
+        self.lock = Lock()
+        self.rnd = random.Random(args.seed)
+        # bumped by /_republish, shifts the stocks of the supplier feeds
+        self.version = 0
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.stats[name] += 1
+
+    def chance(self, probability: float) -> bool:
+        with self.lock:
+            return self.rnd.random() < probability
+
+    def delay(self) -> None:
+        latency = self.args.latency
+        if latency or self.args.jitter:
+            with self.lock:
+                jitter = self.rnd.uniform(-self.args.jitter, self.args.jitter)
+            sleep(max(latency + jitter, 0) / 1000)
+
+
+def stock_of(i: int) -> int:
+    return (i * 7919) % 40
+
+
+def price_of(i: int) -> int:
+    return 100 + (i * 104729) % 90000
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state: FakeState = None
+
+    def log_message(self, format, *args) -> None:
+        if self.state.args.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, obj, status: int = 200, headers: dict = None) -> None:
+        body = json.dumps(obj, ensure_ascii=False).encode()
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and len(body) > 1024:
+            body = gzip.compress(body)
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status: int, headers: dict = None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+
+    def read_json(self):
+        body = self.body
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return json.loads(body) if body else {}
+
+    def injected_failure(self, name: str) -> bool:
+        """Answers with a 429 or a 500 instead of the endpoint if the dice say so"""
+        args = self.state.args
+        if args.faults and name not in args.faults:
+            return False
+        if self.state.chance(args.rate_429):
+            self.state.count(f"{name} 429")
+            self.send_json(dict(code=8, message='rate limit exceeded'), status=429,
+                           headers={'Retry-After': str(args.retry_after)})
+            return True
+        if self.state.chance(args.fail_rate):
+            self.state.count(f"{name} 500")
+            self.send_json(dict(code=13, message='internal error'), status=500)
+            return True
+        return False
+
+    def route(self, method: str) -> None:
+        url = urlparse(self.path)
+        # drained before any answer, an unread body would end up in front of the next request on a keep-alive
+        self.body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        routes = {
+            ('POST', '/v2/product/list'): self.ozon_product_list,
+            ('POST', '/v2/products/stocks'): self.ozon_stocks,
+            ('POST', '/v1/product/import/prices'): self.ozon_prices,
+            ('POST', '/content/v1/cards/cursor/list'): self.wb_cards,
+            ('GET', '/invask/products'): self.invask_products,
+            ('POST', '/rusklimat/jwt'): self.rusklimat_jwt,
+            ('GET', '/rusklimat/request-key'): self.rusklimat_request_key,
+            ('GET', '/armavir'): self.armavir,
+            ('GET', '/_stats'): self.stats,
+            ('POST', '/_reset'): self.reset,
+            ('POST', '/_republish'): self.republish,
+        }
+        handler = routes.get((method, url.path.rstrip('/') or '/'))
+        if handler is None and method == 'PUT' and url.path.startswith('/api/v3/stocks/'):
+            handler = self.wb_stocks
+        if handler is None and method == 'POST' and url.path.startswith('/rusklimat/data/'):
+            handler = self.rusklimat_data
+        if handler is None:
+            self.send_json(dict(message=f"{method} {url.path} is not faked"), status=404)
+            return
+        name = handler.__name__
+        self.state.count(name)
+        self.state.delay()
+        if name in FAULTY and self.injected_failure(name):
+            return
+        handler(url)
+
+    def do_GET(self) -> None:
+        self.route('GET')
+
+    def do_POST(self) -> None:
+        self.route('POST')
+
+    def do_PUT(self) -> None:
+        self.route('PUT')
+
+    # ozon
+
+    def ozon_product_list(self, url) -> None:
+        payload = self.read_json()
+        total = self.state.args.ozon_items
+        limit = min(int(payload.get('limit') or 1000), 1000)
+        start = int(payload.get('last_id') or 0)
+        items = [dict(product_id=10_000_000 + i, offer_id=offer_id(i), is_fbo_visible=True, is_fbs_visible=True,
+                      archived=False, is_discounted=False)
+                 for i in range(start, min(start + limit, total))]
+        # like the real api: an empty page with an empty last_id ends the listing
+        last_id = str(start + len(items)) if items else ''
+        self.send_json(dict(result=dict(items=items, total=total, last_id=last_id)))
+
+    def item_results(self, records: list) -> list:
+        results = []
+        for record in records:
+            errors = []
+            if self.state.chance(self.state.args.item_error_rate):
+                errors.append(dict(code='TOO_MANY_REQUESTS', message='the stock of the product can be updated '
+                                                                     'once in 2 minutes'))
+            if not str(record.get('offer_id', '')).isdigit():
+                errors.append(dict(code='NOT_FOUND', message='product not found'))
+            results.append(dict(product_id=record.get('product_id'), offer_id=record.get('offer_id'),
+                                updated=not errors, errors=errors))
+        return results
+
+    def ozon_stocks(self, url) -> None:
+        stocks = self.read_json().get('stocks') or []
+        if len(stocks) > 100:
+            self.send_json(dict(code=3, message='stocks: maximum 100 items per request'), status=400)
+            return
+        self.send_json(dict(result=self.item_results(stocks)))
+
+    def ozon_prices(self, url) -> None:
+        prices = self.read_json().get('prices') or []
+        if len(prices) > 1000:
+            self.send_json(dict(code=3, message='prices: maximum 1000 items per request'), status=400)
+            return
+        self.send_json(dict(result=self.item_results(prices)))
+
+    # wildberries
+
+    def wb_cards(self, url) -> None:
+        cursor = (self.read_json().get('settings') or {}).get('cursor') or {}
+        limit = min(int(cursor.get('limit') or 100), 1000)
+        total = self.state.args.wb_cards
+        start = int(cursor['nmID']) + 1 if cursor.get('nmID') is not None else 0
+        cards = [dict(nmID=i, vendorCode=offer_id(i), updatedAt=f"2023-01-01T00:00:{i % 60:02d}Z",
+                      sizes=[dict(skus=[f"220{i:010d}"])])
+                 for i in range(start, min(start + limit, total))]
+        last = cards[-1] if cards else dict(nmID=cursor.get('nmID'), updatedAt=cursor.get('updatedAt'))
+        self.send_json(dict(cards=cards, cursor=dict(updatedAt=last['updatedAt'], nmID=last['nmID'],
+                                                     total=len(cards))))
+
+    def wb_stocks(self, url) -> None:
+        stocks = self.read_json().get('stocks') or []
+        failed = [el for el in stocks if self.state.chance(self.state.args.item_error_rate)]
+        if failed:
+            self.send_json([dict(code='NotFound', data=failed, message='sku not found')], status=409)
+            return
+        self.send_empty(status=204)
+
+    # suppliers
+
+    def invask_products(self, url) -> None:
+        offset = int(parse_qs(url.query).get('offset', ['0'])[0])
+        total = self.state.args.invask_items
+        products = []
+        for i in range(offset, min(offset + self.state.args.invask_page, total)):
+            stock = stock_of(i + self.state.version)
+            products.append(dict(cat_number=int(offer_id(i)), quantityLabel=f">{stock}" if stock > 30 else stock,
+                                 regular_price=price_of(i), attributes=dict(brand=f"brand {i % 97}")))
+        self.send_json(dict(total=total, products=products))
+
+    def rusklimat_jwt(self, url) -> None:
+        self.read_json()
+        self.send_json(dict(code=200, data=dict(jwtToken='fake-jwt')))
+
+    def rusklimat_request_key(self, url) -> None:
+        self.send_json(dict(requestKey='fake-request-key'))
+
+    def rusklimat_data(self, url) -> None:
+        self.read_json()
+        query = parse_qs(url.query)
+        page_size = int(query.get('pageSize', ['1000'])[0])
+        page = int(query.get('page', ['1'])[0])
+        total = self.state.args.rusklimat_items
+        data = []
+        for i in range((page - 1) * page_size, min(page * page_size, total)):
+            remains = 'ожидается поставка' if i % 50 == 0 else stock_of(i)
+            data.append(dict(nsCode=offer_id(i), vendorCode=f"V{i}", internetPrice=float(price_of(i)),
+                             remains=dict(total=remains, warehouses={'фрц Киржач': stock_of(i)})))
+        self.send_json(dict(data=data, totalCount=total, totalPageCount=-(-total // page_size)))
+
+    def armavir(self, url) -> None:
+        version = self.state.version
+        headers = dict(ETag=f'"armavir-{version}"') if self.state.args.validators else None
+        if headers and self.headers.get('If-None-Match') == headers['ETag']:
+            self.send_empty(status=304, headers=headers)
+            return
+        self.send_json([[offer_id(i), f"{stock_of(i + version)}.000"] for i in range(self.state.args.armavir_items)],
+                       headers=headers)
+
+    # service
+
+    def stats(self, url) -> None:
+        with self.state.lock:
+            self.send_json(dict(self.state.stats))
+
+    def reset(self, url) -> None:
+        with self.state.lock:
+            self.state.stats.clear()
+        self.send_empty(status=204)
+
+    def republish(self, url) -> None:
+        with self.state.lock:
+            self.state.version += 1
+        self.send_empty(status=204)
+
+
+FAULTY = ['ozon_product_list', 'ozon_stocks', 'ozon_prices', 'wb_cards', 'wb_stocks', 'invask_products',
+          'rusklimat_jwt', 'rusklimat_request_key', 'rusklimat_data', 'armavir']
+
+
+def env_lines(base: str) -> list:
+    return [f"OZON_STOCK_URL={base}/v2/product/list",
+            f"OZON_STOCK_UPDATE_URL={base}/v2/products/stocks",
+            f"OZON_PRICE_UPDATE_URL={base}/v1/product/import/prices",
+            f"WB_STOCK_URL={base}/content/v1/cards/cursor/list",
+            f"WB_STOCK_UPDATE_URL={base}/api/v3/stocks",
+            f"INVASK_API_URL={base}/invask/products",
+            f"RUSKLIMAT_URL_JWT={base}/rusklimat/jwt",
+            f"RUSKLIMAT_URL_RQ={base}/rusklimat/request-key",
+            f"RUSKLIMAT_URL_DATA={base}/rusklimat/data/",
+            f"ARMAVIR_URL={base}/armavir"]
+
+
+def main_fake(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--ozon-items', type=int, default=60_000)
+    parser.add_argument('--wb-cards', type=int, default=5_000)
+    parser.add_argument('--invask-items', type=int, default=80_000)
+    parser.add_argument('--invask-page', type=int, default=500)
+    parser.add_argument('--rusklimat-items', type=int, default=80_000)
+    parser.add_argument('--armavir-items', type=int, default=80_000)
+    parser.add_argument('--latency', type=float, default=0, help='added to every answer, ms')
+    parser.add_argument('--jitter', type=float, default=0, help='+- ms around --latency')
+    parser.add_argument('--rate-429', type=float, default=0, help='share of requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After of the 429 answers, s')
+    parser.add_argument('--fail-rate', type=float, default=0, help='share of requests answered with 500')
+    parser.add_argument('--item-error-rate', type=float, default=0, help='share of update items rejected')
+    parser.add_argument('--faults', nargs='+', choices=FAULTY, help='endpoints the 429 and 500 are injected into, '
+                                                                   'all of them by default')
+    parser.add_argument('--validators', action='store_true', help='ETag and 304 answers on the Armavir feed')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    FakeHandler.state = FakeState(args=args)
+    server = ThreadingHTTPServer((args.host, args.port), FakeHandler)
+    base = f"http://{args.host}:{args.port}"
+    print(f"Fake apis listening on {base}, .env for the scripts:", flush=True)
+    print('\n'.join(env_lines(base)), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main_fake()
@@ -0,0 +1,71 @@
+"""Import time budget of the sync scripts: a one-shot cli run must not load pandas, requests or openpyxl before a
+stage needs them.
+
+    python -m benchmarks.import_time                     # root and rusklimat, 300 ms budget
+    python -m benchmarks.import_time --budget 200 --repeat 7
+
+Every script is imported in a fresh interpreter under `python -X importtime`, the best of --repeat runs counts.
+The exit code is 1 when a script is over the budget or imports one of the heavy modules at start.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+from benchmarks import PLACEHOLDER_ENV
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = dict(invask='.', rusklimat='rusklimat')
+HEAVY_MODULES = ('pandas', 'numpy', 'openpyxl', 'requests', 'urllib3', 'xlsxwriter')
+# settings of rusklimat/config.py that the root placeholders do not cover
+RUSKLIMAT_ENV = dict(
+    OZON_WAREHOUSE_ID='1',
+    RUSKLIMAT_LOGIN='bench',
+    RUSKLIMAT_PASSWORD='bench',
+    RUSKLIMAT_URL_JWT='http://127.0.0.1:8765/rusklimat/jwt',
+    RUSKLIMAT_URL_RQ='http://127.0.0.1:8765/rusklimat/request-key',
+    RUSKLIMAT_URL_DATA='http://127.0.0.1:8765/rusklimat/data/',
+)
+
+
+def import_profile(directory: str) -> dict:
+    """Cumulative import time in microseconds of every top level module imported by `import main`"""
+    env = {**PLACEHOLDER_ENV, **RUSKLIMAT_ENV, **os.environ}
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=directory, env=env,
+                         capture_output=True, text=True, check=True)
+    profile = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # nested modules are indented, the package itself is what a script pays for
+        profile.setdefault(name.strip(), int(cumulative))
+    return profile
+
+
+def check(name: str, directory: str, budget_ms: float, repeat: int) -> bool:
+    profiles = [import_profile(directory=directory) for _ in range(repeat)]
+    best = min(profiles, key=lambda el: el['main'])
+    took = best['main'] / 1000
+    heavy = [el for el in HEAVY_MODULES if el in best]
+    ok = took <= budget_ms and not heavy
+    print(f"{name:<10} import main: {took:7.1f} ms (budget {budget_ms:.0f} ms) {'ok' if ok else 'OVER BUDGET'}")
+    if heavy:
+        print(f"{'':<10} heavy modules imported at start: {', '.join(heavy)}")
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=float, default=300, help="milliseconds allowed for `import main`")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scripts', nargs='+', choices=list(SCRIPTS), default=list(SCRIPTS))
+    args = parser.parse_args()
+
+    results = [check(name=el, directory=os.path.join(ROOT, SCRIPTS[el]), budget_ms=args.budget, repeat=args.repeat)
+               for el in args.scripts]
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""Times and memory-profiles every stage of the sync pipeline on synthetic catalogs and writes the results as json.
+
+    python -m benchmarks.run                                  # all stages at 10k, 100k and 1M rows
+    python -m benchmarks.run --sizes 10000 --stages list_batcher process_stock_items
+    python -m benchmarks.run --output new.json --compare old.json --tolerance 0.25
+
+Each stage is run twice per size: once for wall time and once under tracemalloc for the peak of python
+allocations (numpy and pandas buffers included), so the tracing overhead does not end up in the timings.
+With --compare the exit code is 1 when a stage got slower or hungrier than the tolerance allows.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+
+from benchmarks import prepare_env, synthetic
+
+prepare_env()
+
+import pandas as pd  # noqa: E402
+
+import batching  # noqa: E402
+import main  # noqa: E402
+from prices_reader import PriceReader  # noqa: E402
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+# writing a workbook is by far the slowest stage, larger sizes only with --no-limits
+STAGE_LIMITS = dict(save_excel=100_000)
+
+
+def stage_process_table(size: int, workdir: str):
+    product_list = synthetic.invask_products(n=size)
+    return lambda: main.TableGetter.process_table(product_list=product_list)
+
+
+def stage_process_stock_items(size: int, workdir: str):
+    df_site = main.TableGetter.process_table(product_list=synthetic.invask_products(n=size))
+    stock_list = synthetic.ozon_catalog(n=size)
+    oa = main.OzonApi(client_id='bench', api_key='bench', prices_delta_dict={})
+    return lambda: oa.process_stock_items(stock_list=stock_list, df_site=df_site)
+
+
+def stage_process_all_items(size: int, workdir: str):
+    df_site = main.TableGetter.process_table(product_list=synthetic.invask_products(n=size))
+    stock_list = synthetic.ozon_catalog(n=size)
+    oa = main.OzonApi(client_id='bench', api_key='bench', prices_delta_dict=synthetic.markup_rules(n=size))
+    return lambda: oa.process_all_items(stock_list=stock_list, df_site=df_site)
+
+
+def stage_get_prices_dict(size: int, workdir: str):
+    filename = os.path.join(workdir, f"prices_{size}.xlsx")
+    if not os.path.exists(filename):
+        synthetic.markup_workbook(filename=filename, n=size)
+    # a fresh reader every run, otherwise the mtime cache answers instead of the loader
+    return lambda: PriceReader(filename=filename, start_rows=2, article_col='A', prices_delta_col='B',
+                               delivery_col='C').get_prices_dict()
+
+
+def stage_list_batcher(size: int, workdir: str):
+    records = [dict(offer_id=synthetic.offer_id(i), product_id=i, stock=i % 30, warehouse_id=1) for i in range(size)]
+    # a fresh batcher at the stocks maximum, what the first cycle of a daemon cuts
+    return lambda: list(batching.AdaptiveBatcher(maximum=100, slow=5).batches(records=records))
+
+
+def stage_save_excel(size: int, workdir: str):
+    products = synthetic.invask_products(n=size)
+
+    def run():
+        # save_excel flattens the attributes in place, give it a fresh copy every run
+        main.TableGetter.save_excel(product_list=[dict(el) for el in products])
+    return run
+
+
+STAGES = dict(
+    process_table=stage_process_table,
+    process_stock_items=stage_process_stock_items,
+    process_all_items=stage_process_all_items,
+    get_prices_dict=stage_get_prices_dict,
+    list_batcher=stage_list_batcher,
+    save_excel=stage_save_excel,
+)
+
+
+def measure(stage: str, size: int, workdir: str, memory: bool = True) -> dict:
+    run = STAGES[stage](size, workdir)
+    start = perf_counter()
+    run()
+    seconds = perf_counter() - start
+
+    result = dict(stage=stage, rows=size, seconds=round(seconds, 4), rows_per_second=round(size / seconds))
+    if memory:
+        run = STAGES[stage](size, workdir)
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result.update(peak_mb=round(peak / 2 ** 20, 2), bytes_per_row=round(peak / size))
+    return result
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline_file: str, tolerance: float) -> list:
+    with open(baseline_file, encoding='utf-8') as f:
+        baseline = {(el['stage'], el['rows']): el for el in json.load(f)['results']}
+    regressions = []
+    for el in results:
+        base = baseline.get((el['stage'], el['rows']))
+        if not base:
+            continue
+        for metric in ('seconds', 'peak_mb'):
+            if metric in el and metric in base and el[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{el['stage']} @ {el['rows']}: {metric} {base[metric]} -> {el[metric]}")
+    return regressions
+
+
+def main_bench(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--no-limits', action='store_true', help='run every stage at every size')
+    parser.add_argument('--compare', help='results file of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    # the pipeline logs every batch at INFO
+    logging.getLogger().setLevel(logging.WARNING)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        # save_excel writes into the current directory
+        os.chdir(workdir)
+        try:
+            for size in args.sizes:
+                for stage in args.stages:
+                    if not args.no_limits and size > STAGE_LIMITS.get(stage, size):
+                        continue
+                    result = measure(stage=stage, size=size, workdir=workdir, memory=not args.no_memory)
+                    print(json.dumps(result), flush=True)
+                    results.append(result)
+        finally:
+            os.chdir(cwd)
+
+    report = dict(meta=dict(created=datetime.now().isoformat(timespec='seconds'), revision=git_revision(),
+                            python=platform.python_version(), pandas=pd.__version__, platform=platform.platform()),
+                  results=results)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        regressions = compare(results=results, baseline_file=args.compare, tolerance=args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_bench())
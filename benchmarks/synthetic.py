@@ -0,0 +1,49 @@
+"""Synthetic inputs in the shapes the pipeline expects: Invask api products, the ozon catalog and the markup workbook"""
+import random
+
+from openpyxl import Workbook
+
+
+def offer_id(i: int) -> str:
+    return f"{100000 + i}"
+
+
+def invask_products(n: int, seed: int = 1) -> list:
+    """Raw /products items of the Invask api: quantityLabel is an int or a '>N' string, some carry attributes"""
+    rnd = random.Random(seed)
+    products = []
+    for i in range(n):
+        quantity = rnd.randint(0, 30)
+        products.append(dict(cat_number=int(offer_id(i)),
+                             quantityLabel=f">{quantity}" if quantity > 20 else quantity,
+                             regular_price=rnd.randint(100, 90000),
+                             attributes=dict(brand=f"brand {i % 97}", weight=rnd.randint(1, 50)) if i % 3 else None))
+    return products
+
+
+def ozon_catalog(n: int, overlap: float = 0.8, seed: int = 2) -> list:
+    """/v2/product/list items; `overlap` of them have an offer_id that exists at the supplier"""
+    rnd = random.Random(seed)
+    catalog = []
+    for i in range(n):
+        key = rnd.randrange(n) if rnd.random() < overlap else n + i
+        catalog.append(dict(product_id=10_000_000 + i, offer_id=offer_id(key)))
+    return catalog
+
+
+def markup_rules(n: int, seed: int = 3) -> dict:
+    """What PriceReader.get_prices_dict returns: article -> (markup percent, delivery)"""
+    rnd = random.Random(seed)
+    return {offer_id(i): (round(rnd.uniform(5, 60), 4), float(rnd.choice([0, 300, 500]))) for i in range(n)}
+
+
+def markup_workbook(filename: str, n: int, start_row: int = 2, seed: int = 3) -> None:
+    """Markup workbook laid out as the default .env expects: article in A, markup in B, delivery in C"""
+    rules = markup_rules(n=n, seed=seed)
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for _ in range(start_row - 1):
+        sheet.append(['Артикул', 'Наценка', 'Доставка', 'Комментарий'])
+    for article, (markup, delivery) in rules.items():
+        sheet.append([article, markup, delivery, 'synthetic'])
+    workbook.save(filename)
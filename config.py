@@ -4,6 +4,11 @@ from pydantic import BaseSettings
 class Settings(BaseSettings):
     INVASK_API_TOKEN: str
     INVASK_API_URL: str
+    INVASK_WORKERS: int = 4
+    # reuse the last parsed table when every page of the feed is the same as last time
+    INVASK_CACHE: bool = True
+    # the cached table for the next start, empty - in memory only
+    INVASK_CACHE_FILE: str = "invask_cache.pickle"
     FTP_HOST: str = "46.254.21.136"
     FTP_USER: str
     FTP_PASSWORD: str
@@ -16,6 +21,39 @@ class Settings(BaseSettings):
     OZON_PRICE_UPDATE_URL: str
 
     OZON_WAREHOUSE_ID: int = 22053606930000
+    # several seller accounts or warehouses fed from the same supplier download, json list of
+    # {"client_id": "...", "api_key": "...", "warehouse_id": ...}; empty - the single account above
+    OZON_ACCOUNTS: str = ""
+    OZON_ACCOUNT_WORKERS: int = 4
+    OZON_POOL_SIZE: int = 10
+    OZON_UPLOAD_WORKERS: int = 4
+    # ozon quotas, requests per minute for each method
+    OZON_STOCK_RATE_LIMIT: int = 80
+    OZON_PRICE_RATE_LIMIT: int = 80
+    OZON_RETRY_ATTEMPTS: int = 5
+    # gzip the json of the stock and price updates from this many bytes on, 0 sends it as is
+    # turn on only once the api is known to take Content-Encoding: gzip request bodies
+    OZON_GZIP_MIN_SIZE: int = 0
+    # batch sizes start at the documented maximum of items per request and adapt to the answers:
+    # halved on a 429, a 5xx or a timeout, cut by a quarter when an answer takes longer than OZON_BATCH_SLOW seconds
+    OZON_STOCK_BATCH_MAX: int = 100
+    OZON_PRICE_BATCH_MAX: int = 1000
+    OZON_BATCH_SLOW: float = 5
+    # seconds to wait for the answer to an update, a batch that timed out is sent again
+    OZON_TIMEOUT: float = 60
+    # items ozon did not update for a passing reason (a 429, the 2 minute limit per item) are sent again
+    # that many times, after OZON_ITEM_RETRY_DELAY seconds doubled on every round
+    OZON_ITEM_RETRY_ATTEMPTS: int = 3
+    OZON_ITEM_RETRY_DELAY: float = 20
+    # json lines of the updates rejected for good or failed on every retry, empty - the log only
+    OZON_FAILURE_LOG: str = "failed_updates.jsonl"
+    SNAPSHOT_FILE: str = "sync_snapshot.json"
+    FULL_SYNC_EVERY: int = 24
+    # shared by every script of the same seller account if pointed to the same file
+    OZON_CATALOG_CACHE: str = "ozon_catalog.json"
+    OZON_CATALOG_TTL: int = 21600
+    # local scrape endpoint with the stage metrics of the last cycles, 0 turns it off
+    METRICS_PORT: int = 0
     PRICE_URL: str
     TABLE_URL: str
     SHEET_NAME: str = "Sheet1"
@@ -23,6 +61,10 @@ class Settings(BaseSettings):
     UPLOAD_TEMPLATE_YM: str = 'upload_template'
     UPLOAD_NAME_YM: str = 'yandex_upload.xlsx'
     UPLOAD_YM_TABLE_WORKSHEET: str = 'Остатки'
+    # empty - every UPDATE_PERIOD seconds, '10m' / '6h' - fixed rate, or a cron expression like '*/10 * * * *'
+    STOCK_SCHEDULE: str = ""
+    # same format, empty - prices are sent together with the stock on STOCK_SCHEDULE
+    PRICE_SCHEDULE: str = ""
     UPDATE_PERIOD: int
     PRICE_TABLE: str
     ARTICLE_COLUMN: str
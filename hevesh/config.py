@@ -15,6 +15,38 @@ class Settings(BaseSettings):
     START_TIME: str
     STOP_TIME: str
     OZON_WAREHOUSE_ID: int
+    OZON_POOL_SIZE: int = 10
+    OZON_UPLOAD_WORKERS: int = 4
+    # ozon quotas, requests per minute for each method
+    OZON_STOCK_RATE_LIMIT: int = 80
+    OZON_PRICE_RATE_LIMIT: int = 80
+    OZON_RETRY_ATTEMPTS: int = 5
+    # gzip the json of the stock and price updates from this many bytes on, 0 sends it as is
+    # turn on only once the api is known to take Content-Encoding: gzip request bodies
+    OZON_GZIP_MIN_SIZE: int = 0
+    # batch sizes start at the documented maximum of items per request and adapt to the answers:
+    # halved on a 429, a 5xx or a timeout, cut by a quarter when an answer takes longer than OZON_BATCH_SLOW seconds
+    OZON_STOCK_BATCH_MAX: int = 100
+    OZON_PRICE_BATCH_MAX: int = 1000
+    OZON_BATCH_SLOW: float = 5
+    # seconds to wait for the answer to an update, a batch that timed out is sent again
+    OZON_TIMEOUT: float = 60
+    # items ozon did not update for a passing reason (a 429, the 2 minute limit per item) are sent again
+    # that many times, after OZON_ITEM_RETRY_DELAY seconds doubled on every round
+    OZON_ITEM_RETRY_ATTEMPTS: int = 3
+    OZON_ITEM_RETRY_DELAY: float = 20
+    # json lines of the updates rejected for good or failed on every retry, empty - the log only
+    OZON_FAILURE_LOG: str = "failed_updates.jsonl"
+    SNAPSHOT_FILE: str = "sync_snapshot.json"
+    FULL_SYNC_EVERY: int = 24
+    # shared by every script of the same seller account if pointed to the same file
+    OZON_CATALOG_CACHE: str = "ozon_catalog.json"
+    OZON_CATALOG_TTL: int = 21600
+    # local scrape endpoint with the stage metrics of the last cycles, 0 turns it off
+    METRICS_PORT: int = 0
+    # empty - every UPDATE_PERIOD seconds between START_TIME and STOP_TIME, '10m' / '6h' - fixed rate in the same
+    # window, or a cron expression like '*/10 8-17 * * *' that replaces the window
+    STOCK_SCHEDULE: str = ""
     UPDATE_PERIOD: int
 
     class Messages:
@@ -1,24 +1,49 @@
 import requests
+from requests.adapters import HTTPAdapter
+import json
 import logging as logger
 import pandas as pd
 from datetime import datetime
-from sys import exit as s_exit
+from openpyxl import load_workbook
+from openpyxl.utils import column_index_from_string
+from os import getpid, remove, replace
 from time import sleep, time
-from typing import Generator
+from urllib3.util.retry import Retry
 
+import batching
+import compression
+import metrics
 from config import settings
+from scheduler import Scheduler, make_trigger, parse_clock
+from sync_state import FailureLog, OzonUpload, RateLimiter, SyncSnapshot
 logger.basicConfig(level=logger.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
 
 class TableGetter:
 
     @staticmethod
-    def table_from_excel() -> pd.core.frame.DataFrame:
-        df_supplies = pd.read_excel(settings.EXCEL_FILE, sheet_name=settings.EXCEL_SHEET_NAME, usecols=f'{settings.EXCEL_OFFER_ID_COL}, {settings.EXCEL_QUANTITY_COL}')
-        df_supplies.drop(df_supplies.index[0])
-        headers = ['offer_id', "stock_val", ]
-        df_supplies.columns = headers
-        return df_supplies
+    def table_from_excel() -> dict:
+        """offer_id -> stock straight from the supplier workbook.
+        The sheet is streamed row by row in read-only mode and only the offer_id and quantity cells are kept,
+        repeated offer_ids keep the first row"""
+        workbook = load_workbook(filename=settings.EXCEL_FILE, read_only=True, data_only=True)
+        try:
+            sheet = workbook[settings.EXCEL_SHEET_NAME]
+            oid_col = column_index_from_string(settings.EXCEL_OFFER_ID_COL.strip())
+            qty_col = column_index_from_string(settings.EXCEL_QUANTITY_COL.strip())
+            first_col = min(oid_col, qty_col)
+
+            site_values = {}
+            # the first row holds the headers
+            for row in sheet.iter_rows(min_row=2, min_col=first_col, max_col=max(oid_col, qty_col), values_only=True):
+                offer_id = row[oid_col - first_col]
+                if offer_id is None:
+                    continue
+                # ozon offer_ids are strings, a numeric cell is read as a number
+                site_values.setdefault(str(offer_id), row[qty_col - first_col])
+        finally:
+            workbook.close()
+        return site_values
 
     # @staticmethod
     # def process_table(product_list: list) -> pd.core.frame.DataFrame:
@@ -32,133 +57,178 @@ class TableGetter:
     #     return df_arm
 
 
-class OzonApi:
-    def __init__(self, client_id: str, api_key: str, prices_delta_dict: dict) -> None:
+class OzonApi(OzonUpload):
+    def __init__(self, client_id: str, api_key: str, prices_delta_dict: dict, session: requests.Session = None,
+                 snapshot: SyncSnapshot = None) -> None:
         self.client_id = client_id
         self.api_key = api_key
         self.last_id = None
         self.res_list = []
         self.prices_dd = prices_delta_dict
+        self.snapshot = snapshot
+        self.session = session if session else OzonApi.make_session(client_id=client_id, api_key=api_key)
+        self.catalog_file = settings.OZON_CATALOG_CACHE
+        # one bucket per ozon method, quotas are counted separately for stocks and prices
+        self.limiters = dict(stocks=RateLimiter(rate=settings.OZON_STOCK_RATE_LIMIT),
+                             prices=RateLimiter(rate=settings.OZON_PRICE_RATE_LIMIT))
+        self.batchers = OzonApi.make_batchers(client_id=str(client_id))
+        self.failures = FailureLog(filename=settings.OZON_FAILURE_LOG, owner=dict(client_id=str(client_id)))
 
-    def get_stock_items(self):
+    @staticmethod
+    def make_batchers(client_id: str) -> dict:
+        # batch sizes are learned per seller account and method and kept for the life of the process
+        return dict(stocks=batching.shared(key=(client_id, 'stocks'), maximum=settings.OZON_STOCK_BATCH_MAX,
+                                           slow=settings.OZON_BATCH_SLOW),
+                    prices=batching.shared(key=(client_id, 'prices'), maximum=settings.OZON_PRICE_BATCH_MAX,
+                                           slow=settings.OZON_BATCH_SLOW))
+
+    @staticmethod
+    def make_session(client_id: str, api_key: str) -> requests.Session:
+        """Long-lived session for the seller api: auth headers are set once and the pooled
+        keep-alive connections are reused by every request of every cycle"""
+        s = requests.Session()
+        s.headers.update({'Client-Id': client_id, 'Api-Key': api_key,
+                          'Accept-Encoding': compression.ACCEPT_ENCODING})
+        s.hooks['response'].append(metrics.observe)
+        adapter = HTTPAdapter(pool_maxsize=settings.OZON_POOL_SIZE,
+                              max_retries=Retry(connect=3, read=0, backoff_factor=0.5))
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        return s
+
+    def get_stock_items(self, refresh: bool = False):
+        if not refresh:
+            cached_list = self.load_catalog()
+            if cached_list is not None:
+                self.res_list = cached_list
+                logger.info(msg="Данные с озон склада взяты из кэша")
+                return self.res_list
         while self.last_id != '':
             self.res_list += self.get_stock_items_batch()
+        self.save_catalog(items=self.res_list)
         logger.info(msg="Данные с озон склада получены")
         return self.res_list
 
+    def load_catalog(self) -> list | None:
+        """offer_id/product_id pairs saved by an earlier cycle or by another process of the same seller account"""
+        try:
+            with open(self.catalog_file, encoding='utf-8') as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if catalog.get('client_id') != self.client_id or time() - catalog.get('saved_at', 0) > settings.OZON_CATALOG_TTL:
+            return None
+        return catalog.get('items')
+
+    def save_catalog(self, items: list) -> None:
+        catalog = dict(client_id=self.client_id, saved_at=time(),
+                       items=[dict(product_id=el.get('product_id'), offer_id=el.get('offer_id')) for el in items])
+        tmp_name = f"{self.catalog_file}.{getpid()}.tmp"
+        with open(tmp_name, 'w', encoding='utf-8') as f:
+            json.dump(catalog, f, ensure_ascii=False)
+        replace(tmp_name, self.catalog_file)
+
+    @staticmethod
+    def invalidate_catalog(filename: str = settings.OZON_CATALOG_CACHE) -> None:
+        """Forces the next cycle to list the ozon catalog again"""
+        try:
+            remove(filename)
+        except FileNotFoundError:
+            pass
+
     def get_stock_items_batch(self):
-        with requests.Session() as s:
-            headers = {'Client-Id': self.client_id,
-                       'Api-Key': self.api_key}
-            payload = dict(last_id=self.last_id) if self.last_id else dict()
-            response = s.post(url=settings.OZON_STOCK_URL, headers=headers, json=payload)
-            res_dict = response.json()
+        payload = dict(last_id=self.last_id) if self.last_id else dict()
+        for attempt in range(settings.OZON_RETRY_ATTEMPTS + 1):
+            res_dict = self.list_page(payload=payload)
             result = res_dict.get("result")
-
-            if not result:
-                logger.warning(msg=f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}")
-                s_exit()
-            else:
-                last_id = result.get("last_id")
-                if last_id == '':
-                    self.last_id = last_id
-                    return []
-                self.last_id = last_id
-                batch_list = res_dict.get("result").get('items')
-                if not batch_list:
-                    logger.warning(msg=f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}")
-                    s_exit()
-                return batch_list
-
-    def process_stock_items(self, stock_list: list, df_site: pd.core.frame.DataFrame) -> tuple:
+            # an empty page with an empty last_id ends the listing, any other page has items
+            if result and (result.get("last_id") == '' or result.get('items')):
+                break
+            if attempt == settings.OZON_RETRY_ATTEMPTS:
+                # raised instead of exiting, a daemon goes on with its next run
+                raise RuntimeError(f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}")
+            logger.warning(msg=f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}, "
+                               f"повтор через {2 ** attempt} сек")
+            sleep(2 ** attempt)
+        self.last_id = result.get("last_id")
+        if self.last_id == '':
+            return []
+        return result.get('items')
+
+    def list_page(self, payload: dict) -> dict:
+        """One page of the catalog, a failed request is returned as {'error': ...} and tried again"""
+        try:
+            response = self.session.post(url=settings.OZON_STOCK_URL, json=payload, timeout=settings.OZON_TIMEOUT)
+            return response.json()
+        except (requests.RequestException, ValueError) as e:
+            return dict(error=repr(e))
+
+    def process_stock_items(self, stock_list: list, site_values: dict) -> tuple:
         df_stock_raw = pd.DataFrame(stock_list)
         df_stock = df_stock_raw[['product_id', 'offer_id']]
-        df_stock_quants = pd.DataFrame(columns=['offer_id', 'product_id', 'stock', 'warehouse_id'])
 
         stock_quants = []
-        for index, row in df_stock[["product_id", "offer_id"]].iterrows():
-
-            key_oid = row["offer_id"]
-            key_pid = row["product_id"]
+        for key_oid, key_pid in zip(df_stock["offer_id"], df_stock["product_id"]):
             # get stock value from supplier table
-
-            stock_value = tuple(df_site[df_site['offer_id'] == key_oid]['stock_val'])
-
-            if len(stock_value) == 0:
+            if key_oid not in site_values:
                 continue
             stock_quants.append(dict(offer_id=key_oid,
                                      product_id=key_pid,
-                                     stock=stock_value[0],
+                                     stock=site_values[key_oid],
                                      warehouse_id=settings.OZON_WAREHOUSE_ID))
 
-        df_stock_quants = pd.concat([df_stock_quants, pd.DataFrame(stock_quants)])
-        result_list_dicts = df_stock_quants.to_dict(orient="records")
-        # print(result_list_dicts)
-        batch_list = self.list_batcher(list_dicts=result_list_dicts)
+        result_list_dicts = stock_quants
+        if self.snapshot:
+            result_list_dicts = self.snapshot.changed(kind='stocks', records=result_list_dicts)
+        batch_list = self.batchers['stocks'].batches(records=result_list_dicts)
         logger.info(msg=f"Завершено сопоставление таблицы артикулов и таблицы поставщика.\n"
                     f"Обработано {len(result_list_dicts)} записей для кол-ва товаров")
         return batch_list, len(result_list_dicts)
 
 
-    def update_stock(self, list_send: Generator, len_list: int, price_flag: bool = False):
-        with requests.Session() as s:
-            headers = {'Client-Id': self.client_id,
-                       'Api-Key': self.api_key}
-            if not price_flag:
-                for el in list_send:
-
-                    payload = dict(stocks=el)
-                    response = s.post(url=settings.OZON_STOCK_UPDATE_URL, headers=headers, json=payload)
-                    logger.info(msg=f"Пачка данных кол-ва товаров обработана:{response.json()}")
-            else:
-                for el in list_send:
-                    payload = dict(prices=el)
-                    response = s.post(url=settings.OZON_PRICE_UPDATE_URL, headers=headers, json=payload)
-                    logger.info(msg=f"Пачка данных цен обработана:{response.json()}")
-                if len_list > 8000:
-                    sleep(1)
-
-    @staticmethod
-    def list_batcher(list_dicts: list, n: int = 100):
-        len_list = len(list_dicts)
-        for ndx in range(0, len_list, n):
-            yield list_dicts[ndx:min(ndx + n, len_list)]
-
-
-def runner_stock():
+def runner_stock(session: requests.Session = None, snapshot: SyncSnapshot = None):
     start = time()
-
-    df_hevesh = TableGetter.table_from_excel()
-
-    oa = OzonApi(client_id=settings.OZON_CLIENT_ID, api_key=settings.OZON_API_KEY, prices_delta_dict={ })
-    stock_list = oa.get_stock_items()
-
-    batches2send, len_list = oa.process_stock_items(stock_list=stock_list, df_site=df_hevesh)
-
-    oa.update_stock(list_send=batches2send, len_list=len_list)
-
+    cycle = metrics.start_cycle(name='runner_stock')
+    try:
+        if snapshot:
+            snapshot.start_cycle(kinds=('stocks',))
+
+        with metrics.stage('supplier_fetch') as st:
+            site_values = TableGetter.table_from_excel()
+            st.rows = len(site_values)
+
+        oa = OzonApi(client_id=settings.OZON_CLIENT_ID, api_key=settings.OZON_API_KEY, prices_delta_dict={ },
+                     session=session, snapshot=snapshot)
+        with metrics.stage('ozon_catalog') as st:
+            stock_list = oa.get_stock_items()
+            st.rows = len(stock_list)
+
+        with metrics.stage('matching') as st:
+            batches2send, len_list = oa.process_stock_items(stock_list=stock_list, site_values=site_values)
+            st.rows = len(stock_list)
+
+        oa.update_stock(list_send=batches2send, len_list=len_list)
+
+        if snapshot:
+            snapshot.save()
+    finally:
+        cycle.finish()
     finish = time()
     delta = finish - start
     logger.info(msg=f"Обновление {len_list} позиций по остаткам склада выполнено за {delta}")
 
 
 def main_proc():
-    while True:
-        time_pc = datetime.now()
-
-        start_time = datetime.strptime(settings.START_TIME, '%H:%M').replace(year=time_pc.year)\
-            .replace(month=time_pc.month).replace(day=time_pc.day)
-
-        stop_time = datetime.strptime(settings.STOP_TIME, '%H:%M').replace(year=time_pc.year)\
-            .replace(month=time_pc.month).replace(day=time_pc.day)
-
-        if start_time < time_pc < stop_time:
-            logger.info(msg=f"{time_pc} - запускаю обработчик")
-            runner_stock()
-            logger.info(msg=f"Обработчик запустится через {settings.UPDATE_PERIOD} сек - а пока баиньки")
-            sleep(settings.UPDATE_PERIOD)
-        else:
-            sleep(5)
+    # one pooled ozon session for the whole life of the daemon
+    session = OzonApi.make_session(client_id=settings.OZON_CLIENT_ID, api_key=settings.OZON_API_KEY)
+    snapshot = SyncSnapshot(filename=settings.SNAPSHOT_FILE, full_sync_every=settings.FULL_SYNC_EVERY)
+    metrics.serve(port=settings.METRICS_PORT)
+    sch = Scheduler()
+    # the scheduler sleeps until the window opens instead of polling the clock
+    sch.add(name='остатки', func=lambda: runner_stock(session=session, snapshot=snapshot),
+            trigger=make_trigger(spec=settings.STOCK_SCHEDULE, period=settings.UPDATE_PERIOD,
+                                 window=(parse_clock(settings.START_TIME), parse_clock(settings.STOP_TIME))))
+    sch.run_forever()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,242 @@
+"""Per stage metrics of a sync cycle: wall time, rows, requests, bytes and request latency percentiles.
+
+    cycle = metrics.start_cycle('runner')
+    with metrics.stage('supplier_fetch') as st:
+        product_list = tg.get_stock()
+        st.rows = len(product_list)
+    cycle.finish()
+
+Requests are counted by the `observe` response hook of the sessions and go to the innermost stage that is
+open in the thread that made them, so do the sizes of the update batches. The running cycle and the open stages
+are kept per thread (in a context variable): a worker thread sees them only if its function is wrapped with
+`bind`, executor.submit(metrics.bind(post_batch), payload). Bytes are counted as they went over the
+wire, bytes_saved is what gzip saved on the compressed bodies in both directions. Stages may be nested, the outer
+one then also contains the time of the inner one.
+A finished cycle is logged as one json record per stage and kept for the scrape endpoint started by `serve`:
+/metrics in the prometheus text format and /metrics.json.
+"""
+import json
+import logging as logger
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter, time
+
+PERCENTILES = (50, 90, 99)
+
+
+class StageStats:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.seconds = 0.0
+        self.rows = 0
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.bytes_saved = 0
+        self.latencies = []
+        self.batch_sizes = []
+
+    @staticmethod
+    def percentile(values: list, p: int) -> float:
+        # nearest rank, good enough for a few hundred requests
+        ordered = sorted(values)
+        return ordered[max(round(p / 100 * len(ordered)) - 1, 0)]
+
+    def as_dict(self) -> dict:
+        res = dict(stage=self.name, seconds=round(self.seconds, 4), rows=self.rows, requests=self.requests,
+                   errors=self.errors, bytes_sent=self.bytes_sent, bytes_received=self.bytes_received,
+                   bytes_saved=self.bytes_saved,
+                   rows_per_second=round(self.rows / self.seconds) if self.seconds else None)
+        for p in PERCENTILES:
+            res[f"latency_p{p}"] = round(self.percentile(self.latencies, p), 4) if self.latencies else None
+        if self.batch_sizes:
+            res.update(batches=len(self.batch_sizes), batch_size_min=min(self.batch_sizes),
+                       batch_size_max=max(self.batch_sizes), batch_size_last=self.batch_sizes[-1])
+        return res
+
+
+class CycleMetrics:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.started = time()
+        self.start = perf_counter()
+        self.seconds = None
+        self.stages = {}
+        self.lock = Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        with self.lock:
+            # a stage entered twice in one cycle (several upload runs) adds up
+            stats = self.stages.setdefault(name, StageStats(name=name))
+        token = OPEN_STAGES.set(OPEN_STAGES.get() + (stats,))
+        start = perf_counter()
+        try:
+            yield stats
+        finally:
+            OPEN_STAGES.reset(token)
+            with self.lock:
+                stats.seconds += perf_counter() - start
+
+    def current(self) -> StageStats:
+        """Innermost stage of this cycle open in the calling thread, call with the lock held"""
+        for stats in reversed(OPEN_STAGES.get()):
+            if self.stages.get(stats.name) is stats:
+                return stats
+        return self.stages.setdefault('other', StageStats('other'))
+
+    def observe(self, response, **kwargs) -> None:
+        body = response.request.body
+        length = response.headers.get('Content-Length')
+        received, saved = int(length or 0), 0
+        if not kwargs.get('stream'):
+            # read before taking the lock, content is decoded and the raw stream knows the bytes on the wire
+            size = len(response.content)
+            received = int(length) if length is not None else response.raw.tell()
+            if response.headers.get('Content-Encoding') in ('gzip', 'deflate'):
+                saved = size - received
+        with self.lock:
+            stats = self.current()
+            stats.requests += 1
+            stats.errors += response.status_code >= 400
+            stats.latencies.append(response.elapsed.total_seconds())
+            stats.bytes_sent += len(body) if body else 0
+            stats.bytes_received += received
+            stats.bytes_saved += saved
+
+    def add(self, **values) -> None:
+        """Adds to the counters of the innermost open stage"""
+        with self.lock:
+            stats = self.current()
+            for key, value in values.items():
+                setattr(stats, key, getattr(stats, key) + value)
+
+    def batch(self, size: int) -> None:
+        with self.lock:
+            self.current().batch_sizes.append(size)
+
+    def finish(self) -> dict:
+        self.seconds = perf_counter() - self.start
+        report = self.report()
+        for el in report['stages']:
+            logger.info(msg=json.dumps(dict(event='stage', cycle=self.name, **el), ensure_ascii=False))
+        logger.info(msg=json.dumps(dict(event='cycle', cycle=self.name, seconds=report['seconds']),
+                                   ensure_ascii=False))
+        with REGISTRY_LOCK:
+            LAST_CYCLES[self.name] = report
+        if ACTIVE.get() is self:
+            ACTIVE.set(None)
+        return report
+
+    def report(self) -> dict:
+        with self.lock:
+            stages = [el.as_dict() for el in self.stages.values()]
+        return dict(cycle=self.name, started=self.started,
+                    seconds=round(self.seconds, 4) if self.seconds is not None else None, stages=stages)
+
+
+# cycle started in this thread and the stages it has open, innermost last
+ACTIVE: ContextVar[CycleMetrics | None] = ContextVar('metrics_cycle', default=None)
+OPEN_STAGES: ContextVar[tuple] = ContextVar('metrics_open_stages', default=())
+LAST_CYCLES = {}
+REGISTRY_LOCK = Lock()
+
+
+def start_cycle(name: str) -> CycleMetrics:
+    cycle = CycleMetrics(name=name)
+    ACTIVE.set(cycle)
+    return cycle
+
+
+def bind(func):
+    """`func` to run in another thread with the cycle and the open stages of the calling one"""
+    context = copy_context()
+
+    def run(*args, **kwargs):
+        # a context can not be entered by two threads at once, every call gets its own copy
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+
+@contextmanager
+def stage(name: str):
+    """Stage of the running cycle, a throwaway one if no cycle was started (single calls, benchmarks)"""
+    cycle = ACTIVE.get()
+    if cycle is None:
+        yield StageStats(name=name)
+        return
+    with cycle.stage(name) as stats:
+        yield stats
+
+
+def observe(response, *args, **kwargs):
+    """Response hook for requests sessions: session.hooks['response'].append(metrics.observe)"""
+    cycle = ACTIVE.get()
+    if cycle is not None:
+        cycle.observe(response, **kwargs)
+    return response
+
+
+def add(**values) -> None:
+    """Adds to the counters of the stage that is open, metrics.add(bytes_saved=n)"""
+    cycle = ACTIVE.get()
+    if cycle is not None:
+        cycle.add(**values)
+
+
+def batch(size: int) -> None:
+    """Size of an update batch taken by the stage that is open"""
+    cycle = ACTIVE.get()
+    if cycle is not None:
+        cycle.batch(size=size)
+
+
+def prometheus_text() -> str:
+    lines = []
+    with REGISTRY_LOCK:
+        cycles = list(LAST_CYCLES.values())
+    for cycle in cycles:
+        labels = f'cycle="{cycle["cycle"]}"'
+        lines.append(f"sync_cycle_seconds{{{labels}}} {cycle['seconds']}")
+        lines.append(f"sync_cycle_started{{{labels}}} {cycle['started']}")
+        for el in cycle['stages']:
+            stage_labels = f'{labels},stage="{el["stage"]}"'
+            for key, value in el.items():
+                if key in ('stage', 'rows_per_second') or value is None:
+                    continue
+                lines.append(f"sync_stage_{key}{{{stage_labels}}} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path == '/metrics':
+            body, content_type = prometheus_text().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            with REGISTRY_LOCK:
+                body = json.dumps(LAST_CYCLES, ensure_ascii=False).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def serve(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer | None:
+    """Scrape endpoint in a daemon thread, port 0 turns it off"""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(msg=f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
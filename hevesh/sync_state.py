@@ -0,0 +1,290 @@
+"""Delivery state of the marketplace pushes, the same file in every sync script directory.
+
+    snapshot = SyncSnapshot(filename=settings.SNAPSHOT_FILE, full_sync_every=settings.FULL_SYNC_EVERY)
+    snapshot.start_cycle(kinds=('stocks',))
+    records = snapshot.changed(kind='stocks', records=stock_quants)
+    ...
+    snapshot.acknowledge(kind='stocks', records=batch, res_dict=res_dict)
+    retry, rejected = item_outcomes(records=batch, res_dict=res_dict)
+    failures.write(kind='stocks', items=rejected)
+    snapshot.save()
+
+RateLimiter keeps the quota of one api method, SyncSnapshot the last stocks and prices ozon acknowledged so that
+only the changed ones are sent, FailureLog the updates that did not go through. `item_outcomes` sorts the items
+of an ozon update answer into the ones to send again and the ones rejected for good, OzonUpload is the upload
+of the OzonApi of every script built on all of them. The ozon settings are read from the config.py of the script
+when a batch is sent, heveshWB only uses FailureLog.
+"""
+import json
+import logging as logger
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from os import replace
+from threading import Lock
+from time import monotonic, sleep
+from typing import Generator
+
+import compression
+import metrics
+from config import settings
+
+# per item errors that pass by themselves, the stock of an item may be changed once in 2 minutes
+RETRY_CODES = ('TOO_MANY_REQUESTS',)
+
+
+class RateLimiter:
+    """Token bucket limiter: `rate` requests per `per` seconds, bursts up to `rate`, safe to share between threads"""
+    def __init__(self, rate: int, per: float = 60.0) -> None:
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.fill_rate = rate / per
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.fill_rate
+            sleep(wait_time)
+
+
+class SyncSnapshot:
+    """Last stock and price acknowledged by ozon for every offer, kept on disk between cycles and restarts.
+    Only records that differ from it are sent, every `full_sync_every` cycle everything is sent again"""
+    def __init__(self, filename: str, full_sync_every: int) -> None:
+        self.filename = filename
+        self.full_sync_every = full_sync_every
+        # stock and price jobs run on their own schedules, each kind counts its own cycles
+        self.cycles = dict(stocks=0, prices=0)
+        self.full_sync = dict(stocks=True, prices=True)
+        self.values = dict(stocks={}, prices={})
+        self.lock = Lock()
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.filename, encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.cycles.update(snapshot.get('cycles', {}))
+        self.values['stocks'] = snapshot.get('stocks', {})
+        self.values['prices'] = snapshot.get('prices', {})
+
+    def save(self) -> None:
+        with self.lock:
+            snapshot = dict(cycles=self.cycles, **self.values)
+            with open(f"{self.filename}.tmp", 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+        replace(f"{self.filename}.tmp", self.filename)
+
+    def start_cycle(self, kinds: tuple = ('stocks', 'prices')) -> None:
+        """Counts a cycle for every kind sent in it"""
+        for kind in kinds:
+            self.cycles[kind] += 1
+            self.full_sync[kind] = self.full_sync_every <= 1 or self.cycles[kind] % self.full_sync_every == 1
+            if self.full_sync[kind]:
+                logger.info(msg=f"Полная синхронизация ({kind}): отправляю все позиции")
+
+    @staticmethod
+    def record_key(kind: str, record: dict) -> tuple[str, str]:
+        if kind == 'stocks':
+            return f"{record['offer_id']}:{record.get('warehouse_id')}", str(record.get('stock'))
+        return str(record['offer_id']), str(record.get('price'))
+
+    def changed(self, kind: str, records: list) -> list:
+        if self.full_sync[kind]:
+            return records
+        known = self.values[kind]
+        changed_list = []
+        for record in records:
+            key, value = SyncSnapshot.record_key(kind=kind, record=record)
+            if known.get(key) != value:
+                changed_list.append(record)
+        return changed_list
+
+    def acknowledge(self, kind: str, records: list, res_dict: dict) -> None:
+        """Remembers the records of a sent batch that ozon reported as updated"""
+        result = res_dict.get('result')
+        if not isinstance(result, list):
+            return
+        updated = {str(el.get('offer_id')) for el in result if el.get('updated')}
+        with self.lock:
+            for record in records:
+                if str(record['offer_id']) in updated:
+                    key, value = SyncSnapshot.record_key(kind=kind, record=record)
+                    self.values[kind][key] = value
+
+
+class FailureLog:
+    """Updates that the marketplace rejected for good or that failed every retry, appended to `filename` as one
+    json line per item with the record and its errors. `owner` - the fields that tell whose updates they are,
+    `id_field` - the record field that names the item. Empty filename - the log only"""
+    # one file for every thread and account of the process
+    lock = Lock()
+
+    def __init__(self, filename: str, owner: dict = None, id_field: str = 'offer_id') -> None:
+        self.filename = filename
+        self.owner = owner or {}
+        self.id_field = id_field
+
+    def write(self, kind: str, items: list) -> None:
+        if not items:
+            return
+        record, errors = items[0]
+        logger.warning(msg=f"Не обновлено позиций ({kind}): {len(items)}, первая {record.get(self.id_field)}: {errors}")
+        if not self.filename:
+            return
+        now = datetime.now().isoformat(timespec='seconds')
+        lines = ''.join(json.dumps(dict(time=now, **self.owner, kind=kind,
+                                        **{self.id_field: record.get(self.id_field)}, record=record, errors=errors),
+                                   ensure_ascii=False, default=str) + '\n'
+                        for record, errors in items)
+        with FailureLog.lock, open(self.filename, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+
+def item_outcomes(records: list, res_dict: dict) -> tuple[list, list]:
+    """(record, errors) of the items to send again and of the items ozon rejected for good.
+    An item missing from the result or not updated for a passing reason is sent again"""
+    result = res_dict.get('result')
+    items = {str(el.get('offer_id')): el for el in result} if isinstance(result, list) else {}
+    retry, rejected = [], []
+    for record in records:
+        item = items.get(str(record['offer_id']))
+        if item is None:
+            retry.append((record, [dict(code='NO_RESULT', message='позиции нет в ответе')]))
+        elif not item.get('updated'):
+            errors = item.get('errors') or []
+            passing = all(any(code in str(el.get('code')) for code in RETRY_CODES) for el in errors)
+            (retry if passing else rejected).append((record, errors))
+    return retry, rejected
+
+
+class OzonUpload:
+    """Upload half of the OzonApi of every script: the batches are posted concurrently under the rate limits,
+    a whole batch is retried after a 429, a 5xx or a network error, then only the items that were not updated
+    are sent again and the ones that never made it go to the failure log.
+    The OzonApi sets session, limiters, batchers, failures, snapshot and catalog_file and has invalidate_catalog"""
+    def update_stock(self, list_send: Generator, len_list: int, price_flag: bool = False):
+        url = settings.OZON_PRICE_UPDATE_URL if price_flag else settings.OZON_STOCK_UPDATE_URL
+        key = 'prices' if price_flag else 'stocks'
+        workers = settings.OZON_UPLOAD_WORKERS
+        with metrics.stage(f"upload_{key}") as st, ThreadPoolExecutor(max_workers=workers) as executor:
+            st.rows += len_list
+            retry = self.send_batches(executor=executor, url=url, key=key, batches=list_send)
+            # only the items that were not updated are sent again, the pause grows for the per item limits to pass
+            for attempt in range(settings.OZON_ITEM_RETRY_ATTEMPTS):
+                if not retry:
+                    break
+                delay = settings.OZON_ITEM_RETRY_DELAY * 2 ** attempt
+                logger.warning(msg=f"Озон не обновил {len(retry)} позиций, повтор через {delay} сек")
+                sleep(delay)
+                records = [record for record, errors in retry]
+                retry = self.send_batches(executor=executor, url=url, key=key,
+                                          batches=self.batchers[key].batches(records=records))
+            self.failures.write(kind=key, items=retry)
+
+    def send_batches(self, executor: ThreadPoolExecutor, url: str, key: str, batches) -> list:
+        """Posts the batches and returns (record, errors) of the items to send again"""
+        workers = settings.OZON_UPLOAD_WORKERS
+        retry = []
+        # at most `workers` batches in flight, the next batch is taken from the generator only when a slot frees up
+        in_flight = set()
+        for el in batches:
+            if len(in_flight) >= workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    retry += future.result()
+            in_flight.add(executor.submit(metrics.bind(self.post_batch), url=url, payload={key: el}))
+        for future in in_flight:
+            retry += future.result()
+        return retry
+
+    def post_batch(self, url: str, payload: dict) -> list:
+        """Sends one batch and returns (record, errors) of its items worth sending again.
+        A 429, a 5xx or a network error is retried here for the whole batch, the items ozon rejected
+        for good go to the failure log"""
+        # imported on the first upload, a cli run that does not push starts without requests
+        from requests import RequestException, Timeout
+
+        price_flag = 'prices' in payload
+        key = 'prices' if price_flag else 'stocks'
+        records = payload[key]
+        limiter = self.limiters[key]
+        batcher = self.batchers[key]
+        body, headers = compression.json_body(payload=payload, min_size=settings.OZON_GZIP_MIN_SIZE)
+        for attempt in range(settings.OZON_RETRY_ATTEMPTS + 1):
+            limiter.acquire()
+            try:
+                response = self.session.post(url=url, data=body, headers=headers, timeout=settings.OZON_TIMEOUT)
+            except RequestException as e:
+                if isinstance(e, Timeout):
+                    batcher.timed_out(size=len(records))
+                errors = [dict(code=type(e).__name__, message=str(e))]
+                delay = 2 ** attempt
+            else:
+                batcher.record(size=len(records), status=response.status_code,
+                               seconds=response.elapsed.total_seconds())
+                if response.status_code != 429 and response.status_code < 500:
+                    break
+                errors = [dict(code=str(response.status_code), message=response.text)]
+                delay = OzonUpload.retry_after(response=response, attempt=attempt)
+            if attempt < settings.OZON_RETRY_ATTEMPTS:
+                logger.warning(msg=f"Озон не принял пачку на {url} ({errors[0]['code']}), повтор через {delay} сек")
+                sleep(delay)
+        else:
+            # every attempt failed, the items wait for the retry of the items that were not updated
+            return [(record, errors) for record in records]
+
+        if response.status_code != 200:
+            # any other 4xx comes back the same on a resend
+            errors = [dict(code=str(response.status_code), message=response.text)]
+            self.failures.write(kind=key, items=[(record, errors) for record in records])
+            return []
+        try:
+            res_dict = response.json()
+        except ValueError:
+            res_dict = {}
+        if self.snapshot:
+            self.snapshot.acknowledge(kind=key, records=records, res_dict=res_dict)
+        if OzonUpload.has_unknown_items(res_dict=res_dict):
+            # products were archived or removed on ozon since the catalog was cached
+            self.invalidate_catalog(filename=self.catalog_file)
+        retry, rejected = item_outcomes(records=records, res_dict=res_dict)
+        self.failures.write(kind=key, items=rejected)
+        updated = len(records) - len(retry) - len(rejected)
+        counts = f"обновлено {updated}, на повтор {len(retry)}, отклонено {len(rejected)}"
+        if price_flag:
+            logger.info(msg=f"Пачка данных цен обработана: {counts}")
+        else:
+            logger.info(msg=f"Пачка данных кол-ва товаров обработана: {counts}")
+        return retry
+
+    @staticmethod
+    def has_unknown_items(res_dict: dict) -> bool:
+        result = res_dict.get('result')
+        if not isinstance(result, list):
+            return False
+        return any('NOT_FOUND' in str(error.get('code')) for el in result for error in el.get('errors') or [])
+
+    @staticmethod
+    def retry_after(response, attempt: int) -> float:
+        """Delay from the Retry-After header (seconds or http date), exponential backoff if there is none"""
+        header = response.headers.get('Retry-After')
+        if header:
+            try:
+                return max(float(header), 0)
+            except ValueError:
+                try:
+                    return max((parsedate_to_datetime(header) - datetime.now(timezone.utc)).total_seconds(), 0)
+                except (TypeError, ValueError):
+                    pass
+        return 2 ** attempt
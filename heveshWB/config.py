@@ -12,7 +12,27 @@ class Settings(BaseSettings):
     START_TIME: str
     STOP_TIME: str
     WB_WAREHOUSE_ID: int
+    # gzip the json of the stock updates from this many bytes on, 0 sends it as is
+    # turn on only once the api is known to take Content-Encoding: gzip request bodies
+    WB_GZIP_MIN_SIZE: int = 0
+    # the batch size starts at the documented maximum of items per request and adapts to the answers:
+    # halved on a 429, a 5xx or a timeout, cut by a quarter when an answer takes longer than WB_BATCH_SLOW seconds
+    WB_STOCK_BATCH_MAX: int = 1000
+    WB_BATCH_SLOW: float = 5
+    # seconds to wait for the answer to an update
+    WB_TIMEOUT: float = 60
+    # items of a batch that got a 429, a 5xx or a network error are sent again that many times,
+    # after WB_RETRY_DELAY seconds doubled on every round, the catalog pages are retried as often
+    WB_RETRY_ATTEMPTS: int = 3
+    WB_RETRY_DELAY: float = 20
+    # json lines of the updates rejected for good or failed on every retry, empty - the log only
+    WB_FAILURE_LOG: str = "failed_updates.jsonl"
+    # empty - every UPDATE_PERIOD seconds between START_TIME and STOP_TIME, '10m' / '6h' - fixed rate in the same
+    # window, or a cron expression like '*/10 8-17 * * *' that replaces the window
+    STOCK_SCHEDULE: str = ""
     UPDATE_PERIOD: int
+    # local scrape endpoint with the stage metrics of the last cycles, 0 turns it off
+    METRICS_PORT: int = 0
 
     class Messages:
         START_MESSAGE: str = "Начат процесс обновления таблицы остатков склада!"
@@ -1,31 +1,47 @@
 import requests
+import json
 import logging as logger
 import pandas as pd
 from datetime import datetime
-from sys import exit as s_exit
+from openpyxl import load_workbook
+from openpyxl.utils import column_index_from_string
 from time import sleep, time
 from typing import Generator
 
+import batching
+import compression
+import metrics
 from config import settings
+from scheduler import Scheduler, make_trigger, parse_clock
+from sync_state import FailureLog
 logger.basicConfig(level=logger.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
 
 class TableGetter:
 
     @staticmethod
-    def table_from_excel() -> pd.core.frame.DataFrame:
+    def table_from_excel() -> dict:
+        """sku -> amount straight from the supplier workbook.
+        The sheet is streamed row by row in read-only mode and only the sku and amount cells are kept,
+        repeated skus keep the first row"""
+        workbook = load_workbook(filename=settings.EXCEL_FILE, read_only=True, data_only=True)
         try:
-            df_supplies = pd.read_excel(settings.EXCEL_FILE, sheet_name=settings.EXCEL_SHEET_NAME, usecols=f'{settings.EXCEL_OFFER_ID_COL}, {settings.EXCEL_QUANTITY_COL}')
-
-            df_supplies.drop(df_supplies.index[0])
-            headers = ['sku', "amount", ]
-            df_supplies.columns = headers
-            df_supplies[['sku']] = df_supplies[['sku']].astype(str)
-            return df_supplies
-        except Exception as e:
-            logger.warning(msg=f"Во время загрузки таблицы произошла ошибка {e}")
-            sleep(5)
-            s_exit()
+            sheet = workbook[settings.EXCEL_SHEET_NAME]
+            sku_col = column_index_from_string(settings.EXCEL_OFFER_ID_COL.strip())
+            amount_col = column_index_from_string(settings.EXCEL_QUANTITY_COL.strip())
+            first_col = min(sku_col, amount_col)
+
+            site_values = {}
+            # the first row holds the headers
+            for row in sheet.iter_rows(min_row=2, min_col=first_col, max_col=max(sku_col, amount_col),
+                                       values_only=True):
+                sku = row[sku_col - first_col]
+                if sku is None:
+                    continue
+                site_values.setdefault(str(sku), row[amount_col - first_col])
+        finally:
+            workbook.close()
+        return site_values
 
 
 class WB:
@@ -36,6 +52,22 @@ class WB:
         self.updated_at = ''
         self.res_list = []
         self.sku_list = []
+        self.session = WB.make_session(api_key=api_key)
+        # the batch size learned from the answers is kept for the life of the process
+        self.batcher = batching.shared(key=('wb', str(settings.WB_WAREHOUSE_ID), 'stocks'),
+                                       maximum=settings.WB_STOCK_BATCH_MAX, slow=settings.WB_BATCH_SLOW)
+        self.failures = FailureLog(filename=settings.WB_FAILURE_LOG,
+                                   owner=dict(warehouse_id=settings.WB_WAREHOUSE_ID), id_field='sku')
+
+    @staticmethod
+    def make_session(api_key: str) -> requests.Session:
+        """One session for the catalog and the updates: the auth header is set once, the keep-alive connection
+        saves a tls handshake per request and the answers come gzipped"""
+        s = requests.Session()
+        s.headers.update({'accept': 'application/json', 'Authorization': api_key,
+                          'Accept-Encoding': compression.ACCEPT_ENCODING})
+        s.hooks['response'].append(metrics.observe)
+        return s
 
     def get_stock_items(self):
         while self.total >= 100:
@@ -51,139 +83,172 @@ class WB:
         return self
 
     def get_stock_items_batch(self):
-        with requests.Session() as s:
-            headers = {'accept': 'application/json',
-                       'Authorization': self.api_key,
-                       'Content-Type': 'application/json',
-                       }
-            # payload = dict(last_id=self.last_id) if self.last_id else dict()
-            from json import dumps
-            payload = {"settings": {
-                            "cursor": {
-                              "limit": 100,
-                              "updatedAt": self.updated_at,
-                              "nmID": self.last_id
-                            },
-                            "filter": {
-                              "withPhoto": -1,
-                            }
-                      }
-                    } if self.last_id else {"settings": {
-                            "cursor": {
-                              "limit": 100
-                            },
-                            "filter": {
-                              "withPhoto": -1,
-                            }
-                      }
-                    }
-
-            response = s.post(url=settings.WB_STOCK_URL, headers=headers, json=payload)
-
-            res_dict = response.json()
-
-            result = res_dict
-
-            if not result:
-                logger.warning(msg=f"Во время выгрузки данных товаров на вайлдберис произошла ошибка ")
-                sleep(5)
-                s_exit()
-            else:
-                self.last_id = result.get("cursor",).get('nmID')
-                self.updated_at = result.get("cursor",).get('updatedAt')
-                self.total = result.get("cursor",).get('total')
-
-                batch_list = res_dict.get('cards')
-                if not batch_list:
-                    logger.warning(msg=f"Во время выгрузки данных товаров на вайлдберис произошла ошибка {res_dict}")
-                    sleep(5)
-                    s_exit()
-
-                return batch_list
-
-    def process_stock_items(self, stock_list: list, df_site: pd.core.frame.DataFrame) -> tuple:
+        # payload = dict(last_id=self.last_id) if self.last_id else dict()
+        payload = {"settings": {
+                        "cursor": {
+                          "limit": 100,
+                          "updatedAt": self.updated_at,
+                          "nmID": self.last_id
+                        },
+                        "filter": {
+                          "withPhoto": -1,
+                        }
+                  }
+                } if self.last_id else {"settings": {
+                        "cursor": {
+                          "limit": 100
+                        },
+                        "filter": {
+                          "withPhoto": -1,
+                        }
+                  }
+                }
+
+        for attempt in range(settings.WB_RETRY_ATTEMPTS + 1):
+            try:
+                response = self.session.post(url=settings.WB_STOCK_URL, json=payload, timeout=settings.WB_TIMEOUT)
+                res_dict = response.json()
+            except (requests.RequestException, ValueError) as e:
+                res_dict = dict(error=repr(e))
+            if not isinstance(res_dict, dict):
+                res_dict = dict(error=res_dict)
+            # a catalog that is a multiple of the limit ends with an empty page
+            if isinstance(res_dict.get('cards'), list) and res_dict.get('cursor'):
+                break
+            if attempt == settings.WB_RETRY_ATTEMPTS:
+                # raised instead of exiting, the daemon goes on with its next run
+                raise RuntimeError(f"Во время выгрузки данных товаров на вайлдберис произошла ошибка {res_dict}")
+            logger.warning(msg=f"Во время выгрузки данных товаров на вайлдберис произошла ошибка {res_dict}, "
+                               f"повтор через {2 ** attempt} сек")
+            sleep(2 ** attempt)
+
+        self.last_id = res_dict.get("cursor",).get('nmID')
+        self.updated_at = res_dict.get("cursor",).get('updatedAt')
+        self.total = res_dict.get("cursor",).get('total')
+        return res_dict.get('cards')
+
+    def process_stock_items(self, stock_list: list, site_values: dict) -> tuple:
         df_stock = pd.DataFrame(stock_list, columns=['sku'])
 
         df_stock_quants = pd.DataFrame(columns=['sku', 'amount'])
-        stock_quants = []
-        for index, row in df_stock[["sku"]].iterrows():
 
-            key_sku = row["sku"]
-
-            stock_value = tuple(df_site[df_site['sku'] == str(key_sku)]['amount'])
+        stock_quants = []
+        for key_sku in df_stock["sku"]:
 
-            if len(stock_value) == 0:
+            if str(key_sku) not in site_values:
                 continue
 
             stock_quants.append(dict(sku=key_sku,
-                                     amount=stock_value[0],
+                                     amount=site_values[str(key_sku)],
                                      ))
 
         df_stock_quants = pd.concat([df_stock_quants, pd.DataFrame(stock_quants)])
         result_list_dicts = df_stock_quants.to_dict(orient="records")
 
-        batch_list = self.list_batcher(list_dicts=result_list_dicts)
+        batch_list = self.batcher.batches(records=result_list_dicts)
         logger.info(msg=f"Завершено сопоставление таблицы артикулов и таблицы поставщика.\n"
                         f"Обработано {len(result_list_dicts)} записей для кол-ва товаров")
         return batch_list, len(result_list_dicts)
 
-    @staticmethod
-    def list_batcher(list_dicts: list, n: int = 100):
-        len_list = len(list_dicts)
-        for ndx in range(0, len_list, n):
-            yield list_dicts[ndx:min(ndx + n, len_list)]
-
     def update_stock(self, list_send: Generator, len_list: int, price_flag: bool = False):
-        with requests.Session() as s:
-            headers = {'accept': 'application/json',
-                       'Authorization': self.api_key,
-                       'Content-Type': 'application/json',
-                       }
+        with metrics.stage('upload_stocks') as st:
+            st.rows += len_list
             url = f"{settings.WB_STOCK_UPDATE_URL}/{settings.WB_WAREHOUSE_ID}"
+            retry = []
             for el in list_send:
+                retry += self.put_batch(url=url, records=el)
+            # only the items of the failed batches are sent again, after a growing pause
+            for attempt in range(settings.WB_RETRY_ATTEMPTS):
+                if not retry:
+                    break
+                delay = settings.WB_RETRY_DELAY * 2 ** attempt
+                logger.warning(msg=f"Вайлдберис не обновил {len(retry)} позиций, повтор через {delay} сек")
+                sleep(delay)
+                records = [record for record, errors in retry]
+                retry = []
+                for el in self.batcher.batches(records=records):
+                    retry += self.put_batch(url=url, records=el)
+            self.failures.write(kind='stocks', items=retry)
+
+    def put_batch(self, url: str, records: list) -> list:
+        """Sends one batch and returns (record, errors) of its items worth sending again: all of them after
+        a 429, a 5xx or a network error. The skus listed in a 409 go to the failure log, the rest of the batch
+        was updated"""
+        body, headers = compression.json_body(payload=dict(stocks=records), min_size=settings.WB_GZIP_MIN_SIZE)
+        try:
+            response = self.session.put(url=url, headers=headers, data=body, timeout=settings.WB_TIMEOUT)
+        except requests.RequestException as e:
+            if isinstance(e, requests.Timeout):
+                self.batcher.timed_out(size=len(records))
+            logger.warning(msg=f"Пачка данных кол-ва товаров не отправлена на {url}: {e!r}")
+            return [(record, [dict(code=type(e).__name__, message=str(e))]) for record in records]
+        self.batcher.record(size=len(records), status=response.status_code, seconds=response.elapsed.total_seconds())
+
+        rejected = []
+        if response.status_code == 409:
+            rejected = WB.rejected_items(records=records, response=response)
+        elif response.status_code == 429 or response.status_code >= 500:
+            logger.warning(msg=f"Вайлдберис не принял пачку ({response.status_code}): {response.text}")
+            return [(record, [dict(code=str(response.status_code), message=response.text)]) for record in records]
+        elif response.status_code >= 400:
+            # any other 4xx comes back the same on a resend
+            rejected = [(record, [dict(code=str(response.status_code), message=response.text)]) for record in records]
+        self.failures.write(kind='stocks', items=rejected)
+        logger.info(msg=f"Пачка данных кол-ва товаров обработана: обновлено {len(records) - len(rejected)}, "
+                        f"отклонено {len(rejected)}")
+        return []
 
-                payload = dict(stocks=el)
-
-                response = s.put(url=url, headers=headers,
-                                 json=payload)
-
-                logger.info(msg=f"Пачка данных кол-ва товаров обработана,\nОтвет сервера:{response.status_code}\n"
-                                f"Сообщение от сервера: {response.text}")
+    @staticmethod
+    def rejected_items(records: list, response: requests.Response) -> list:
+        """(record, errors) of the skus in the data of the errors of a 409 answer"""
+        try:
+            answer = response.json()
+        except ValueError:
+            answer = None
+        errors_by_sku = {}
+        for error in answer if isinstance(answer, list) else []:
+            for el in error.get('data') or []:
+                errors_by_sku.setdefault(str(el.get('sku')), []).append(dict(code=error.get('code'),
+                                                                             message=error.get('message')))
+        if not errors_by_sku:
+            # no way to tell the skus apart, the whole batch is reported
+            return [(record, [dict(code='409', message=response.text)]) for record in records]
+        return [(record, errors_by_sku[str(record['sku'])]) for record in records
+                if str(record['sku']) in errors_by_sku]
 
 
 def runner_stock():
     start = time()
-
-    wb = WB(api_key=settings.WB_API_KEY)
-
-    df_wb = TableGetter.table_from_excel()
-    stock_list = wb.get_stock_items().get_skus().sku_list
-    # print(stock_list, len(stock_list))
-    batches2send, len_list = wb.process_stock_items(stock_list=stock_list, df_site=df_wb)
-    wb.update_stock(list_send=batches2send, len_list=len_list)
-
+    cycle = metrics.start_cycle(name='runner_stock')
+    try:
+        wb = WB(api_key=settings.WB_API_KEY)
+
+        with metrics.stage('supplier_fetch') as st:
+            site_values = TableGetter.table_from_excel()
+            st.rows = len(site_values)
+        with metrics.stage('wb_catalog') as st:
+            stock_list = wb.get_stock_items().get_skus().sku_list
+            st.rows = len(stock_list)
+        # print(stock_list, len(stock_list))
+        with metrics.stage('matching') as st:
+            batches2send, len_list = wb.process_stock_items(stock_list=stock_list, site_values=site_values)
+            st.rows = len(stock_list)
+        wb.update_stock(list_send=batches2send, len_list=len_list)
+    finally:
+        cycle.finish()
     finish = time()
     delta = finish - start
     logger.info(msg=f"Обновление {len_list} позиций по остаткам склада выполнено за {delta}")
 
 
 def main_proc():
-    while True:
-        time_pc = datetime.now()
-
-        start_time = datetime.strptime(settings.START_TIME, '%H:%M').replace(year=time_pc.year)\
-            .replace(month=time_pc.month).replace(day=time_pc.day)
-
-        stop_time = datetime.strptime(settings.STOP_TIME, '%H:%M').replace(year=time_pc.year)\
-            .replace(month=time_pc.month).replace(day=time_pc.day)
-
-        if start_time < time_pc < stop_time:
-            logger.info(msg=f"{time_pc} - запускаю обработчик")
-            runner_stock()
-            logger.info(msg=f"Обработчик запустится через {settings.UPDATE_PERIOD} сек - а пока баиньки")
-            sleep(settings.UPDATE_PERIOD)
-        else:
-            sleep(5)
+    metrics.serve(port=settings.METRICS_PORT)
+    sch = Scheduler()
+    # the scheduler sleeps until the window opens instead of polling the clock
+    sch.add(name='остатки', func=runner_stock,
+            trigger=make_trigger(spec=settings.STOCK_SCHEDULE, period=settings.UPDATE_PERIOD,
+                                 window=(parse_clock(settings.START_TIME), parse_clock(settings.STOP_TIME))))
+    sch.run_forever()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,31 @@
+"""Deferred imports for the heavy dependencies, so a cli run starts without loading what it does not need.
+
+    pd = LazyModule('pandas')
+    df = pd.DataFrame(rows)     # pandas is imported here, on the first attribute access
+
+Annotations that name a lazy module stay strings with `from __future__ import annotations` and do not import it.
+"""
+from importlib import import_module
+from threading import Lock
+
+
+class LazyModule:
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module = None
+        self._lock = Lock()
+
+    def _load(self):
+        # upload threads may be the first users of a module, import it once
+        with self._lock:
+            if self._module is None:
+                self._module = import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        module = self._module if self._module is not None else self._load()
+        return getattr(module, attr)
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<lazy module {self._name!r}, {state}>"
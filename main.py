@@ -1,41 +1,175 @@
-import requests
+from __future__ import annotations
+
+import argparse
+import json
 import logging as logger
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from io import BytesIO
 from prices_reader import PriceReader
+from os import getpid, remove, replace
+from os.path import splitext
 from sys import exit as s_exit
 from time import sleep, time
-from typing import Generator
 
+import batching
+import compression
+import metrics
 from config import settings
+from download_cache import DownloadCache
+from lazy_import import LazyModule
+from scheduler import Scheduler, make_trigger
+from sync_state import FailureLog, OzonUpload, RateLimiter, SyncSnapshot
+
+# loaded on first use, so a cli run imports pandas and requests only when a stage needs them
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+requests = LazyModule('requests')
+urllib3 = LazyModule('urllib3')
 logger.basicConfig(level=logger.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
 
+class SupplierTable:
+    """Supplier rows in a compact form: every offer_id once in a pandas Index, stocks and prices as int32 arrays
+    in the same row order. Only the first row of an offer_id is kept, the lookups always took the first one"""
+    NO_PRICE = -1
+
+    def __init__(self, offer_ids: list, stocks: list, prices: list = None, zero_stocks: list = ()) -> None:
+        index = pd.Index(offer_ids, dtype=object)
+        first = ~index.duplicated(keep='first')
+        self.offer_ids = index[first]
+        self.stocks = np.asarray(stocks, dtype=np.int32)[first]
+        if len(zero_stocks):
+            self.stocks[np.isin(self.stocks, zero_stocks)] = 0
+        self.prices = np.asarray(prices, dtype=np.int32)[first] if prices is not None else None
+
+    def __len__(self) -> int:
+        return len(self.offer_ids)
+
+    def rows(self, offer_ids) -> np.ndarray:
+        """Row of every given offer_id, -1 for the ones the supplier does not have"""
+        return self.offer_ids.get_indexer(offer_ids)
+
+    def columns(self) -> dict:
+        """Plain arrays of the table, pickled without a reference to the module of the script that made it"""
+        return dict(offer_ids=self.offer_ids.to_numpy(), stocks=self.stocks, prices=self.prices)
+
+    @staticmethod
+    def from_columns(columns: dict) -> SupplierTable:
+        table = SupplierTable.__new__(SupplierTable)
+        table.offer_ids = pd.Index(columns['offer_ids'], dtype=object)
+        table.stocks = columns['stocks']
+        table.prices = columns['prices']
+        return table
+
+    @staticmethod
+    def min_items(rule: str) -> list:
+        """Stocks that OZON_MIN_ITEMS turns into 0. The rule used to be replaced over string cells, so only its
+        string entries ever matched a stock, numbers like the [1,] of .env_dist never did and still do not"""
+        return [int(el) for el in eval(rule) if isinstance(el, str) and el.strip().isdigit()]
+
+
 class TableGetter:
+    cache = None
+
     def __init__(self, api_token: str) -> None:
         self.api_token = api_token
         self.last_id = ''
 
-    def table_requester(self, offset: int = None):
-        with requests.Session() as s:
-            headers = {"Authorization": f"Bearer {self.api_token}"}
-            payload = dict(offset=offset) if offset else None
-            response = s.get(url=settings.INVASK_API_URL, headers=headers, params=payload)
-            if not response.status_code == 200:
-                logger.warning(msg=f"Во время загрузки данных с {settings.INVASK_API_URL} произошла ошибка\n"
-                                   f"Ответ сервера: {response.status_code} \n {response.text}")
-                s_exit()
-            res_dict = response.json()
-            return res_dict.get("total"), res_dict.get("products")
+    @staticmethod
+    def download_cache() -> DownloadCache:
+        """One cache for the life of the process, so the last table is at hand in every cycle"""
+        if TableGetter.cache is None:
+            TableGetter.cache = DownloadCache(filename=settings.INVASK_CACHE_FILE, name='Invask',
+                                              dump=SupplierTable.columns, restore=SupplierTable.from_columns)
+        return TableGetter.cache
+
+    def session(self) -> requests.Session:
+        s = requests.Session()
+        s.headers.update({"Authorization": f"Bearer {self.api_token}"})
+        s.hooks['response'].append(metrics.observe)
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=settings.INVASK_WORKERS)
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        return s
+
+    def page_requester(self, s: requests.Session, offset: int = None) -> bytes:
+        payload = dict(offset=offset) if offset else None
+        response = s.get(url=settings.INVASK_API_URL, params=payload)
+        if not response.status_code == 200:
+            raise RuntimeError(f"Во время загрузки данных с {settings.INVASK_API_URL} произошла ошибка\n"
+                               f"Ответ сервера: {response.status_code} \n {response.text}")
+        return response.content
+
+    def table_requester(self, s: requests.Session, offset: int = None):
+        res_dict = json.loads(self.page_requester(s=s, offset=offset))
+        return res_dict.get("total"), res_dict.get("products")
+
+    def get_pages(self) -> list:
+        """Raw bodies of every page in offset order, only the first one is parsed to learn the total"""
+        with self.session() as s:
+            first_page = self.page_requester(s=s)
+            res_dict = json.loads(first_page)
+            total, page_size = res_dict.get("total"), len(res_dict.get("products"))
+            pages = [first_page]
+            if page_size and total > page_size:
+                # every remaining offset is known after the first page, fetch them all at once
+                offsets = range(page_size, total, page_size)
+                with ThreadPoolExecutor(max_workers=settings.INVASK_WORKERS) as executor:
+                    pages += list(executor.map(metrics.bind(lambda offset: self.page_requester(s=s, offset=offset)),
+                                               offsets))
+        return pages
+
+    def products_of(self, pages: list) -> list:
+        batches = [json.loads(el).get("products") for el in pages]
+        if any(len(pr_batch_list) < len(batches[0]) for pr_batch_list in batches[:-1]):
+            # the server shortened a page, offsets computed up front are no longer valid
+            logger.warning(msg="Invask вернул неполную страницу, загружаю остатки последовательно")
+            return self.get_stock_sequential()
+        return TableGetter.unique_products(product_list=[el for pr_batch_list in batches for el in pr_batch_list])
+
+    def get_stock_sequential(self) -> list:
+        with self.session() as s:
+            total, pr_list = self.table_requester(s=s)
+            while total > len(pr_list):
+                total, pr_batch_list = self.table_requester(s=s, offset=len(pr_list))
+                pr_list += pr_batch_list
+        return TableGetter.unique_products(product_list=pr_list)
 
     def get_stock(self) -> list:
-        total, pr_list = self.table_requester()
-        while total > len(pr_list):
-            total, pr_batch_list = self.table_requester(offset=len(pr_list))
-            pr_list += pr_batch_list
+        return self.products_of(pages=self.get_pages())
+
+    def get_table(self) -> SupplierTable:
+        """Normalized supplier table, the one of the last cycle if no page changed since then"""
+        cache = TableGetter.download_cache()
+        with metrics.stage('supplier_fetch') as fetch_stage:
+            pages = self.get_pages()
+        digest = DownloadCache.digest_of(chunks=pages)
+        if settings.INVASK_CACHE and cache.unchanged(digest=digest):
+            fetch_stage.rows = len(cache.table)
+            return cache.table
+
+        with metrics.stage('supplier_normalize') as st:
+            product_list = self.products_of(pages=pages)
+            fetch_stage.rows = len(product_list)
+            df_invask = TableGetter.process_table(product_list=product_list)
+            st.rows = len(df_invask)
+        if settings.INVASK_CACHE:
+            cache.store(table=df_invask, digest=digest)
+        return df_invask
 
-        return pr_list
+    @staticmethod
+    def unique_products(product_list: list) -> list:
+        """Drops repeated cat_number entries (pages can overlap if the feed changes mid download), first one wins"""
+        seen = set()
+        unique_list = []
+        for el in product_list:
+            cat_number = el.get("cat_number")
+            if cat_number in seen:
+                continue
+            seen.add(cat_number)
+            unique_list.append(el)
+        return unique_list
 
     @staticmethod
     def get_name() -> str:
@@ -64,50 +198,43 @@ class TableGetter:
 
         writer.close()
 
-    def register_download(self) -> list:
-        with requests.Session() as s:
-            headers = {'Client-Id': self.client_id,
-                       'Api-Key': self.api_key}
-            payload = dict(last_id=self.last_id) if self.last_id else dict()
-            response = s.post(url=settings.OZON_STOCK_URL, headers=headers, json=payload)
-            res_dict = response.json()
-            last_id = res_dict.get("result").get("last_id")
-            if last_id == '':
-                self.last_id = last_id
-                return []
+    def register_download(self, s: requests.Session) -> list:
+        payload = dict(last_id=self.last_id) if self.last_id else dict()
+        response = s.post(url=settings.OZON_STOCK_URL, json=payload)
+        res_dict = response.json()
+        last_id = res_dict.get("result").get("last_id")
+        if last_id == '':
             self.last_id = last_id
-            batch_list = res_dict.get("result").get('items')
-            if not batch_list:
-                logger.warning(msg=f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}")
-                s_exit()
-            return batch_list
+            return []
+        self.last_id = last_id
+        batch_list = res_dict.get("result").get('items')
+        if not batch_list:
+            raise RuntimeError(f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}")
+        return batch_list
 
     @staticmethod
-    def process_table(product_list: list) -> pd.core.frame.DataFrame:
-
-        string_list = list(
-            filter(lambda x: isinstance(x.get("quantityLabel"), str) and x.get("quantityLabel").startswith(">"),
-                   product_list))
-        num_list = list(filter(lambda x: isinstance(x.get("quantityLabel"), int), product_list))
-
-        conv_string_list = list(
-            map(lambda x: {"cat_number": str(x.get("cat_number")),
-                           "quantityLabel": str(int(x.get("quantityLabel")[1:]) + 1),
-                           "regular_price": str(x.get("regular_price"))},
-                string_list))
-        conv_num_list = list(
-            map(lambda x: {"cat_number": str(x.get("cat_number")),
-                           "quantityLabel": str(x.get("quantityLabel")),
-                           "regular_price": str(x.get("regular_price"))
-                           }, num_list))
-
-        super_list = conv_string_list + conv_num_list
-        df_invask = pd.DataFrame(super_list)
-        df_invask = df_invask.replace(eval(settings.OZON_MIN_ITEMS), 0)
-        # df_invask = df_invask.replace(">10", settings.OZON_MAX_ITEMS).replace(eval(settings.OZON_MIN_ITEMS), 0)
-        df_invask.rename(columns={df_invask.columns[0]: 'offer_id', df_invask.columns[1]: 'stock_val'}, inplace=True)
-        # df_invask = df_invask.iloc[:, :]
-        return df_invask
+    def process_table(product_list: list) -> SupplierTable:
+        # '>N' labels go first as they always did, the first row of a duplicated offer_id is the one kept
+        string_list = [el for el in product_list
+                       if isinstance(el.get("quantityLabel"), str) and el.get("quantityLabel").startswith(">")]
+        num_list = [el for el in product_list if isinstance(el.get("quantityLabel"), int)]
+
+        offer_ids, stocks, prices, bad_prices = [], [], [], []
+        for el in string_list + num_list:
+            quantity = el.get("quantityLabel")
+            price = el.get("regular_price")
+            offer_ids.append(str(el.get("cat_number")))
+            stocks.append(int(quantity[1:]) + 1 if isinstance(quantity, str) else quantity)
+            try:
+                prices.append(int(float(price)) if price is not None else SupplierTable.NO_PRICE)
+            except (TypeError, ValueError, OverflowError):
+                # a text instead of the price, the stock of the offer is still pushed
+                bad_prices.append(offer_ids[-1])
+                prices.append(SupplierTable.NO_PRICE)
+        if bad_prices:
+            logger.warning(msg=f"Цена не число у {len(bad_prices)} позиций, их цены не отправляются: {bad_prices[:10]}")
+        return SupplierTable(offer_ids=offer_ids, stocks=stocks, prices=prices,
+                             zero_stocks=SupplierTable.min_items(rule=settings.OZON_MIN_ITEMS))
 
 
 class SimaLandApi:
@@ -134,232 +261,422 @@ class SimaLandApi:
             response = s.post(url=f"{settings.SIMA_ISLAND_URL}items", headers=headers, json=payload)
 
 
-class OzonApi:
-    def __init__(self, client_id: str, api_key: str, prices_delta_dict: dict) -> None:
+class OzonApi(OzonUpload):
+    def __init__(self, client_id: str, api_key: str, prices_delta_dict: dict, session: requests.Session = None,
+                 snapshot: SyncSnapshot = None, warehouse_id=None, limiters: dict = None,
+                 catalog_file: str = None) -> None:
         self.client_id = client_id
         self.api_key = api_key
         self.last_id = None
         self.res_list = []
         self.prices_dd = prices_delta_dict
+        self.snapshot = snapshot
+        self.session = session if session else OzonApi.make_session(client_id=client_id, api_key=api_key)
+        self.warehouse_id = warehouse_id if warehouse_id is not None else settings.OZON_WAREHOUSE_ID
+        self.catalog_file = catalog_file if catalog_file else settings.OZON_CATALOG_CACHE
+        self.limiters = limiters if limiters else OzonApi.make_limiters()
+        self.batchers = OzonApi.make_batchers(client_id=str(client_id))
+        self.failures = FailureLog(filename=settings.OZON_FAILURE_LOG, owner=dict(client_id=str(client_id)))
+
+    @staticmethod
+    def make_limiters() -> dict:
+        # one bucket per ozon method, quotas are counted separately for stocks and prices
+        return dict(stocks=RateLimiter(rate=settings.OZON_STOCK_RATE_LIMIT),
+                    prices=RateLimiter(rate=settings.OZON_PRICE_RATE_LIMIT))
+
+    @staticmethod
+    def make_batchers(client_id: str) -> dict:
+        # batch sizes are learned per seller account and method and kept for the life of the process
+        return dict(stocks=batching.shared(key=(client_id, 'stocks'), maximum=settings.OZON_STOCK_BATCH_MAX,
+                                           slow=settings.OZON_BATCH_SLOW),
+                    prices=batching.shared(key=(client_id, 'prices'), maximum=settings.OZON_PRICE_BATCH_MAX,
+                                           slow=settings.OZON_BATCH_SLOW))
 
-    def get_stock_items(self):
+    @staticmethod
+    def make_session(client_id: str, api_key: str) -> requests.Session:
+        """Long-lived session for the seller api: auth headers are set once and the pooled
+        keep-alive connections are reused by every request of every cycle"""
+        s = requests.Session()
+        s.headers.update({'Client-Id': client_id, 'Api-Key': api_key,
+                          'Accept-Encoding': compression.ACCEPT_ENCODING})
+        s.hooks['response'].append(metrics.observe)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=settings.OZON_POOL_SIZE,
+            max_retries=urllib3.util.retry.Retry(connect=3, read=0, backoff_factor=0.5))
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        return s
+
+    def get_stock_items(self, refresh: bool = False):
+        if not refresh:
+            cached_list = self.load_catalog()
+            if cached_list is not None:
+                self.res_list = cached_list
+                logger.info(msg="Данные с озон склада взяты из кэша")
+                return self.res_list
         while self.last_id != '':
             self.res_list += self.get_stock_items_batch()
+        self.save_catalog(items=self.res_list)
         logger.info(msg="Данные с озон склада получены")
         return self.res_list
 
-    def get_stock_items_batch(self):
-        with requests.Session() as s:
-            headers = {'Client-Id': self.client_id,
-                       'Api-Key': self.api_key}
-            payload = dict(last_id=self.last_id) if self.last_id else dict()
-            response = s.post(url=settings.OZON_STOCK_URL, headers=headers, json=payload)
-            res_dict = response.json()
-            result = res_dict.get("result")
-            if not result:
-                logger.warning(msg=f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}")
-                s_exit()
-            else:
-                last_id = result.get("last_id")
-                if last_id == '':
-                    self.last_id = last_id
-                    return []
-                self.last_id = last_id
-                batch_list = res_dict.get("result").get('items')
-                if not batch_list:
-                    logger.warning(msg=f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}")
-                    s_exit()
-                return batch_list
-
-    def process_stock_items(self, stock_list: list, df_site: pd.core.frame.DataFrame, price_flag: bool = False) -> tuple:
-        df_stock_raw = pd.DataFrame(stock_list)
-        df_stock = df_stock_raw[['product_id', 'offer_id']]
-        df_stock_quants = pd.DataFrame(columns=['offer_id', 'product_id', 'stock', 'warehouse_id'])
-
-        stock_quants = []
-        for index, row in df_stock[["product_id", "offer_id"]].iterrows():
-
-            key_oid = row["offer_id"]
-            key_pid = row["product_id"]
-            # get stock value from supplier table
-            if not price_flag:
-                stock_value = tuple(df_site[df_site['offer_id'] == key_oid]['stock_val'])
+    def load_catalog(self) -> list | None:
+        """offer_id/product_id pairs saved by an earlier cycle or by another process of the same seller account"""
+        try:
+            with open(self.catalog_file, encoding='utf-8') as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if catalog.get('client_id') != self.client_id or time() - catalog.get('saved_at', 0) > settings.OZON_CATALOG_TTL:
+            return None
+        return catalog.get('items')
+
+    def save_catalog(self, items: list) -> None:
+        catalog = dict(client_id=self.client_id, saved_at=time(),
+                       items=[dict(product_id=el.get('product_id'), offer_id=el.get('offer_id')) for el in items])
+        tmp_name = f"{self.catalog_file}.{getpid()}.tmp"
+        with open(tmp_name, 'w', encoding='utf-8') as f:
+            json.dump(catalog, f, ensure_ascii=False)
+        replace(tmp_name, self.catalog_file)
 
-                if len(stock_value) == 0:
-                    continue
-                stock_quants.append(dict(offer_id=key_oid,
-                                         product_id=key_pid,
-                                         stock=stock_value[0],
-                                         warehouse_id=settings.OZON_WAREHOUSE_ID))
-            else:
+    @staticmethod
+    def invalidate_catalog(filename: str = settings.OZON_CATALOG_CACHE) -> None:
+        """Forces the next cycle to list the ozon catalog again"""
+        try:
+            remove(filename)
+        except FileNotFoundError:
+            pass
 
-                price_value = tuple(df_site[df_site['offer_id'] == key_oid]['regular_price'])
+    def get_stock_items_batch(self):
+        payload = dict(last_id=self.last_id) if self.last_id else dict()
+        for attempt in range(settings.OZON_RETRY_ATTEMPTS + 1):
+            res_dict = self.list_page(payload=payload)
+            result = res_dict.get("result")
+            # an empty page with an empty last_id ends the listing, any other page has items
+            if result and (result.get("last_id") == '' or result.get('items')):
+                break
+            if attempt == settings.OZON_RETRY_ATTEMPTS:
+                # raised instead of exiting, a daemon goes on with its next run
+                raise RuntimeError(f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}")
+            logger.warning(msg=f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}, "
+                               f"повтор через {2 ** attempt} сек")
+            sleep(2 ** attempt)
+        self.last_id = result.get("last_id")
+        if self.last_id == '':
+            return []
+        return result.get('items')
+
+    def list_page(self, payload: dict) -> dict:
+        """One page of the catalog, a failed request is returned as {'error': ...} and tried again"""
+        try:
+            response = self.session.post(url=settings.OZON_STOCK_URL, json=payload, timeout=settings.OZON_TIMEOUT)
+            return response.json()
+        except (requests.RequestException, ValueError) as e:
+            return dict(error=repr(e))
 
+    @staticmethod
+    def site_lookup(df_site: SupplierTable, column: str) -> dict:
+        """offer_id -> value of the supplier table, `column` is 'stocks' or 'prices'"""
+        return dict(zip(df_site.offer_ids, getattr(df_site, column).tolist()))
+
+    def match_items(self, stock_list: list, df_site: SupplierTable, stock_flag: bool = True,
+                    price_flag: bool = True) -> tuple[list, list]:
+        """Single pass over the ozon catalog that builds the stock records, the price records or both"""
+        df_stock = pd.DataFrame(stock_list)[['product_id', 'offer_id']]
+
+        # supplier row of every ozon item in one hash lookup over the offer_id index, -1 if there is none
+        rows = df_site.rows(offer_ids=df_stock['offer_id'])
+        found = rows >= 0
+        rows = rows[found]
+        offer_ids = df_stock['offer_id'][found].tolist()
+        product_ids = df_stock['product_id'][found].tolist()
 
+        stock_quants = []
+        if stock_flag:
+            stock_quants = [dict(offer_id=key_oid, product_id=key_pid, stock=stock, warehouse_id=self.warehouse_id)
+                            for key_oid, key_pid, stock in zip(offer_ids, product_ids, df_site.stocks[rows].tolist())]
+
+        # matched price rows as columns, repriced all at once after the loop
+        price_oids, price_pids, supplier_prices, markups, deliveries = [], [], [], [], []
+        if price_flag and df_site.prices is not None:
+            for key_oid, key_pid, price in zip(offer_ids, product_ids, df_site.prices[rows].tolist()):
                 prices_tuple = self.prices_dd.get(key_oid)
-
-                if len(price_value) == 0 or prices_tuple is None or len(prices_tuple) != 2:
+                if price == SupplierTable.NO_PRICE or prices_tuple is None or len(prices_tuple) != 2:
                     continue
+                price_oids.append(key_oid)
+                price_pids.append(key_pid)
+                supplier_prices.append(price)
+                markups.append(prices_tuple[0])
+                deliveries.append(prices_tuple[1])
+
+        with metrics.stage('pricing') as st:
+            updated_values = PriceReader.price_process_batch(prices=supplier_prices, markups=markups,
+                                                             deliveries=deliveries)
+            st.rows = len(supplier_prices)
+        price_quants = [dict(offer_id=key_oid,
+                             product_id=key_pid,
+                             old_price="0",
+                             price=str(updated_value),
+                             ) for key_oid, key_pid, updated_value in zip(price_oids, price_pids, updated_values)]
+        return stock_quants, price_quants
+
+    def stock_batches(self, stock_quants: list) -> tuple:
+        result_list_dicts = stock_quants
+        if self.snapshot:
+            result_list_dicts = self.snapshot.changed(kind='stocks', records=result_list_dicts)
+        batch_list = self.batchers['stocks'].batches(records=result_list_dicts)
+        logger.info(msg=f"Завершено сопоставление таблицы артикулов и таблицы поставщика.\n"
+                    f"Обработано {len(result_list_dicts)} записей для кол-ва товаров")
+        return batch_list, len(result_list_dicts)
+
+    def price_batches(self, price_quants: list) -> tuple:
+        if self.snapshot:
+            price_quants = self.snapshot.changed(kind='prices', records=price_quants)
+        batch_list = self.batchers['prices'].batches(records=price_quants)
+        logger.info(msg=f"Завершено сопоставление таблицы артикулов и таблицы поставщика.\n"
+                    f"Обработано {len(price_quants)} записей для цен")
+        return batch_list, len(price_quants)
+
+    def process_stock_items(self, stock_list: list, df_site: SupplierTable, price_flag: bool = False) -> tuple:
+        stock_quants, price_quants = self.match_items(stock_list=stock_list, df_site=df_site,
+                                                      stock_flag=not price_flag, price_flag=price_flag)
+        if not price_flag:
+            return self.stock_batches(stock_quants=stock_quants)
+        return self.price_batches(price_quants=price_quants)
 
+    def process_all_items(self, stock_list: list, df_site: SupplierTable) -> tuple:
+        """Stock and price batches from one matching pass: (stock batches, stock count, price batches, price count)"""
+        stock_quants, price_quants = self.match_items(stock_list=stock_list, df_site=df_site)
+        return self.stock_batches(stock_quants=stock_quants) + self.price_batches(price_quants=price_quants)
 
-                # if key_oid == '451873':
-                #     print(price_value, price_delta)
-                updated_value = PriceReader.price_process(price=int(price_value[0]), prices_tuple=prices_tuple)
-                stock_quants.append(dict(offer_id=key_oid,
-                                         product_id=key_pid,
-                                         old_price="0",
-                                         price=updated_value,
-                                         # price=price_value[0],
-                                         # updated_price=updated_value
-                                         ))
-        if not price_flag:
-            df_stock_quants = pd.concat([df_stock_quants, pd.DataFrame(stock_quants)])
-            result_list_dicts = df_stock_quants.to_dict(orient="records")
-            batch_list = self.list_batcher(list_dicts=result_list_dicts)
-            logger.info(msg=f"Завершено сопоставление таблицы артикулов и таблицы поставщика.\n"
-                        f"Обработано {len(result_list_dicts)} записей для кол-ва товаров")
-            return batch_list, len(result_list_dicts)
-        else:
-            # print(stock_quants[:10])
-            batch_list = self.list_batcher(list_dicts=stock_quants, n=1000)
-            logger.info(msg=f"Завершено сопоставление таблицы артикулов и таблицы поставщика.\n"
-                        f"Обработано {len(stock_quants)} записей для цен")
-            return batch_list, len(stock_quants)
-
-    def update_stock(self, list_send: Generator, len_list: int, price_flag: bool = False):
-        with requests.Session() as s:
-            headers = {'Client-Id': self.client_id,
-                       'Api-Key': self.api_key}
-            if not price_flag:
-                for el in list_send:
 
-                    payload = dict(stocks=el)
-                    response = s.post(url=settings.OZON_STOCK_UPDATE_URL, headers=headers, json=payload)
-                    logger.info(msg=f"Пачка данных кол-ва товаров обработана:{response.json()}")
-            else:
-                for el in list_send:
-                    payload = dict(prices=el)
-                    response = s.post(url=settings.OZON_PRICE_UPDATE_URL, headers=headers, json=payload)
-                    logger.info(msg=f"Пачка данных цен обработана:{response.json()}")
-                if len_list > 8000:
-                    sleep(1)
+class OzonAccount:
+    """Seller account and warehouse the supplier feed is pushed to. The session, the rate limiters and the
+    snapshot live as long as the daemon, warehouses of one seller account share its limiters and catalog"""
+    def __init__(self, client_id: str, api_key: str, warehouse_id, snapshot_file: str = settings.SNAPSHOT_FILE,
+                 catalog_file: str = settings.OZON_CATALOG_CACHE, limiters: dict = None) -> None:
+        self.client_id = str(client_id)
+        self.api_key = api_key
+        self.warehouse_id = warehouse_id
+        self.name = f"{client_id}:{warehouse_id}"
+        self.catalog_file = catalog_file
+        self.session = OzonApi.make_session(client_id=self.client_id, api_key=api_key)
+        self.limiters = limiters if limiters else OzonApi.make_limiters()
+        self.snapshot = SyncSnapshot(filename=snapshot_file, full_sync_every=settings.FULL_SYNC_EVERY)
 
     @staticmethod
-    def list_batcher(list_dicts: list, n: int = 100):
-        len_list = len(list_dicts)
-        for ndx in range(0, len_list, n):
-            yield list_dicts[ndx:min(ndx + n, len_list)]
-
+    def from_settings() -> list:
+        """OZON_ACCOUNTS if set, otherwise the single OZON_CLIENT_ID / OZON_API_KEY / OZON_WAREHOUSE_ID account"""
+        if not settings.OZON_ACCOUNTS.strip():
+            return [OzonAccount(client_id=settings.OZON_CLIENT_ID, api_key=settings.OZON_API_KEY,
+                                warehouse_id=settings.OZON_WAREHOUSE_ID)]
+        accounts, limiters = [], {}
+        for el in json.loads(settings.OZON_ACCOUNTS):
+            client_id = str(el['client_id'])
+            warehouse_id = el.get('warehouse_id', settings.OZON_WAREHOUSE_ID)
+            accounts.append(OzonAccount(client_id=client_id, api_key=el['api_key'], warehouse_id=warehouse_id,
+                                        snapshot_file=OzonAccount.suffixed(filename=settings.SNAPSHOT_FILE,
+                                                                           suffix=f"{client_id}_{warehouse_id}"),
+                                        catalog_file=OzonAccount.suffixed(filename=settings.OZON_CATALOG_CACHE,
+                                                                          suffix=client_id),
+                                        # ozon counts the quotas per seller account
+                                        limiters=limiters.setdefault(client_id, OzonApi.make_limiters())))
+        return accounts
 
-def runner(prices_dd: dict):
+    @staticmethod
+    def suffixed(filename: str, suffix: str) -> str:
+        root, ext = splitext(filename)
+        return f"{root}_{suffix}{ext}"
+
+    def ozon_api(self, prices_dd: dict) -> OzonApi:
+        return OzonApi(client_id=self.client_id, api_key=self.api_key, prices_delta_dict=prices_dd,
+                       session=self.session, snapshot=self.snapshot, warehouse_id=self.warehouse_id,
+                       limiters=self.limiters, catalog_file=self.catalog_file)
+
+    def sync(self, stock_list: list, df_site: SupplierTable, prices_dd: dict, stock_flag: bool = True,
+             price_flag: bool = True) -> tuple[int, int]:
+        """Matching and upload of one account, returns the number of stock and price records sent"""
+        self.snapshot.start_cycle(kinds=[kind for kind, flag in (('stocks', stock_flag), ('prices', price_flag))
+                                         if flag])
+        oa = self.ozon_api(prices_dd=prices_dd)
+        batches2send, len_list, batches2send_p, len_list_p = [], 0, [], 0
+        with metrics.stage('matching') as st:
+            if stock_flag and price_flag:
+                batches2send, len_list, batches2send_p, len_list_p = oa.process_all_items(stock_list=stock_list,
+                                                                                          df_site=df_site)
+            elif price_flag:
+                batches2send_p, len_list_p = oa.process_stock_items(stock_list=stock_list, df_site=df_site,
+                                                                    price_flag=True)
+            else:
+                batches2send, len_list = oa.process_stock_items(stock_list=stock_list, df_site=df_site)
+            st.rows = len(stock_list)
+
+        if stock_flag:
+            oa.update_stock(list_send=batches2send, len_list=len_list)
+        if price_flag:
+            oa.update_stock(list_send=batches2send_p, len_list=len_list_p, price_flag=True)
+
+        self.snapshot.save()
+        return len_list, len_list_p
+
+
+def sync_accounts(accounts: list, df_site: SupplierTable, prices_dd: dict, stock_flag: bool = True,
+                  price_flag: bool = True) -> tuple[int, int]:
+    """The supplier table is downloaded once and pushed to every account by parallel workers.
+    The catalog is listed once per seller account. With several accounts the stage metrics add up over all of them"""
+    workers = max(min(settings.OZON_ACCOUNT_WORKERS, len(accounts)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        with metrics.stage('ozon_catalog') as st:
+            listing = {}
+            for account in accounts:
+                listing.setdefault(account.client_id, account)
+            stock_lists = dict(zip(listing, executor.map(metrics.bind(lambda account: account.ozon_api(prices_dd={})
+                                                                      .get_stock_items()), listing.values())))
+            st.rows = sum(map(len, stock_lists.values()))
+
+        sync = metrics.bind(lambda account: account.sync(stock_list=stock_lists[account.client_id], df_site=df_site,
+                                                         prices_dd=prices_dd, stock_flag=stock_flag,
+                                                         price_flag=price_flag))
+        results = list(executor.map(sync, accounts))
+    if len(accounts) > 1:
+        for account, (len_list, len_list_p) in zip(accounts, results):
+            logger.info(msg=f"Аккаунт {account.name}: отправлено {len_list} позиций по остаткам и {len_list_p} по ценам")
+    return sum(el[0] for el in results), sum(el[1] for el in results)
+
+
+def runner(prices_dd: dict, accounts: list = None):
     start = time()
+    cycle = metrics.start_cycle(name='runner')
+    try:
+        accounts = accounts if accounts else OzonAccount.from_settings()
 
-    tg = TableGetter(api_token=settings.INVASK_API_TOKEN)
-    product_list = tg.get_stock()
-
-    df_invask = tg.process_table(product_list=product_list)
-    # print(df_invask)
-    oa = OzonApi(client_id=settings.OZON_CLIENT_ID, api_key=settings.OZON_API_KEY, prices_delta_dict=prices_dd)
-    stock_list = oa.get_stock_items()
-
-    batches2send, len_list = oa.process_stock_items(stock_list=stock_list, df_site=df_invask)
-    batches2send_p, len_list_p = oa.process_stock_items(stock_list=stock_list, df_site=df_invask, price_flag=True)
-
-    oa.update_stock(list_send=batches2send, len_list=len_list)
-    oa.update_stock(list_send=batches2send_p, len_list=len_list, price_flag=True)
-
+        tg = TableGetter(api_token=settings.INVASK_API_TOKEN)
+        df_invask = tg.get_table()
 
+        len_list, len_list_p = sync_accounts(accounts=accounts, df_site=df_invask, prices_dd=prices_dd)
+    finally:
+        cycle.finish()
     finish = time()
     delta = finish - start
     logger.info(msg=f"Обновление {len_list} позиций по остаткам склада и {len_list_p} по ценам выполнено за {delta}")
 
 
-def runner_stock():
+def runner_stock(accounts: list = None):
     start = time()
+    cycle = metrics.start_cycle(name='runner_stock')
+    try:
+        accounts = accounts if accounts else OzonAccount.from_settings()
 
-    tg = TableGetter(api_token=settings.INVASK_API_TOKEN)
-    product_list = tg.get_stock()
-
-    df_invask = tg.process_table(product_list=product_list)
-    # print(df_invask)
-    oa = OzonApi(client_id=settings.OZON_CLIENT_ID, api_key=settings.OZON_API_KEY, prices_delta_dict={ })
-    stock_list = oa.get_stock_items()
-
-    batches2send, len_list = oa.process_stock_items(stock_list=stock_list, df_site=df_invask)
-
-    oa.update_stock(list_send=batches2send, len_list=len_list)
+        tg = TableGetter(api_token=settings.INVASK_API_TOKEN)
+        df_invask = tg.get_table()
 
+        len_list, len_list_p = sync_accounts(accounts=accounts, df_site=df_invask, prices_dd={}, price_flag=False)
+    finally:
+        cycle.finish()
     finish = time()
     delta = finish - start
     logger.info(msg=f"Обновление {len_list} позиций по остаткам склада выполнено за {delta}")
 
 
-def runner_price(prices_dd: dict):
+def runner_price(prices_dd: dict, accounts: list = None):
     start = time()
+    cycle = metrics.start_cycle(name='runner_price')
+    try:
+        accounts = accounts if accounts else OzonAccount.from_settings()
 
-    tg = TableGetter(api_token=settings.INVASK_API_TOKEN)
-    product_list = tg.get_stock()
-
-    df_invask = tg.process_table(product_list=product_list)
-    # print(df_invask)
-    oa = OzonApi(client_id=settings.OZON_CLIENT_ID, api_key=settings.OZON_API_KEY, prices_delta_dict=prices_dd)
-    stock_list = oa.get_stock_items()
-
-    batches2send_p, len_list = oa.process_stock_items(stock_list=stock_list, df_site=df_invask, price_flag=True)
-
-    oa.update_stock(list_send=batches2send_p, len_list=len_list, price_flag=True)
+        tg = TableGetter(api_token=settings.INVASK_API_TOKEN)
+        df_invask = tg.get_table()
 
+        len_list, len_list_p = sync_accounts(accounts=accounts, df_site=df_invask, prices_dd=prices_dd,
+                                             stock_flag=False)
+    finally:
+        cycle.finish()
     finish = time()
     delta = finish - start
-    logger.info(msg=f"Обновление {len_list} позиций ценам выполнено за {delta}")
-
+    logger.info(msg=f"Обновление {len_list_p} позиций ценам выполнено за {delta}")
+
+
+MODES = dict(sync="остатки склада и цены", stock="только остатки склада", prices="только цены")
+MENU = {'1': 'sync', '2': 'stock', '3': 'prices'}
+
+
+def sync_jobs(mode: str, accounts: list) -> list:
+    """(name, function, schedule spec) of every job a mode runs, one job per cadence of the .env"""
+    stock_job = ('остатки', lambda: runner_stock(accounts=accounts), settings.STOCK_SCHEDULE)
+    if mode == 'stock':
+        return [stock_job]
+    pr = PriceReader()
+    price_job = ('цены', lambda: runner_price(prices_dd=pr.get_prices_dict(), accounts=accounts),
+                 settings.PRICE_SCHEDULE)
+    if mode == 'prices':
+        return [price_job]
+    if settings.PRICE_SCHEDULE.strip():
+        # separate cadences, the markup file is re-read only if it was changed since the previous run
+        return [stock_job, price_job]
+    return [('остатки и цены', lambda: runner(prices_dd=pr.get_prices_dict(), accounts=accounts),
+             settings.STOCK_SCHEDULE)]
+
+
+def run_daemon(mode: str, accounts: list) -> None:
+    metrics.serve(port=settings.METRICS_PORT)
+    sch = Scheduler()
+    for name, func, spec in sync_jobs(mode=mode, accounts=accounts):
+        sch.add(name=name, func=func, trigger=make_trigger(spec=spec, period=settings.UPDATE_PERIOD))
+    sch.run_forever()
+
+
+def ask_mode() -> str | None:
+    while True:
+        option = input("Привет! Напишите вариант работы программы и нажмите enter\n\n"
+                       "1. Скрипт обновит остатки склада и цены\n"
+                       "2. Скрипт обновит только остатки склада\n"
+                       "3. Скрипт обновит только цены\n"
+                       "4. Выход\n\n\n"
+                       "Ваш выбор: ").strip()
+        if option == '4':
+            return None
+        if option in MENU:
+            return MENU[option]
+        print("напишите 1 или 2 или 3 или 4 и нажмите enter")
 
-def main_proc():
-    option = input("Привет! Напишите вариант работы программы и нажмите enter\n\n"
-                            "1. Скрипт обновит остатки склада и цены\n"
-                            "2. Скрипт обновит только остатки склада\n"
-                            "3. Скрипт обновит только цены\n"
-                            "4. Выход\n\n\n"
-                            "Ваш выбор: ").strip()
 
-    if option not in ['1', '2', '3', '4']:
-        print("напишите 1 или 2 или 3 или 4 и нажмите enter")
-        main_proc()
-    else:
-        logger.info(msg="Выполняю...")
-        match option:
-            case '1':
-                pr = PriceReader()
-                prices_dd = pr.get_prices_dict()
-                while True:
-                    time_pc = datetime.now()
-                    logger.info(msg=f"{time_pc} - запускаю обработчик")
-                    runner(prices_dd=prices_dd)
-                    logger.info(msg=f"Обработчик запустится через {settings.UPDATE_PERIOD} сек - а пока баиньки")
-                    sleep(settings.UPDATE_PERIOD)
-
-            case '2':
-                # pr = PriceReader()
-                # prices_dd = pr.get_prices_dict()
-
-                while True:
-                    time_pc = datetime.now()
-                    logger.info(msg=f"{time_pc} - запускаю обработчик")
-                    runner_stock()
-                    logger.info(msg=f"Обработчик запустится через {settings.UPDATE_PERIOD} сек - а пока баиньки")
-                    sleep(settings.UPDATE_PERIOD)
-            case '3':
-                pr = PriceReader()
-                prices_dd = pr.get_prices_dict()
-                while True:
-                    time_pc = datetime.now()
-                    logger.info(msg=f"{time_pc} - запускаю обработчик")
-                    runner_price(prices_dd=prices_dd)
-                    logger.info(msg=f"Обработчик запустится через {settings.UPDATE_PERIOD} сек - а пока баиньки")
-                    sleep(settings.UPDATE_PERIOD)
-
-            case '4':
-                s_exit()
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Обновление остатков склада и цен на Ozon. "
+                                                 "Без команды спрашивает вариант работы и запускает расписание")
+    commands = parser.add_subparsers(dest='command', metavar='команда')
+    for mode, text in MODES.items():
+        commands.add_parser(mode, help=f"один запуск: {text}")
+    for command, text in (('once', "каждое задание расписания по одному разу"), ('daemon', "работа по расписанию")):
+        sub = commands.add_parser(command, help=text)
+        sub.add_argument('mode', nargs='?', choices=list(MODES), default='sync',
+                         help="что обновлять, по умолчанию sync")
+    return parser.parse_args(argv)
+
+
+def main_proc(argv: list = None):
+    args = parse_args(argv)
+    command, mode = args.command, getattr(args, 'mode', args.command)
+    if command is None:
+        command, mode = 'daemon', ask_mode()
+        if mode is None:
+            s_exit()
+
+    logger.info(msg="Выполняю...")
+    # pooled ozon sessions, limiters and snapshots for every run of the process
+    accounts = OzonAccount.from_settings()
+    match command:
+        case 'daemon':
+            run_daemon(mode=mode, accounts=accounts)
+        case 'once':
+            for name, func, _ in sync_jobs(mode=mode, accounts=accounts):
+                logger.info(msg=f"{name}: запускаю обработчик")
+                func()
+        case 'sync':
+            runner(prices_dd=PriceReader().get_prices_dict(), accounts=accounts)
+        case 'stock':
+            runner_stock(accounts=accounts)
+        case 'prices':
+            runner_price(prices_dd=PriceReader().get_prices_dict(), accounts=accounts)
 
 
 if __name__ == '__main__':
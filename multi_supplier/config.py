@@ -0,0 +1,27 @@
+from pydantic import BaseSettings
+
+
+class Settings(BaseSettings):
+    # supplier script directories served by the daemon, comma separated, in this order:
+    # invask (repository root), rusklimat, hevesh, sp_armtek, sp_artem, side_proj
+    SUPPLIERS: str = "invask,rusklimat,hevesh,sp_armtek,sp_artem,side_proj"
+    # push prices too for the suppliers that have a markup table (invask, rusklimat)
+    SYNC_PRICES: bool = True
+    # stock of an offer carried by several suppliers of one ozon warehouse:
+    # none - every supplier pushes its own stock as the standalone scripts do,
+    # sum / max - one push of the summed / largest stock,
+    # priority - one push of the stock of the supplier listed first in SUPPLIERS
+    MERGE_STRATEGY: str = "none"
+    # snapshot of the merged pushes, one file per account and warehouse: <name>_<client id>_<warehouse>.json
+    MERGED_SNAPSHOT_PREFIX: str = "sync_snapshot_merged"
+    UPDATE_PERIOD: int
+    # empty - every UPDATE_PERIOD seconds, '10m' / '6h' - fixed rate, or a cron expression like '*/10 * * * *'
+    SCHEDULE: str = ""
+    # local scrape endpoint with the stage metrics of the last cycles, 0 turns it off
+    METRICS_PORT: int = 0
+
+    class Config:
+        env_file = '.env'
+
+
+settings = Settings()
@@ -0,0 +1,444 @@
+"""One daemon for every supplier script of the repository.
+
+The supplier scripts are loaded as they are, each from its own directory with its own config.py and .env,
+so a supplier is configured exactly as for the standalone run. Every cycle the ozon catalog is listed once
+per seller account and handed to all suppliers of that account, then each supplier downloads its table,
+matches it against the catalog and pushes the batches with its own OzonApi.
+With MERGE_STRATEGY the stock of all suppliers of one ozon warehouse is merged first and pushed once.
+Variables set in the process environment apply to every supplier, keep the per supplier settings in the .env files.
+"""
+import filecmp
+import importlib.util
+import logging as logger
+import sys
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime
+from os import chdir, getcwd, listdir, path
+from time import time
+
+import metrics
+from config import settings
+from scheduler import EveryTrigger, Scheduler, make_trigger, parse_clock
+logger.basicConfig(level=logger.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+DAEMON_DIR = path.dirname(path.abspath(__file__))
+ROOT_DIR = path.dirname(DAEMON_DIR)
+# every script has its own settings, its other modules are copies of the daemon's ones where the daemon has them
+OWN_MODULES = ('config', 'main')
+# file settings of the scripts, made absolute against the script directory when it is loaded
+PATH_SETTINGS = ('SNAPSHOT_FILE', 'OZON_CATALOG_CACHE', 'OZON_FAILURE_LOG', 'PRICE_TABLE', 'EXCEL_FILE',
+                 'INVASK_CACHE_FILE', 'ARMAVIR_CACHE_FILE')
+MERGE_STRATEGIES = ('sum', 'max', 'priority')
+
+
+@contextmanager
+def script_dir(directory: str):
+    """Working directory of a supplier script while it is imported, its config reads .env from there"""
+    cwd = getcwd()
+    chdir(directory)
+    try:
+        yield
+    finally:
+        chdir(cwd)
+
+
+def shared_module(key: str, directory: str) -> bool:
+    """A module of the script directory is shared only if the daemon has the same file, metrics for one,
+    so the stages of every supplier end up in the daemon's report"""
+    if key in OWN_MODULES:
+        return False
+    module = sys.modules.get(key)
+    own_file = getattr(module, '__file__', None)
+    if not own_file or path.dirname(path.abspath(own_file)) != DAEMON_DIR:
+        return False
+    if filecmp.cmp(own_file, path.join(directory, f"{key}.py"), shallow=False):
+        return True
+    logger.warning(msg=f"{key}.py в {directory} отличается от копии демона, поставщик получит свою")
+    return False
+
+
+def load_script(name: str, directory: str):
+    """Imports main.py of a supplier directory under its own name. Every module of that directory (config,
+    prices_reader, batching, json_stream...) is imported from it and kept private to the script, another
+    supplier never gets this copy and the daemon's modules are put back after the load.
+    The scripts are loaded before the daemon starts any thread, the working directory is changed only for the import
+    and the relative file names of the settings are made absolute, nothing depends on it afterwards"""
+    private = [el[:-3] for el in sorted(listdir(directory))
+               if el.endswith('.py') and not shared_module(key=el[:-3], directory=directory)]
+    saved = {key: sys.modules.pop(key) for key in private if key in sys.modules}
+    sys.path.insert(0, directory)
+    try:
+        with script_dir(directory):
+            resolve_paths(settings=importlib.import_module('config').settings, directory=directory)
+            spec = importlib.util.spec_from_file_location(f"{name}_main", path.join(directory, 'main.py'))
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+        for key in private:
+            sys.modules.pop(key, None)
+        sys.modules.update(saved)
+    return module
+
+
+def resolve_paths(settings, directory: str) -> None:
+    for key in PATH_SETTINGS:
+        value = getattr(settings, key, None)
+        if value and not path.isabs(value):
+            setattr(settings, key, path.join(directory, value))
+
+
+class SupplierAdapter(ABC):
+    """A supplier script loaded into the daemon. Subclasses only know how to get the supplier table,
+    matching and upload are done by the OzonApi of the script itself"""
+    directory = ''
+    with_prices = False
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.directory = path.join(ROOT_DIR, self.directory)
+        self.module = load_script(name=name, directory=self.directory)
+        self.settings = self.module.settings
+        self.account = str(self.settings.OZON_CLIENT_ID)
+        self.warehouse = str(self.settings.OZON_WAREHOUSE_ID)
+        self.snapshot = self.module.SyncSnapshot(filename=self.settings.SNAPSHOT_FILE,
+                                                   full_sync_every=self.settings.FULL_SYNC_EVERY)
+        self.price_reader = self.module.PriceReader() if self.with_prices and settings.SYNC_PRICES else None
+        # (stock values, price records) of the last table that made it into a merged push
+        self.last_merged = None
+
+    def active(self) -> bool:
+        """False outside the working hours of the supplier, the daemon then leaves it out of the cycle"""
+        return True
+
+    def ozon_api(self, session=None, prices_dd: dict = None, snapshot=None):
+        return self.module.OzonApi(client_id=self.settings.OZON_CLIENT_ID, api_key=self.settings.OZON_API_KEY,
+                                   prices_delta_dict=prices_dd or {}, session=session,
+                                   snapshot=snapshot or self.snapshot)
+
+    def make_session(self):
+        return self.module.OzonApi.make_session(client_id=self.settings.OZON_CLIENT_ID,
+                                                api_key=self.settings.OZON_API_KEY)
+
+    @abstractmethod
+    def fetch(self):
+        """Supplier table in the form the OzonApi of the script matches"""
+
+    def stock_values(self, oa, table) -> dict:
+        """offer_id -> stock as a number, the form the merge works on"""
+        return oa.site_lookup(df_site=table, column='stocks')
+
+    def price_records(self, oa, stock_list: list, table) -> list:
+        if not self.price_reader:
+            return []
+        _, price_quants = oa.match_items(stock_list=stock_list, df_site=table, stock_flag=False)
+        return price_quants
+
+    def match(self, oa, stock_list: list, table) -> tuple:
+        """(stock batches, stock count, price batches, price count)"""
+        if self.price_reader:
+            return oa.process_all_items(stock_list=stock_list, df_site=table)
+        batches2send, len_list = oa.process_stock_items(stock_list=stock_list, df_site=table)
+        return batches2send, len_list, [], 0
+
+    def sync(self, stock_list: list, session) -> None:
+        cycle = metrics.start_cycle(name=self.name)
+        try:
+            self.snapshot.start_cycle(kinds=('stocks', 'prices') if self.price_reader else ('stocks',))
+            prices_dd = self.price_reader.get_prices_dict() if self.price_reader else {}
+
+            table = self.fetch()
+
+            oa = self.ozon_api(session=session, prices_dd=prices_dd)
+            with metrics.stage('matching') as st:
+                batches2send, len_list, batches2send_p, len_list_p = self.match(oa=oa, stock_list=stock_list,
+                                                                                table=table)
+                st.rows = len(stock_list)
+
+            oa.update_stock(list_send=batches2send, len_list=len_list)
+            if self.price_reader:
+                oa.update_stock(list_send=batches2send_p, len_list=len_list_p, price_flag=True)
+
+            self.snapshot.save()
+        finally:
+            cycle.finish()
+        logger.info(msg=f"{self.name}: обновлено {len_list} позиций по остаткам склада и {len_list_p} по ценам")
+
+
+class InvaskAdapter(SupplierAdapter):
+    directory = ''
+    with_prices = True
+
+    def fetch(self):
+        return self.module.TableGetter(api_token=self.settings.INVASK_API_TOKEN).get_table()
+
+
+class RusklimatAdapter(SupplierAdapter):
+    directory = 'rusklimat'
+    with_prices = True
+
+    def fetch(self):
+        table_getter = self.module.TableGetter
+        with metrics.stage('supplier_fetch') as st:
+            jwt = table_getter.jwt_requester()
+            table_list = table_getter.table_requester(jwt=jwt)
+            st.rows = len(table_list)
+        with metrics.stage('supplier_normalize') as st:
+            df_site = table_getter.process_table(product_list=table_list)
+            st.rows = len(df_site)
+        return df_site
+
+
+class ArmavirAdapter(SupplierAdapter):
+    def fetch(self):
+        return self.module.TableGetter.get_table()
+
+
+class SpArmtekAdapter(ArmavirAdapter):
+    directory = 'sp_armtek'
+
+
+class SpArtemAdapter(ArmavirAdapter):
+    directory = 'sp_artem'
+
+
+class SideProjAdapter(ArmavirAdapter):
+    directory = 'side_proj'
+
+
+class ExcelAdapter(SupplierAdapter):
+    """hevesh pushes only inside its START_TIME - STOP_TIME window, as the standalone script does.
+    In a merged push its workbook is read at any time, the window then only keeps it from pushing alone"""
+    directory = 'hevesh'
+
+    def __init__(self, name: str) -> None:
+        super().__init__(name=name)
+        self.window = EveryTrigger(period=self.settings.UPDATE_PERIOD,
+                                   window=(parse_clock(self.settings.START_TIME), parse_clock(self.settings.STOP_TIME)))
+
+    def active(self) -> bool:
+        return self.window.in_window(datetime.now())
+
+    def fetch(self):
+        with metrics.stage('supplier_fetch') as st:
+            site_values = self.module.TableGetter.table_from_excel()
+            st.rows = len(site_values)
+        return site_values
+
+    def stock_values(self, oa, table) -> dict:
+        return stock_numbers(table)
+
+    def match(self, oa, stock_list: list, table) -> tuple:
+        batches2send, len_list = oa.process_stock_items(stock_list=stock_list, site_values=table)
+        return batches2send, len_list, [], 0
+
+
+ADAPTERS = dict(
+    invask=InvaskAdapter,
+    rusklimat=RusklimatAdapter,
+    hevesh=ExcelAdapter,
+    sp_armtek=SpArmtekAdapter,
+    sp_artem=SpArtemAdapter,
+    side_proj=SideProjAdapter,
+)
+
+
+def stock_numbers(values: dict) -> dict:
+    """Stock values of the excel suppliers are workbook cells, cells that are not a number are left out"""
+    res = {}
+    for offer_id, value in values.items():
+        try:
+            res[str(offer_id)] = int(float(value))
+        except (TypeError, ValueError):
+            continue
+    return res
+
+
+def merge_stocks(tables: list, strategy: str) -> dict:
+    """One stock per offer from the supplier tables, `tables` are in the priority order"""
+    merged = {}
+    for table in tables:
+        for offer_id, stock in table.items():
+            if offer_id not in merged:
+                merged[offer_id] = stock
+            elif strategy == 'sum':
+                merged[offer_id] += stock
+            elif strategy == 'max':
+                merged[offer_id] = max(merged[offer_id], stock)
+            # priority: the first supplier that has the offer keeps it
+    return merged
+
+
+def make_adapters(names: str) -> list:
+    adapters = []
+    for name in filter(None, map(str.strip, names.split(','))):
+        if name not in ADAPTERS:
+            logger.warning(msg=f"Неизвестный поставщик {name}, доступны: {', '.join(ADAPTERS)}")
+            continue
+        try:
+            adapters.append(ADAPTERS[name](name=name))
+        except Exception as e:
+            # usually an incomplete .env of that supplier
+            logger.warning(msg=f"Поставщик {name} не загружен {e!r}")
+    return adapters
+
+
+def fetch_catalogs(adapters: list, sessions: dict) -> dict:
+    """One ozon catalog per seller account, listed with the first supplier of that account"""
+    catalogs = {}
+    cycle = metrics.start_cycle(name='ozon_catalog')
+    try:
+        for adapter in adapters:
+            if adapter.account in catalogs:
+                continue
+            with metrics.stage(f"ozon_catalog_{adapter.account}") as st:
+                try:
+                    catalogs[adapter.account] = adapter.ozon_api(session=sessions[adapter.account]).get_stock_items()
+                except (Exception, SystemExit) as e:
+                    logger.warning(msg=f"Каталог озон аккаунта {adapter.account} не получен {e!r}")
+                    catalogs[adapter.account] = None
+                    continue
+                st.rows = len(catalogs[adapter.account])
+    finally:
+        cycle.finish()
+    return catalogs
+
+
+def merged_group(adapters: list, stock_list: list, session, snapshot) -> None:
+    """Suppliers of one ozon warehouse: tables are merged and pushed as one set of batches.
+    Prices are not summed, an offer gets the price of the first supplier in SUPPLIERS that prices it.
+    A supplier whose table could not be fetched takes part with its last good one, without one the warehouse
+    is not pushed this cycle: a sum or max over the other suppliers only would lower the stock on ozon"""
+    primary = adapters[0]
+    cycle = metrics.start_cycle(name=f"merged_{primary.account}_{primary.warehouse}")
+    try:
+        tables, price_quants, seen_prices = [], [], set()
+        for adapter in adapters:
+            try:
+                prices_dd = adapter.price_reader.get_prices_dict() if adapter.price_reader else {}
+                table = adapter.fetch()
+                oa = adapter.ozon_api(session=session, prices_dd=prices_dd)
+                adapter.last_merged = (adapter.stock_values(oa=oa, table=table),
+                                       adapter.price_records(oa=oa, stock_list=stock_list, table=table))
+            except (Exception, SystemExit) as e:
+                if adapter.last_merged is None:
+                    logger.warning(msg=f"{adapter.name}: таблица не получена, прошлой нет. Склад {primary.warehouse} "
+                                       f"аккаунта {primary.account} в этом цикле не обновляется {e!r}")
+                    return
+                logger.warning(msg=f"{adapter.name}: таблица не получена, в объединение вошла прошлая {e!r}")
+            stock_values, price_records = adapter.last_merged
+            tables.append(stock_values)
+            for el in price_records:
+                if el['offer_id'] not in seen_prices:
+                    seen_prices.add(el['offer_id'])
+                    price_quants.append(el)
+
+        # the price cycles are counted only for a group that pushes prices, like the standalone scripts do
+        with_prices = any(adapter.price_reader for adapter in adapters)
+        snapshot.start_cycle(kinds=('stocks', 'prices') if with_prices else ('stocks',))
+        with metrics.stage('merge') as st:
+            merged = merge_stocks(tables=tables, strategy=settings.MERGE_STRATEGY)
+            stock_quants = [dict(offer_id=el['offer_id'],
+                                 product_id=el['product_id'],
+                                 stock=merged[el['offer_id']],
+                                 warehouse_id=primary.settings.OZON_WAREHOUSE_ID)
+                            for el in stock_list if el['offer_id'] in merged]
+            st.rows = sum(map(len, tables))
+
+        oa = primary.ozon_api(session=session, snapshot=snapshot)
+        stock_quants = snapshot.changed(kind='stocks', records=stock_quants)
+        oa.update_stock(list_send=oa.batchers['stocks'].batches(records=stock_quants), len_list=len(stock_quants))
+        price_quants = snapshot.changed(kind='prices', records=price_quants)
+        if price_quants:
+            oa.update_stock(list_send=oa.batchers['prices'].batches(records=price_quants),
+                            len_list=len(price_quants), price_flag=True)
+
+        snapshot.save()
+    finally:
+        cycle.finish()
+    logger.info(msg=f"Объединено {len(tables)} поставщиков ({settings.MERGE_STRATEGY}): обновлено {len(stock_quants)} "
+                    f"позиций по остаткам склада и {len(price_quants)} по ценам")
+
+
+def merged_snapshots(adapters: list) -> dict:
+    snapshots = {}
+    for adapter in adapters:
+        key = (adapter.account, adapter.warehouse)
+        if key not in snapshots:
+            filename = path.abspath(f"{settings.MERGED_SNAPSHOT_PREFIX}_{adapter.account}_{adapter.warehouse}.json")
+            snapshots[key] = adapter.module.SyncSnapshot(filename=filename,
+                                                         full_sync_every=adapter.settings.FULL_SYNC_EVERY)
+    return snapshots
+
+
+def runner_merged(adapters: list, sessions: dict, snapshots: dict) -> None:
+    start = time()
+    catalogs = fetch_catalogs(adapters=adapters, sessions=sessions)
+
+    groups = {}
+    for adapter in adapters:
+        if catalogs[adapter.account] is not None:
+            groups.setdefault((adapter.account, adapter.warehouse), []).append(adapter)
+    for (account, warehouse), group in groups.items():
+        try:
+            merged_group(adapters=group, stock_list=catalogs[account], session=sessions[account],
+                         snapshot=snapshots[(account, warehouse)])
+        except (Exception, SystemExit) as e:
+            logger.warning(msg=f"Склад {warehouse} аккаунта {account}: обработка прервана {e!r}")
+
+    finish = time()
+    delta = finish - start
+    logger.info(msg=f"Обработка {len(adapters)} поставщиков выполнена за {delta}")
+
+
+def runner(adapters: list, sessions: dict) -> None:
+    start = time()
+    catalogs = fetch_catalogs(adapters=adapters, sessions=sessions)
+
+    for adapter in adapters:
+        if catalogs[adapter.account] is None:
+            continue
+        if not adapter.active():
+            logger.info(msg=f"{adapter.name}: вне времени работы, пропускаю")
+            continue
+        try:
+            adapter.sync(stock_list=catalogs[adapter.account], session=sessions[adapter.account])
+        except (Exception, SystemExit) as e:
+            # a failed download raises, a missing markup table still exits, neither may stop the other suppliers
+            logger.warning(msg=f"{adapter.name}: обработка прервана {e!r}")
+
+    finish = time()
+    delta = finish - start
+    logger.info(msg=f"Обработка {len(adapters)} поставщиков выполнена за {delta}")
+
+
+def main_proc():
+    adapters = make_adapters(names=settings.SUPPLIERS)
+    if not adapters:
+        logger.warning(msg="Не задан ни один поставщик")
+        return
+    # one pooled ozon session per seller account for the whole life of the daemon
+    sessions = {}
+    for adapter in adapters:
+        if adapter.account not in sessions:
+            sessions[adapter.account] = adapter.make_session()
+    merge = settings.MERGE_STRATEGY != 'none'
+    if merge and settings.MERGE_STRATEGY not in MERGE_STRATEGIES:
+        logger.warning(msg=f"MERGE_STRATEGY должен быть одним из: none, {', '.join(MERGE_STRATEGIES)}")
+        return
+    snapshots = merged_snapshots(adapters=adapters) if merge else None
+    metrics.serve(port=settings.METRICS_PORT)
+
+    sch = Scheduler()
+    trigger = make_trigger(spec=settings.SCHEDULE, period=settings.UPDATE_PERIOD)
+    if merge:
+        sch.add(name='все поставщики', func=lambda: runner_merged(adapters=adapters, sessions=sessions,
+                                                                  snapshots=snapshots), trigger=trigger)
+    else:
+        sch.add(name='все поставщики', func=lambda: runner(adapters=adapters, sessions=sessions), trigger=trigger)
+    sch.run_forever()
+
+
+if __name__ == '__main__':
+    main_proc()
@@ -0,0 +1,177 @@
+"""Job scheduler for the sync daemons.
+
+    sch = Scheduler()
+    sch.add(name='остатки', func=run_stock, trigger=make_trigger(spec='10m', period=600))
+    sch.add(name='цены', func=run_prices, trigger=make_trigger(spec='0 */6 * * *', period=600))
+    sch.run_forever()
+
+Fixed-rate triggers count the period from the planned start of the previous run, not from its end, so the
+run time does not make the schedule drift. Jobs run one at a time: a job that became due while another one
+was running starts right after it, once, and every other slot it missed is skipped instead of piling up.
+A run that raised is logged and the job keeps its schedule.
+Schedule specs: empty - every `period` seconds, '90', '10m', '6h', '1d' - fixed rate, five fields - cron
+expression (minute hour day month weekday, with *, lists, ranges and steps, weekday 0 or 7 is sunday).
+"""
+import logging as logger
+from datetime import datetime, time as dtime, timedelta
+from time import sleep
+
+UNITS = dict(s=1, m=60, h=3600, d=86400)
+
+
+def parse_clock(value: str) -> dtime:
+    return datetime.strptime(value.strip(), '%H:%M').time()
+
+
+class EveryTrigger:
+    """Every `period` seconds, optionally only inside a daily [start, stop) window, the window may span midnight"""
+    def __init__(self, period: float, window: tuple = None) -> None:
+        if period <= 0:
+            raise ValueError(f"period must be positive, got {period}")
+        self.period = timedelta(seconds=period)
+        self.window = window
+
+    def in_window(self, moment: datetime) -> bool:
+        if not self.window:
+            return True
+        start, stop = self.window
+        clock = moment.time()
+        if start <= stop:
+            return start <= clock < stop
+        return clock >= start or clock < stop
+
+    def window_start(self, moment: datetime) -> datetime:
+        """The next opening of the window after `moment`"""
+        candidate = datetime.combine(moment.date(), self.window[0])
+        return candidate if candidate > moment else candidate + timedelta(days=1)
+
+    def first_run(self, now: datetime) -> datetime:
+        return now if self.in_window(now) else self.window_start(now)
+
+    def next_run(self, after: datetime) -> datetime:
+        candidate = after + self.period
+        return candidate if self.in_window(candidate) else self.window_start(candidate)
+
+
+class CronTrigger:
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str) -> None:
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron expression needs 5 fields, got {expression!r}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            CronTrigger.parse_field(field=field, low=low, high=high) for field, (low, high) in zip(fields, self.RANGES))
+        self.weekdays = {el % 7 for el in weekdays}
+        # as in cron: with both day and weekday restricted a day matching either of them will do
+        self.any_day = fields[2] != '*' and fields[4] != '*'
+
+    @staticmethod
+    def parse_field(field: str, low: int, high: int) -> set:
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                first, last = low, high
+            elif '-' in part:
+                first, last = map(int, part.split('-'))
+            else:
+                first = int(part)
+                last = high if step > 1 else first
+            if not low <= first <= last <= high or step < 1:
+                raise ValueError(f"cron field {field!r} is out of {low}-{high}")
+            values.update(range(first, last + 1, step))
+        return values
+
+    def day_matches(self, moment: datetime) -> bool:
+        # cron weekdays start with sunday = 0, python ones with monday = 0
+        by_day = moment.day in self.days
+        by_weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        return by_day or by_weekday if self.any_day else by_day and by_weekday
+
+    def first_run(self, now: datetime) -> datetime:
+        return self.next_run(after=now)
+
+    def next_run(self, after: datetime) -> datetime:
+        moment = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 4)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self.day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"cron expression {self.expression!r} never fires")
+
+
+def make_trigger(spec: str, period: float, window: tuple = None):
+    """Trigger from a schedule spec of the .env, see the module docstring"""
+    spec = spec.strip()
+    if not spec:
+        return EveryTrigger(period=period, window=window)
+    if len(spec.split()) == 5:
+        return CronTrigger(expression=spec)
+    unit = UNITS.get(spec[-1].lower())
+    if unit:
+        return EveryTrigger(period=float(spec[:-1]) * unit, window=window)
+    return EveryTrigger(period=float(spec), window=window)
+
+
+class Job:
+    def __init__(self, name: str, func, trigger) -> None:
+        self.name = name
+        self.func = func
+        self.trigger = trigger
+        self.next_run = trigger.first_run(now=datetime.now())
+
+
+class Scheduler:
+    def __init__(self) -> None:
+        self.jobs = []
+
+    def add(self, name: str, func, trigger) -> Job:
+        job = Job(name=name, func=func, trigger=trigger)
+        self.jobs.append(job)
+        logger.info(msg=f"{name}: первый запуск {job.next_run:%Y-%m-%d %H:%M:%S}")
+        return job
+
+    def run_pending(self) -> float:
+        """Runs the job that is due first if its time has come, returns the seconds to wait for the next one"""
+        job = min(self.jobs, key=lambda el: el.next_run)
+        delay = (job.next_run - datetime.now()).total_seconds()
+        if delay > 0:
+            return delay
+
+        planned = job.next_run
+        logger.info(msg=f"{datetime.now()} - {job.name}: запускаю обработчик")
+        try:
+            job.func()
+        except Exception as e:
+            # a failed run must not stop the daemon, the job runs again in its next slot
+            logger.exception(msg=f"{job.name}: обработка прервана {e!r}")
+
+        now = datetime.now()
+        job.next_run = job.trigger.next_run(after=planned)
+        skipped = 0
+        while job.next_run <= now:
+            job.next_run = job.trigger.next_run(after=job.next_run)
+            skipped += 1
+        if skipped:
+            logger.warning(msg=f"{job.name}: обработка шла дольше периода, пропущено запусков: {skipped}")
+        logger.info(msg=f"{job.name}: следующий запуск {job.next_run:%Y-%m-%d %H:%M:%S}")
+        return 0
+
+    def run_forever(self) -> None:
+        while True:
+            delay = self.run_pending()
+            if delay > 0:
+                sleep(delay)
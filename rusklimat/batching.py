@@ -0,0 +1,70 @@
+"""Update batches sized by how the marketplace api answers.
+
+    batcher = batching.shared(key=(client_id, 'stocks'), maximum=100, slow=5)
+    for batch in batcher.batches(records=records):
+        response = s.post(url=url, json=dict(stocks=batch))
+        batcher.record(size=len(batch), status=response.status_code, seconds=response.elapsed.total_seconds())
+
+A batcher starts at the documented maximum of its endpoint and changes the size the way tcp changes its window:
+an overloaded answer (429, 413, 5xx or a timeout) halves it, an answer slower than `slow` seconds takes a quarter
+off and a quick healthy one adds a tenth of the maximum back. An answer only shrinks the size if its batch was cut
+at the current size or below, so the batches that were in flight when the first 429 came do not halve it again.
+Batches are cut lazily, the size learned from the answers so far applies to the next batch taken. `shared`
+keeps one batcher per key for the life of the process, the sizes carry over from cycle to cycle.
+"""
+from threading import Lock
+
+import metrics
+
+BATCHERS = {}
+BATCHERS_LOCK = Lock()
+
+
+class AdaptiveBatcher:
+    def __init__(self, maximum: int, slow: float, minimum: int = 1) -> None:
+        if maximum < 1:
+            raise ValueError(f"maximum must be positive, got {maximum}")
+        self.maximum = maximum
+        self.minimum = min(max(minimum, 1), maximum)
+        self.slow = slow
+        self.step = max(maximum // 10, 1)
+        self.size = maximum
+        self.lock = Lock()
+
+    def batches(self, records: list):
+        """Slices of `records`, each as long as the size is when it is taken. Sizes go to the running stage"""
+        start = 0
+        while start < len(records):
+            with self.lock:
+                size = self.size
+            batch = records[start:start + size]
+            start += size
+            metrics.batch(size=len(batch))
+            yield batch
+
+    def record(self, size: int, status: int, seconds: float) -> None:
+        """Answer to a batch of `size` items"""
+        with self.lock:
+            if status in (413, 429) or status >= 500:
+                self.shrink(size=size, factor=0.5)
+            elif seconds > self.slow:
+                self.shrink(size=size, factor=0.75)
+            elif status < 400:
+                self.size = min(self.size + self.step, self.maximum)
+
+    def timed_out(self, size: int) -> None:
+        with self.lock:
+            self.shrink(size=size, factor=0.5)
+
+    def shrink(self, size: int, factor: float) -> None:
+        if size <= self.size:
+            self.size = max(int(size * factor), self.minimum)
+
+
+def shared(key: tuple, maximum: int, slow: float) -> AdaptiveBatcher:
+    """Batcher of the key, (seller account, method) for example, made on first use"""
+    with BATCHERS_LOCK:
+        batcher = BATCHERS.get(key)
+        if batcher is None:
+            batcher = BATCHERS[key] = AdaptiveBatcher(maximum=maximum, slow=slow)
+        return batcher
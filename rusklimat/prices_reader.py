@@ -1,8 +1,15 @@
+from __future__ import annotations
+
 import logging as logger
-from openpyxl import load_workbook
+from hashlib import md5
+from os import stat
 from sys import exit as s_exit
 from time import sleep
 from config import settings
+from lazy_import import LazyModule
+
+np = LazyModule('numpy')
+openpyxl = LazyModule('openpyxl')
 
 
 logger.basicConfig(level=logger.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -18,38 +25,85 @@ class PriceReader:
         self.dc = delivery_col
         self.start_rows = start_rows
         self.filename = filename
+        self.prices_dict = None
+        self.signature = None
+        self.digest = None
 
     def get_prices_dict(self) -> dict:
+        """Markup rules by article. The workbook is read again only when its mtime or size changed
+        and its content hash differs from the loaded one, so it can be called every cycle"""
         try:
-            dataframe = load_workbook(filename=self.filename).active
-        except:
-            logger.warning(msg=f"В папке должен находиться файл с настройками для цен {settings.TABLE_NAME}."
+            stat_result = stat(self.filename)
+            signature = (stat_result.st_mtime_ns, stat_result.st_size)
+            if self.prices_dict is not None and signature == self.signature:
+                return self.prices_dict
+            digest = self.file_digest()
+            if self.prices_dict is not None and digest == self.digest:
+                self.signature = signature
+                return self.prices_dict
+            prices_dict = self.load_prices()
+        except Exception as e:
+            if self.prices_dict is not None:
+                logger.warning(msg=f"Не удалось перечитать файл с настройками для цен {self.filename}: {e}. "
+                                   f"Продолжаю с загруженными ранее")
+                return self.prices_dict
+            logger.warning(msg=f"В папке должен находиться файл с настройками для цен {self.filename}."
                                f"Отключаюсь")
             sleep(4)
             s_exit()
-        # Define variable to read sheet
-        # dataframe1 = dataframe.active
-
-        # Iterate the loop to read the cell values
-        # print(dataframe["B1"].value, dataframe["D1"].value)
-        prices_dict = {}
-        for row in range(self.start_rows, dataframe.max_row+1):
-            prices_dict[dataframe[f"{self.ac}{row}"].value] = (round(float(dataframe[f"{self.pc}{row}"].value), 4), round(float(dataframe[f"{self.dc}{row}"].value), 4))
-            # for col in f"{self.ac}{self.pc}":
-            #     print(dataframe[f"{col}{row}"].value)
-        # print(prices_dict['442511'])
 
+        if self.prices_dict is not None:
+            logger.info(msg=f"Файл с настройками для цен {self.filename} изменился, загружено {len(prices_dict)} позиций")
+        self.prices_dict = prices_dict
+        self.signature = signature
+        self.digest = digest
+        return self.prices_dict
+
+    def file_digest(self) -> str:
+        digest = md5()
+        with open(self.filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def load_prices(self) -> dict:
+        """Streams the sheet in read-only mode and takes the three rule columns of every row"""
+        workbook = openpyxl.load_workbook(filename=self.filename, read_only=True)
+        try:
+            ac = openpyxl.utils.column_index_from_string(self.ac)
+            pc = openpyxl.utils.column_index_from_string(self.pc)
+            dc = openpyxl.utils.column_index_from_string(self.dc)
+            first_col = min(ac, pc, dc)
+
+            prices_dict = {}
+            for row in workbook.active.iter_rows(min_row=self.start_rows, min_col=first_col, max_col=max(ac, pc, dc),
+                                                 values_only=True):
+                if row[ac - first_col] is None:
+                    # trailing empty rows of the sheet
+                    continue
+                prices_dict[str(row[ac - first_col])] = (round(float(row[pc - first_col]), 4), round(float(row[dc - first_col]), 4))
+        finally:
+            workbook.close()
         return prices_dict
 
     @staticmethod
-    def price_process(price: float, prices_tuple: tuple[float, int]) -> None|str:
+    def price_process(price: float, prices_tuple: tuple[float, int]) -> None | str:
         if prices_tuple and len(prices_tuple) == 2:
-            return str(round(price*((100+prices_tuple[0])/100) + prices_tuple[1]))
+            return str(round(price * ((100 + prices_tuple[0]) / 100) + prices_tuple[1]))
         else:
             return None
 
+    @staticmethod
+    def price_process_batch(prices: np.ndarray, markups: np.ndarray, deliveries: np.ndarray) -> np.ndarray:
+        """price_process for whole columns at once: markup percent, delivery and rounding in one vectorized
+        operation. Same formula and the same round half to even as round(), so the results match price_process"""
+        prices = np.asarray(prices, dtype=np.float64)
+        markups = np.asarray(markups, dtype=np.float64)
+        deliveries = np.asarray(deliveries, dtype=np.float64)
+        return np.round(prices * ((100 + markups) / 100) + deliveries).astype(np.int64)
+
 
 if __name__ == '__main__':
     pr = PriceReader()
     prices_dict = pr.get_prices_dict()
-    print(PriceReader.price_process(price=135.54646, prices_tuple=prices_dict.get('НС-1155801')))
\ No newline at end of file
+    print(PriceReader.price_process(price=100, prices_tuple=prices_dict.get('452001')))
@@ -0,0 +1,118 @@
+"""Cache of the last supplier download: the http validators, a hash of the body and the table parsed from it.
+
+    cache = DownloadCache(filename='armavir_cache.pickle', name='Armavir', dump=..., restore=...)
+    with session.get(url, headers=cache.request_headers(), stream=True) as response:
+        table = cache.table_from(response=response, parse=parse_chunks)
+
+A 304 answer or a body with the same hash as the previous one hands back the stored table and nothing is parsed.
+Feeds without validators (paginated apis) are compared by `digest_of` their pages and `unchanged` / `store`.
+The table stays in memory for the next cycle and is pickled to `filename` for the next start ('' - memory only),
+`dump` turns it into plain data for that and `restore` back, so the file does not depend on the module that made it.
+"""
+import logging as logger
+import pickle
+from hashlib import md5
+from os import replace
+from tempfile import SpooledTemporaryFile
+
+CHUNK_SIZE = 1 << 16
+# bodies up to this size are hashed and parsed in memory, larger ones go through a temporary file
+SPOOL_SIZE = 1 << 23
+
+
+class DownloadCache:
+    def __init__(self, filename: str = '', name: str = '', dump=None, restore=None) -> None:
+        self.filename = filename
+        self.name = name
+        self.dump = dump
+        self.restore = restore
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+        self.table = None
+        self.load()
+
+    def load(self) -> None:
+        if not self.filename:
+            return
+        try:
+            with open(self.filename, 'rb') as f:
+                state = pickle.load(f)
+            table = state['table']
+            self.table = self.restore(table) if self.restore else table
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            # an old or broken file only costs one full download
+            logger.warning(msg=f"Кэш загрузки {self.filename} не прочитан: {e!r}")
+            return
+        self.etag = state.get('etag')
+        self.last_modified = state.get('last_modified')
+        self.digest = state.get('digest')
+
+    def save(self) -> None:
+        if not self.filename:
+            return
+        state = dict(etag=self.etag, last_modified=self.last_modified, digest=self.digest,
+                     table=self.dump(self.table) if self.dump else self.table)
+        with open(f"{self.filename}.tmp", 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        replace(f"{self.filename}.tmp", self.filename)
+
+    def request_headers(self) -> dict:
+        """Conditional request headers, none while there is no table to fall back on"""
+        headers = {}
+        if self.table is None:
+            return headers
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def unchanged(self, digest: str) -> bool:
+        if self.table is None or digest != self.digest:
+            return False
+        logger.info(msg=f"{self.name}: данные не изменились с прошлой загрузки, таблица взята из кэша")
+        return True
+
+    @staticmethod
+    def validators(response) -> tuple:
+        if response is None:
+            return None, None
+        return response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+    def store(self, table, digest: str, response=None) -> None:
+        self.table = table
+        self.digest = digest
+        self.etag, self.last_modified = DownloadCache.validators(response=response)
+        self.save()
+
+    def table_from(self, response, parse):
+        """Table of a 200 or 304 answer to `request_headers`, `parse` gets the body as an iterable of byte chunks"""
+        if response.status_code == 304 and self.table is not None:
+            logger.info(msg=f"{self.name}: сервер ответил 304, таблица взята из кэша")
+            return self.table
+
+        digest = md5()
+        # the whole body is hashed before parsing, so an unchanged one is never parsed
+        with SpooledTemporaryFile(max_size=SPOOL_SIZE) as body:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                digest.update(chunk)
+                body.write(chunk)
+            if self.unchanged(digest=digest.hexdigest()):
+                if DownloadCache.validators(response=response) != (self.etag, self.last_modified):
+                    # new validators for the same body, remembered for the next conditional request
+                    self.store(table=self.table, digest=self.digest, response=response)
+                return self.table
+            body.seek(0)
+            table = parse(iter(lambda: body.read(CHUNK_SIZE), b''))
+        self.store(table=table, digest=digest.hexdigest(), response=response)
+        return table
+
+    @staticmethod
+    def digest_of(chunks) -> str:
+        digest = md5()
+        for chunk in chunks:
+            digest.update(chunk)
+        return digest.hexdigest()
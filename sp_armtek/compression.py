@@ -0,0 +1,30 @@
+"""Compressed bodies for the marketplace apis.
+
+    s.headers.update({'Accept-Encoding': compression.ACCEPT_ENCODING})
+    body, headers = compression.json_body(payload=payload, min_size=settings.OZON_GZIP_MIN_SIZE)
+    response = s.post(url=url, data=body, headers=headers)
+
+Answers are decompressed by requests itself, `metrics.observe` counts what the compression saved on them.
+Request bodies are gzipped only when asked to, an api that does not take Content-Encoding: gzip answers 400
+or, worse, reads the bytes as they are, so turn it on per api after checking it.
+"""
+import gzip
+import json
+
+import metrics
+
+ACCEPT_ENCODING = 'gzip, deflate'
+# level 6 keeps almost all of the gain of 9 on json at a fraction of its cpu time
+LEVEL = 6
+
+
+def json_body(payload, min_size: int = 0) -> tuple[bytes, dict]:
+    """Compact utf-8 json of the payload and its headers, gzipped if `min_size` is set and the json is that long"""
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':'), allow_nan=False).encode()
+    headers = {'Content-Type': 'application/json'}
+    if min_size and len(body) >= min_size:
+        compressed = gzip.compress(body, compresslevel=LEVEL)
+        metrics.add(bytes_saved=len(body) - len(compressed))
+        body = compressed
+        headers['Content-Encoding'] = 'gzip'
+    return body, headers
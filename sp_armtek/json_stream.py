@@ -0,0 +1,60 @@
+"""Incremental parser of a json array that arrives in chunks, elements are handed out one by one.
+
+    for row in iter_array(response.iter_content(chunk_size=1 << 16)):
+        ...
+
+Only the element being parsed and the unparsed tail of the last chunk are kept, not the whole document, so memory
+does not grow with the length of the array. Anything but a top level array is a ValueError.
+"""
+import codecs
+import json
+
+WHITESPACE = ' \t\n\r'
+DECODER = json.JSONDecoder()
+
+
+def skip_whitespace(buf: str, pos: int) -> int:
+    while pos < len(buf) and buf[pos] in WHITESPACE:
+        pos += 1
+    return pos
+
+
+def iter_array(chunks, encoding: str = 'utf-8'):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    buf, pos = '', 0
+    # what comes next: '[' at the start, then an element or ']', a ',' or ']' after an element,
+    # an element after a ',' and nothing but whitespace after the closing ']'
+    state = 'start'
+    for chunk in chunks:
+        buf = buf[pos:] + decoder.decode(chunk)
+        pos = 0
+        while True:
+            pos = skip_whitespace(buf=buf, pos=pos)
+            if pos == len(buf):
+                break
+            char = buf[pos]
+            if state == 'start' and char == '[':
+                state, pos = 'first', pos + 1
+            elif state in ('first', 'separator') and char == ']':
+                state, pos = 'end', pos + 1
+            elif state == 'separator' and char == ',':
+                state, pos = 'element', pos + 1
+            elif state in ('first', 'element'):
+                try:
+                    element, end = DECODER.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    # the element goes on in the next chunk
+                    break
+                if end == len(buf) or buf[end] not in WHITESPACE + ',]':
+                    # a number cut by the chunk border ('12' of '12.5') decodes too, only a separator proves the end
+                    break
+                yield element
+                state, pos = 'separator', end
+            else:
+                raise ValueError(f"unexpected {buf[pos:pos + 50]!r} in the json array")
+    tail = (buf[pos:] + decoder.decode(b'', final=True)).strip()
+    if state != 'end':
+        if tail:
+            # raises the parse error of an element that never completed
+            DECODER.raw_decode(tail)
+        raise ValueError("json array is not closed")
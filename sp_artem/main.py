@@ -1,159 +1,332 @@
 import requests
+from requests.adapters import HTTPAdapter
+import json
 import logging as logger
+import numpy as np
 import pandas as pd
+from array import array
 from datetime import datetime
-from sys import exit as s_exit
+from os import getpid, remove, replace
 from time import sleep, time
-from typing import Generator
+from urllib3.util.retry import Retry
 
+import batching
+import compression
+import metrics
 from config import settings
+from download_cache import DownloadCache
+from json_stream import iter_array
+from scheduler import Scheduler, make_trigger
+from sync_state import FailureLog, OzonUpload, RateLimiter, SyncSnapshot
 logger.basicConfig(level=logger.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
 
+class SupplierTable:
+    """Supplier rows in a compact form: every offer_id once in a pandas Index, stocks and prices as int32 arrays
+    in the same row order. Only the first row of an offer_id is kept, the lookups always took the first one"""
+    NO_PRICE = -1
+
+    def __init__(self, offer_ids: list, stocks: list, prices: list = None, zero_stocks: list = ()) -> None:
+        index = pd.Index(offer_ids, dtype=object)
+        first = ~index.duplicated(keep='first')
+        self.offer_ids = index[first]
+        self.stocks = np.asarray(stocks, dtype=np.int32)[first]
+        if len(zero_stocks):
+            self.stocks[np.isin(self.stocks, zero_stocks)] = 0
+        self.prices = np.asarray(prices, dtype=np.int32)[first] if prices is not None else None
+
+    def __len__(self) -> int:
+        return len(self.offer_ids)
+
+    def rows(self, offer_ids) -> np.ndarray:
+        """Row of every given offer_id, -1 for the ones the supplier does not have"""
+        return self.offer_ids.get_indexer(offer_ids)
+
+    def columns(self) -> dict:
+        """Plain arrays of the table, pickled without a reference to the module of the script that made it"""
+        return dict(offer_ids=self.offer_ids.to_numpy(), stocks=self.stocks, prices=self.prices)
+
+    @staticmethod
+    def from_columns(columns: dict) -> 'SupplierTable':
+        table = SupplierTable.__new__(SupplierTable)
+        table.offer_ids = pd.Index(columns['offer_ids'], dtype=object)
+        table.stocks = columns['stocks']
+        table.prices = columns['prices']
+        return table
+
+    @staticmethod
+    def min_items(rule: str) -> list:
+        """Stocks that OZON_MIN_ITEMS turns into 0. The rule used to be replaced over string cells, so only its
+        string entries ever matched a stock, numbers like the [1,] of .env_dist never did and still do not"""
+        return [int(el) for el in eval(rule) if isinstance(el, str) and el.strip().isdigit()]
+
+
 class TableGetter:
+    CHUNK_SIZE = 1 << 16
+    cache = None
+
+    @staticmethod
+    def download_cache() -> DownloadCache:
+        """One cache for the life of the process, so the last table is at hand in every cycle"""
+        if TableGetter.cache is None:
+            TableGetter.cache = DownloadCache(filename=settings.ARMAVIR_CACHE_FILE, name='Armavir',
+                                              dump=SupplierTable.columns, restore=SupplierTable.from_columns)
+        return TableGetter.cache
 
     @staticmethod
     def table_requester():
         with requests.Session() as s:
+            s.hooks['response'].append(metrics.observe)
             response = s.get(url=settings.ARMAVIR_URL)
             if not response.status_code == 200:
-                logger.warning(msg=f"Во время загрузки данных с {settings.ARMAVIR_URL} произошла ошибка\n"
+                raise RuntimeError(f"Во время загрузки данных с {settings.ARMAVIR_URL} произошла ошибка\n"
                                    f"Ответ сервера: {response.status_code} \n {response.text}")
-                s_exit()
             res_list = response.json()
             return res_list
 
     @staticmethod
-    def process_table(product_list: list) -> pd.core.frame.DataFrame:
+    def table_stream():
+        """Rows of the feed one by one, parsed from the response body while it downloads"""
+        with requests.Session() as s:
+            s.hooks['response'].append(metrics.observe)
+            with s.get(url=settings.ARMAVIR_URL, stream=True) as response:
+                if not response.status_code == 200:
+                    raise RuntimeError(f"Во время загрузки данных с {settings.ARMAVIR_URL} произошла ошибка\n"
+                                       f"Ответ сервера: {response.status_code} \n {response.text}")
+                yield from iter_array(chunks=response.iter_content(chunk_size=TableGetter.CHUNK_SIZE))
 
-        super_list = list(
-            map(lambda x: {"offer_id": str(x[0]),
-                           "stock_val": str(int(float(x[1])))}, product_list))
+    @staticmethod
+    def process_table(product_list) -> SupplierTable:
+        """`product_list` is any iterable of [offer_id, stock] rows, a stream is normalized row by row"""
+        offer_ids, stocks, bad_stocks = [], array('i'), []
+        for el in product_list:
+            try:
+                stock = int(float(el[1]))
+            except (TypeError, ValueError, OverflowError):
+                # a text instead of the remains, ozon would reject it anyway
+                bad_stocks.append(str(el[0]))
+                continue
+            offer_ids.append(str(el[0]))
+            stocks.append(stock)
+        if bad_stocks:
+            logger.warning(msg=f"Остаток не число у {len(bad_stocks)} позиций, они пропущены: {bad_stocks[:10]}")
+        return SupplierTable(offer_ids=offer_ids, stocks=stocks,
+                             zero_stocks=SupplierTable.min_items(rule=settings.OZON_MIN_ITEMS))
 
-        df_arm = pd.DataFrame(super_list)
-        df_arm = df_arm.replace(eval(settings.OZON_MIN_ITEMS), 0)
+    @staticmethod
+    def parse_feed(chunks) -> SupplierTable:
+        if settings.ARMAVIR_STREAM:
+            return TableGetter.process_table(product_list=iter_array(chunks=chunks))
+        return TableGetter.process_table(product_list=json.loads(b''.join(chunks)))
+
+    @staticmethod
+    def cached_table() -> SupplierTable:
+        """The feed through the download cache, an answer 304 or the same body as last time reuse the last table"""
+        cache = TableGetter.download_cache()
+        with requests.Session() as s:
+            s.hooks['response'].append(metrics.observe)
+            with s.get(url=settings.ARMAVIR_URL, headers=cache.request_headers(), stream=True) as response:
+                if response.status_code not in (200, 304):
+                    raise RuntimeError(f"Во время загрузки данных с {settings.ARMAVIR_URL} произошла ошибка\n"
+                                       f"Ответ сервера: {response.status_code} \n {response.text}")
+                return cache.table_from(response=response, parse=TableGetter.parse_feed)
+
+    @staticmethod
+    def get_table() -> SupplierTable:
+        if settings.ARMAVIR_CACHE:
+            # download, hashing and the parsing of a changed feed are one stage
+            with metrics.stage('supplier_fetch') as st:
+                df_arm = TableGetter.cached_table()
+                st.rows = len(df_arm)
+            return df_arm
+
+        if settings.ARMAVIR_STREAM:
+            # download, parsing and normalization overlap, so they are one stage
+            with metrics.stage('supplier_fetch') as st:
+                df_arm = TableGetter.process_table(product_list=TableGetter.table_stream())
+                st.rows = len(df_arm)
+            return df_arm
+
+        with metrics.stage('supplier_fetch') as st:
+            product_list = TableGetter.table_requester()
+            st.rows = len(product_list)
+
+        with metrics.stage('supplier_normalize') as st:
+            df_arm = TableGetter.process_table(product_list=product_list)
+            st.rows = len(df_arm)
         return df_arm
 
 
-class OzonApi:
-    def __init__(self, client_id: str, api_key: str, prices_delta_dict: dict) -> None:
+class OzonApi(OzonUpload):
+    def __init__(self, client_id: str, api_key: str, prices_delta_dict: dict, session: requests.Session = None,
+                 snapshot: SyncSnapshot = None) -> None:
         self.client_id = client_id
         self.api_key = api_key
         self.last_id = None
         self.res_list = []
         self.prices_dd = prices_delta_dict
+        self.snapshot = snapshot
+        self.session = session if session else OzonApi.make_session(client_id=client_id, api_key=api_key)
+        self.catalog_file = settings.OZON_CATALOG_CACHE
+        # one bucket per ozon method, quotas are counted separately for stocks and prices
+        self.limiters = dict(stocks=RateLimiter(rate=settings.OZON_STOCK_RATE_LIMIT),
+                             prices=RateLimiter(rate=settings.OZON_PRICE_RATE_LIMIT))
+        self.batchers = OzonApi.make_batchers(client_id=str(client_id))
+        self.failures = FailureLog(filename=settings.OZON_FAILURE_LOG, owner=dict(client_id=str(client_id)))
 
-    def get_stock_items(self):
+    @staticmethod
+    def make_batchers(client_id: str) -> dict:
+        # batch sizes are learned per seller account and method and kept for the life of the process
+        return dict(stocks=batching.shared(key=(client_id, 'stocks'), maximum=settings.OZON_STOCK_BATCH_MAX,
+                                           slow=settings.OZON_BATCH_SLOW),
+                    prices=batching.shared(key=(client_id, 'prices'), maximum=settings.OZON_PRICE_BATCH_MAX,
+                                           slow=settings.OZON_BATCH_SLOW))
+
+    @staticmethod
+    def make_session(client_id: str, api_key: str) -> requests.Session:
+        """Long-lived session for the seller api: auth headers are set once and the pooled
+        keep-alive connections are reused by every request of every cycle"""
+        s = requests.Session()
+        s.headers.update({'Client-Id': client_id, 'Api-Key': api_key,
+                          'Accept-Encoding': compression.ACCEPT_ENCODING})
+        s.hooks['response'].append(metrics.observe)
+        adapter = HTTPAdapter(pool_maxsize=settings.OZON_POOL_SIZE,
+                              max_retries=Retry(connect=3, read=0, backoff_factor=0.5))
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        return s
+
+    def get_stock_items(self, refresh: bool = False):
+        if not refresh:
+            cached_list = self.load_catalog()
+            if cached_list is not None:
+                self.res_list = cached_list
+                logger.info(msg="Данные с озон склада взяты из кэша")
+                return self.res_list
         while self.last_id != '':
             self.res_list += self.get_stock_items_batch()
+        self.save_catalog(items=self.res_list)
         logger.info(msg="Данные с озон склада получены")
         return self.res_list
 
+    def load_catalog(self) -> list | None:
+        """offer_id/product_id pairs saved by an earlier cycle or by another process of the same seller account"""
+        try:
+            with open(self.catalog_file, encoding='utf-8') as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if catalog.get('client_id') != self.client_id or time() - catalog.get('saved_at', 0) > settings.OZON_CATALOG_TTL:
+            return None
+        return catalog.get('items')
+
+    def save_catalog(self, items: list) -> None:
+        catalog = dict(client_id=self.client_id, saved_at=time(),
+                       items=[dict(product_id=el.get('product_id'), offer_id=el.get('offer_id')) for el in items])
+        tmp_name = f"{self.catalog_file}.{getpid()}.tmp"
+        with open(tmp_name, 'w', encoding='utf-8') as f:
+            json.dump(catalog, f, ensure_ascii=False)
+        replace(tmp_name, self.catalog_file)
+
+    @staticmethod
+    def invalidate_catalog(filename: str = settings.OZON_CATALOG_CACHE) -> None:
+        """Forces the next cycle to list the ozon catalog again"""
+        try:
+            remove(filename)
+        except FileNotFoundError:
+            pass
+
     def get_stock_items_batch(self):
-        with requests.Session() as s:
-            headers = {'Client-Id': self.client_id,
-                       'Api-Key': self.api_key}
-            payload = dict(last_id=self.last_id) if self.last_id else dict()
-            response = s.post(url=settings.OZON_STOCK_URL, headers=headers, json=payload)
-            res_dict = response.json()
+        payload = dict(last_id=self.last_id) if self.last_id else dict()
+        for attempt in range(settings.OZON_RETRY_ATTEMPTS + 1):
+            res_dict = self.list_page(payload=payload)
             result = res_dict.get("result")
+            # an empty page with an empty last_id ends the listing, any other page has items
+            if result and (result.get("last_id") == '' or result.get('items')):
+                break
+            if attempt == settings.OZON_RETRY_ATTEMPTS:
+                # raised instead of exiting, a daemon goes on with its next run
+                raise RuntimeError(f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}")
+            logger.warning(msg=f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}, "
+                               f"повтор через {2 ** attempt} сек")
+            sleep(2 ** attempt)
+        self.last_id = result.get("last_id")
+        if self.last_id == '':
+            return []
+        return result.get('items')
+
+    def list_page(self, payload: dict) -> dict:
+        """One page of the catalog, a failed request is returned as {'error': ...} and tried again"""
+        try:
+            response = self.session.post(url=settings.OZON_STOCK_URL, json=payload, timeout=settings.OZON_TIMEOUT)
+            return response.json()
+        except (requests.RequestException, ValueError) as e:
+            return dict(error=repr(e))
 
-            if not result:
-                logger.warning(msg=f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}")
-                s_exit()
-            else:
-                last_id = result.get("last_id")
-                if last_id == '':
-                    self.last_id = last_id
-                    return []
-                self.last_id = last_id
-                batch_list = res_dict.get("result").get('items')
-                if not batch_list:
-                    logger.warning(msg=f"Во время выгрузки данных товаров на озон произошла ошибка {res_dict}")
-                    s_exit()
-                return batch_list
-
-    def process_stock_items(self, stock_list: list, df_site: pd.core.frame.DataFrame) -> tuple:
-        df_stock_raw = pd.DataFrame(stock_list)
-        df_stock = df_stock_raw[['product_id', 'offer_id']]
-        df_stock_quants = pd.DataFrame(columns=['offer_id', 'product_id', 'stock', 'warehouse_id'])
-
-        stock_quants = []
-        for index, row in df_stock[["product_id", "offer_id"]].iterrows():
-
-            key_oid = row["offer_id"]
-            key_pid = row["product_id"]
-            # get stock value from supplier table
-
-            stock_value = tuple(df_site[df_site['offer_id'] == key_oid]['stock_val'])
-
-            if len(stock_value) == 0:
-                continue
-            stock_quants.append(dict(offer_id=key_oid,
-                                     product_id=key_pid,
-                                     stock=stock_value[0],
-                                     warehouse_id=settings.OZON_WAREHOUSE_ID))
-
-        df_stock_quants = pd.concat([df_stock_quants, pd.DataFrame(stock_quants)])
-        result_list_dicts = df_stock_quants.to_dict(orient="records")
+    @staticmethod
+    def site_lookup(df_site: SupplierTable, column: str) -> dict:
+        """offer_id -> value of the supplier table, `column` is 'stocks' or 'prices'"""
+        return dict(zip(df_site.offer_ids, getattr(df_site, column).tolist()))
+
+    def process_stock_items(self, stock_list: list, df_site: SupplierTable) -> tuple:
+        df_stock = pd.DataFrame(stock_list)[['product_id', 'offer_id']]
+
+        # supplier row of every ozon item in one hash lookup over the offer_id index, -1 if there is none
+        rows = df_site.rows(offer_ids=df_stock['offer_id'])
+        found = rows >= 0
+        result_list_dicts = [dict(offer_id=key_oid, product_id=key_pid, stock=stock,
+                                  warehouse_id=settings.OZON_WAREHOUSE_ID)
+                             for key_oid, key_pid, stock in zip(df_stock['offer_id'][found].tolist(),
+                                                                df_stock['product_id'][found].tolist(),
+                                                                df_site.stocks[rows[found]].tolist())]
+        if self.snapshot:
+            result_list_dicts = self.snapshot.changed(kind='stocks', records=result_list_dicts)
         # print(result_list_dicts)
-        batch_list = self.list_batcher(list_dicts=result_list_dicts)
+        batch_list = self.batchers['stocks'].batches(records=result_list_dicts)
         logger.info(msg=f"Завершено сопоставление таблицы артикулов и таблицы поставщика.\n"
                     f"Обработано {len(result_list_dicts)} записей для кол-ва товаров")
         return batch_list, len(result_list_dicts)
 
 
-    def update_stock(self, list_send: Generator, len_list: int, price_flag: bool = False):
-        with requests.Session() as s:
-            headers = {'Client-Id': self.client_id,
-                       'Api-Key': self.api_key}
-            if not price_flag:
-                for el in list_send:
-
-                    payload = dict(stocks=el)
-                    response = s.post(url=settings.OZON_STOCK_UPDATE_URL, headers=headers, json=payload)
-                    logger.info(msg=f"Пачка данных кол-ва товаров обработана:{response.json()}")
-            else:
-                for el in list_send:
-                    payload = dict(prices=el)
-                    response = s.post(url=settings.OZON_PRICE_UPDATE_URL, headers=headers, json=payload)
-                    logger.info(msg=f"Пачка данных цен обработана:{response.json()}")
-                if len_list > 8000:
-                    sleep(1)
-
-    @staticmethod
-    def list_batcher(list_dicts: list, n: int = 100):
-        len_list = len(list_dicts)
-        for ndx in range(0, len_list, n):
-            yield list_dicts[ndx:min(ndx + n, len_list)]
-
-
-def runner_stock():
+def runner_stock(session: requests.Session = None, snapshot: SyncSnapshot = None):
     start = time()
+    cycle = metrics.start_cycle(name='runner_stock')
+    try:
+        if snapshot:
+            snapshot.start_cycle(kinds=('stocks',))
 
-    product_list = TableGetter.table_requester()
-
-    df_arm = TableGetter.process_table(product_list=product_list)
+        df_arm = TableGetter.get_table()
 
-    oa = OzonApi(client_id=settings.OZON_CLIENT_ID, api_key=settings.OZON_API_KEY, prices_delta_dict={ })
-    stock_list = oa.get_stock_items()
+        oa = OzonApi(client_id=settings.OZON_CLIENT_ID, api_key=settings.OZON_API_KEY, prices_delta_dict={ },
+                     session=session, snapshot=snapshot)
+        with metrics.stage('ozon_catalog') as st:
+            stock_list = oa.get_stock_items()
+            st.rows = len(stock_list)
 
-    batches2send, len_list = oa.process_stock_items(stock_list=stock_list, df_site=df_arm)
+        with metrics.stage('matching') as st:
+            batches2send, len_list = oa.process_stock_items(stock_list=stock_list, df_site=df_arm)
+            st.rows = len(stock_list)
 
-    oa.update_stock(list_send=batches2send, len_list=len_list)
+        oa.update_stock(list_send=batches2send, len_list=len_list)
 
+        if snapshot:
+            snapshot.save()
+    finally:
+        cycle.finish()
     finish = time()
     delta = finish - start
     logger.info(msg=f"Обновление {len_list} позиций по остаткам склада выполнено за {delta}")
 
 
 def main_proc():
-    while True:
-        time_pc = datetime.now()
-        logger.info(msg=f"{time_pc} - запускаю обработчик")
-        runner_stock()
-        logger.info(msg=f"Обработчик запустится через {settings.UPDATE_PERIOD} сек - а пока баиньки")
-        sleep(settings.UPDATE_PERIOD)
+    # one pooled ozon session for the whole life of the daemon
+    session = OzonApi.make_session(client_id=settings.OZON_CLIENT_ID, api_key=settings.OZON_API_KEY)
+    snapshot = SyncSnapshot(filename=settings.SNAPSHOT_FILE, full_sync_every=settings.FULL_SYNC_EVERY)
+    metrics.serve(port=settings.METRICS_PORT)
+    sch = Scheduler()
+    sch.add(name='остатки', func=lambda: runner_stock(session=session, snapshot=snapshot),
+            trigger=make_trigger(spec=settings.STOCK_SCHEDULE, period=settings.UPDATE_PERIOD))
+    sch.run_forever()
 
 
 if __name__ == '__main__':
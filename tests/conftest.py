@@ -0,0 +1,73 @@
+"""Unit tests of the sync scripts, no network calls are made.
+
+    python -m pytest -q
+
+Every script directory has its own config.py and copies of the helper modules, `load_script` imports a module
+of one directory with its own neighbours, the way the multi supplier daemon does, so each copy can be tested.
+Settings that are not in the environment get placeholders, no .env is needed.
+"""
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import PLACEHOLDER_ENV  # noqa: E402
+
+# settings of the supplier configs that the root placeholders do not cover
+SCRIPTS_ENV = dict(
+    OZON_WAREHOUSE_ID='1',
+    RUSKLIMAT_LOGIN='test',
+    RUSKLIMAT_PASSWORD='test',
+    RUSKLIMAT_URL_JWT='http://127.0.0.1:8765/rusklimat/jwt',
+    RUSKLIMAT_URL_RQ='http://127.0.0.1:8765/rusklimat/request-key',
+    RUSKLIMAT_URL_DATA='http://127.0.0.1:8765/rusklimat/data/',
+    EXCEL_FILE='stock.xlsx',
+    EXCEL_SHEET_NAME='Лист1',
+    EXCEL_OFFER_ID_COL='A',
+    EXCEL_QUANTITY_COL='B',
+    START_TIME='00:00',
+    STOP_TIME='23:59',
+    ARMTEK_URL='http://127.0.0.1:8765/armavir/feed',
+    AVTO_EVRO_URL='http://127.0.0.1:8765/avto-evro',
+    AVTO_EVRO_API_KEY='test',
+    ARMAVIR_URL='http://127.0.0.1:8765/armavir/feed',
+    WB_API_KEY='test',
+    WB_STOCK_URL='http://127.0.0.1:8765/wb/cards',
+    WB_STOCK_UPDATE_URL='http://127.0.0.1:8765/wb/stocks',
+    WB_WAREHOUSE_ID='1',
+)
+for key, value in {**PLACEHOLDER_ENV, **SCRIPTS_ENV}.items():
+    os.environ.setdefault(key, value)
+
+LOADED = {}
+
+
+def load_script(directory: str, name: str = 'main'):
+    """Module `name` of a script directory ('' for the root one), imported once per test session"""
+    key = (directory, name)
+    if key not in LOADED:
+        script_dir = os.path.join(ROOT, directory)
+        own = [el[:-3] for el in os.listdir(script_dir) if el.endswith('.py')]
+        saved = {el: sys.modules.pop(el) for el in own if el in sys.modules}
+        sys.path.insert(0, script_dir)
+        try:
+            spec = importlib.util.spec_from_file_location(f"{directory or 'invask'}_{name}",
+                                                          os.path.join(script_dir, f"{name}.py"))
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            sys.path.remove(script_dir)
+            for el in own:
+                sys.modules.pop(el, None)
+            sys.modules.update(saved)
+        LOADED[key] = module
+    return LOADED[key]
+
+
+@pytest.fixture(scope='session')
+def script():
+    return load_script
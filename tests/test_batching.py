@@ -0,0 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+DIRECTORIES = ('', 'rusklimat', 'hevesh', 'heveshWB', 'sp_armtek', 'sp_artem', 'side_proj')
+
+
+@pytest.fixture(params=DIRECTORIES)
+def batching(request, script):
+    return script(request.param, 'batching')
+
+
+def test_starts_at_the_maximum_and_cuts_lazily(batching):
+    batcher = batching.AdaptiveBatcher(maximum=100, slow=5)
+    batches = batcher.batches(records=list(range(250)))
+    first = next(batches)
+    assert len(first) == 100
+    # the answer to the first batch changes the size of the next one
+    batcher.record(size=100, status=429, seconds=0.1)
+    assert [len(el) for el in batches] == [50, 50, 50]
+
+
+def test_overload_halves(batching):
+    for status in (413, 429, 500, 502, 503):
+        batcher = batching.AdaptiveBatcher(maximum=100, slow=5)
+        batcher.record(size=100, status=status, seconds=0.1)
+        assert batcher.size == 50, status
+
+
+def test_timeout_halves_and_slow_answer_takes_a_quarter(batching):
+    batcher = batching.AdaptiveBatcher(maximum=1000, slow=5)
+    batcher.timed_out(size=1000)
+    assert batcher.size == 500
+    batcher.record(size=500, status=200, seconds=6)
+    assert batcher.size == 375
+
+
+def test_quick_answers_grow_back_to_the_maximum(batching):
+    batcher = batching.AdaptiveBatcher(maximum=100, slow=5)
+    batcher.record(size=100, status=429, seconds=0.1)
+    batcher.record(size=50, status=429, seconds=0.1)
+    assert batcher.size == 25
+    sizes = []
+    for _ in range(10):
+        batcher.record(size=batcher.size, status=200, seconds=0.1)
+        sizes.append(batcher.size)
+    assert sizes == [35, 45, 55, 65, 75, 85, 95, 100, 100, 100]
+
+
+def test_client_errors_do_not_change_the_size(batching):
+    batcher = batching.AdaptiveBatcher(maximum=100, slow=5)
+    batcher.record(size=100, status=429, seconds=0.1)
+    batcher.record(size=50, status=400, seconds=0.1)
+    batcher.record(size=50, status=404, seconds=0.1)
+    assert batcher.size == 50
+
+
+def test_batches_in_flight_do_not_shrink_twice(batching):
+    batcher = batching.AdaptiveBatcher(maximum=100, slow=5)
+    # four batches of 100 were sent at once, all of them come back with 429
+    for _ in range(4):
+        batcher.record(size=100, status=429, seconds=0.1)
+    assert batcher.size == 50
+
+
+def test_never_below_the_minimum(batching):
+    batcher = batching.AdaptiveBatcher(maximum=100, slow=5, minimum=10)
+    for _ in range(10):
+        batcher.record(size=batcher.size, status=429, seconds=0.1)
+    assert batcher.size == 10
+    one = batching.AdaptiveBatcher(maximum=3, slow=5)
+    for _ in range(5):
+        one.timed_out(size=one.size)
+    assert one.size == 1
+    assert one.step == 1
+
+
+def test_bad_maximum(batching):
+    with pytest.raises(ValueError):
+        batching.AdaptiveBatcher(maximum=0, slow=5)
+
+
+def test_every_record_is_in_one_batch(batching):
+    batcher = batching.AdaptiveBatcher(maximum=7, slow=5)
+    records = list(range(1000))
+    sent = []
+    for i, batch in enumerate(batcher.batches(records=records)):
+        sent.extend(batch)
+        batcher.record(size=len(batch), status=429 if i % 3 == 0 else 200, seconds=0.1)
+    assert sent == records
+    assert list(batcher.batches(records=[])) == []
+
+
+def test_answers_from_several_threads(batching):
+    batcher = batching.AdaptiveBatcher(maximum=1000, slow=5)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: batcher.record(size=batcher.size, status=429 if i % 2 else 200, seconds=0.1),
+                          range(400)))
+    assert 1 <= batcher.size <= 1000
+
+
+def test_shared_keeps_one_batcher_per_key(batching):
+    first = batching.shared(key=('test', 'stocks'), maximum=100, slow=5)
+    assert batching.shared(key=('test', 'stocks'), maximum=100, slow=5) is first
+    assert batching.shared(key=('test', 'prices'), maximum=1000, slow=5) is not first
@@ -0,0 +1,31 @@
+import pytest
+from openpyxl import Workbook
+
+
+@pytest.fixture(scope='module')
+def hevesh(script):
+    return script('hevesh')
+
+
+def test_numeric_offer_ids_are_read_as_strings(hevesh, tmp_path, monkeypatch):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = 'Лист1'
+    for row in (('артикул', 'остаток'), (1001, 5), ('НС-1', 2), (None, 7), (1001, 9)):
+        sheet.append(row)
+    workbook.save(tmp_path / 'stock.xlsx')
+    monkeypatch.setattr(hevesh.settings, 'EXCEL_FILE', str(tmp_path / 'stock.xlsx'))
+    monkeypatch.setattr(hevesh.settings, 'EXCEL_SHEET_NAME', 'Лист1')
+    assert hevesh.TableGetter.table_from_excel() == {'1001': 5, 'НС-1': 2}
+
+
+def test_stock_records_of_the_matched_offers(hevesh):
+    oa = hevesh.OzonApi(client_id='c', api_key='k', prices_delta_dict={})
+    stock_list = [dict(offer_id='1001', product_id=11), dict(offer_id='НС-1', product_id=12),
+                  dict(offer_id='нет', product_id=13)]
+    batches, count = oa.process_stock_items(stock_list=stock_list, site_values={'1001': 5, 'НС-1': 2})
+    warehouse_id = hevesh.settings.OZON_WAREHOUSE_ID
+    assert count == 2
+    assert [el for batch in batches for el in batch] == [
+        dict(offer_id='1001', product_id=11, stock=5, warehouse_id=warehouse_id),
+        dict(offer_id='НС-1', product_id=12, stock=2, warehouse_id=warehouse_id)]
@@ -0,0 +1,174 @@
+import json
+from datetime import timedelta
+
+import pytest
+import requests
+
+DIRECTORIES = ('', 'rusklimat', 'hevesh', 'heveshWB', 'sp_armtek', 'sp_artem', 'side_proj')
+
+
+@pytest.fixture(params=DIRECTORIES)
+def sync_state(request, script):
+    return script(request.param, 'sync_state')
+
+
+def records(*offer_ids) -> list:
+    return [dict(offer_id=el, stock=1, warehouse_id=1) for el in offer_ids]
+
+
+def response(status: int, answer) -> requests.Response:
+    result = requests.Response()
+    result.status_code = status
+    result._content = (answer if isinstance(answer, str) else json.dumps(answer)).encode()
+    result.elapsed = timedelta(seconds=0.1)
+    return result
+
+
+def test_updated_items_are_done(sync_state):
+    res_dict = dict(result=[dict(offer_id='a', updated=True, errors=[]), dict(offer_id=101, updated=True)])
+    assert sync_state.item_outcomes(records=records('a', 101), res_dict=res_dict) == ([], [])
+
+
+def test_passing_errors_are_sent_again_and_the_rest_is_rejected(sync_state):
+    too_many = [dict(code='TOO_MANY_REQUESTS', message='')]
+    not_found = [dict(code='NOT_FOUND', message='')]
+    res_dict = dict(result=[dict(offer_id='a', updated=False, errors=too_many),
+                            dict(offer_id='b', updated=False, errors=not_found),
+                            dict(offer_id='c', updated=False, errors=too_many + not_found),
+                            dict(offer_id='d', updated=True, errors=[])])
+    retry, rejected = sync_state.item_outcomes(records=records('a', 'b', 'c', 'd'), res_dict=res_dict)
+    assert retry == [(records('a')[0], too_many)]
+    assert rejected == [(records('b')[0], not_found), (records('c')[0], too_many + not_found)]
+
+
+def test_items_missing_from_the_answer_are_sent_again(sync_state):
+    res_dict = dict(result=[dict(offer_id='a', updated=True)])
+    retry, rejected = sync_state.item_outcomes(records=records('a', 'b'), res_dict=res_dict)
+    assert [record['offer_id'] for record, errors in retry] == ['b']
+    assert retry[0][1][0]['code'] == 'NO_RESULT'
+    assert rejected == []
+
+
+@pytest.mark.parametrize('res_dict', (dict(), dict(result=None), dict(result='error'), dict(code=8)))
+def test_answer_without_a_result_sends_everything_again(sync_state, res_dict):
+    retry, rejected = sync_state.item_outcomes(records=records('a', 'b'), res_dict=res_dict)
+    assert [record['offer_id'] for record, errors in retry] == ['a', 'b']
+    assert rejected == []
+
+
+def test_failure_log_appends_json_lines(sync_state, tmp_path):
+    filename = tmp_path / 'failed.jsonl'
+    log = sync_state.FailureLog(filename=str(filename), owner=dict(client_id='42'))
+    log.write(kind='stocks', items=[(records('a')[0], [dict(code='NOT_FOUND')])])
+    log.write(kind='prices', items=[])
+    log.write(kind='prices', items=[(dict(offer_id='б', price='10'), [])])
+    lines = [json.loads(el) for el in filename.read_text(encoding='utf-8').splitlines()]
+    assert [(el['client_id'], el['kind'], el['offer_id']) for el in lines] == [('42', 'stocks', 'a'),
+                                                                                ('42', 'prices', 'б')]
+    assert lines[0]['errors'] == [dict(code='NOT_FOUND')]
+
+
+@pytest.mark.parametrize('header, attempt, delay', [(None, 3, 8), ('7', 0, 7), ('-2', 0, 0), ('soon', 2, 4),
+                                                    ('Wed, 21 Oct 2015 07:28:00 GMT', 1, 0)])
+def test_retry_after(sync_state, header, attempt, delay):
+    answer = response(429, '')
+    if header:
+        answer.headers['Retry-After'] = header
+    assert sync_state.OzonUpload.retry_after(response=answer, attempt=attempt) == delay
+
+
+class FakeOzonSession:
+    def __init__(self, *answers: requests.Response) -> None:
+        self.answers = list(answers)
+
+    def post(self, **kwargs) -> requests.Response:
+        return self.answers.pop(0)
+
+
+def uploader(sync_state, tmp_path, *answers):
+    oa = sync_state.OzonUpload()
+    oa.session = FakeOzonSession(*answers)
+    oa.limiters = dict(stocks=sync_state.RateLimiter(rate=1000), prices=sync_state.RateLimiter(rate=1000))
+    batcher = type('Batcher', (), dict(record=lambda self, **kwargs: None, timed_out=lambda self, **kwargs: None))()
+    oa.batchers = dict(stocks=batcher, prices=batcher)
+    oa.failures = sync_state.FailureLog(filename=str(tmp_path / 'failed.jsonl'))
+    oa.snapshot = None
+    oa.catalog_file = str(tmp_path / 'catalog.json')
+    oa.invalidated = []
+    oa.invalidate_catalog = lambda filename: oa.invalidated.append(filename)
+    return oa
+
+
+@pytest.mark.parametrize('directory', ('', 'rusklimat', 'hevesh', 'sp_armtek', 'sp_artem', 'side_proj'))
+def test_post_batch_sends_back_only_the_items_to_retry(script, tmp_path, monkeypatch, directory):
+    sync_state = script(directory, 'sync_state')
+    monkeypatch.setattr(sync_state, 'sleep', lambda seconds: None)
+    result = [dict(offer_id='a', updated=True), dict(offer_id='b', updated=False, errors=[dict(code='NOT_FOUND')]),
+              dict(offer_id='c', updated=False, errors=[dict(code='TOO_MANY_REQUESTS')])]
+    oa = uploader(sync_state, tmp_path, response(503, 'busy'), response(200, dict(result=result)))
+    retry = oa.post_batch(url='https://ozon.test/stocks', payload=dict(stocks=records('a', 'b', 'c')))
+    assert [record['offer_id'] for record, errors in retry] == ['c']
+    logged = (tmp_path / 'failed.jsonl').read_text(encoding='utf-8').splitlines()
+    assert [json.loads(el)['offer_id'] for el in logged] == ['b']
+    # an unknown offer means the cached catalog is out of date
+    assert oa.invalidated == [oa.catalog_file]
+
+
+@pytest.mark.parametrize('directory', ('', 'rusklimat', 'hevesh', 'sp_armtek', 'sp_artem', 'side_proj'))
+def test_post_batch_logs_a_rejected_batch(script, tmp_path, directory):
+    sync_state = script(directory, 'sync_state')
+    oa = uploader(sync_state, tmp_path, response(400, 'bad request'))
+    assert oa.post_batch(url='https://ozon.test/prices', payload=dict(prices=records('a', 'b'))) == []
+    logged = (tmp_path / 'failed.jsonl').read_text(encoding='utf-8').splitlines()
+    assert [(json.loads(el)['kind'], json.loads(el)['offer_id']) for el in logged] == [('prices', 'a'),
+                                                                                        ('prices', 'b')]
+
+
+@pytest.fixture(scope='module')
+def wb_main(script):
+    return script('heveshWB')
+
+
+def wb_records(*skus) -> list:
+    return [dict(sku=el, amount=1) for el in skus]
+
+
+def test_409_rejects_the_skus_listed_in_the_errors(wb_main):
+    answer = [dict(code='NotFound', message='нет такого товара', data=[dict(sku='s1', amount=1)]),
+              dict(code='Blocked', message='карточка заблокирована', data=[dict(sku='s3'), dict(sku='s1')])]
+    rejected = wb_main.WB.rejected_items(records=wb_records('s1', 's2', 's3'), response=response(409, answer))
+    assert [(record['sku'], [el['code'] for el in errors]) for record, errors in rejected] == [
+        ('s1', ['NotFound', 'Blocked']), ('s3', ['Blocked'])]
+
+
+@pytest.mark.parametrize('answer', ('<html>conflict</html>', dict(code='Conflict'), [dict(code='Conflict')], []))
+def test_409_without_skus_rejects_the_whole_batch(wb_main, answer):
+    rejected = wb_main.WB.rejected_items(records=wb_records('s1', 's2'), response=response(409, answer))
+    assert [record['sku'] for record, errors in rejected] == ['s1', 's2']
+    assert rejected[0][1][0]['code'] == '409'
+
+
+class FakeSession:
+    def __init__(self, answer: requests.Response) -> None:
+        self.answer = answer
+
+    def put(self, **kwargs) -> requests.Response:
+        return self.answer
+
+
+@pytest.mark.parametrize('status, answer, retried, logged', [
+    (204, '', [], []),
+    (409, [dict(code='NotFound', message='', data=[dict(sku='s2')])], [], ['s2']),
+    (429, 'too many requests', ['s1', 's2'], []),
+    (502, 'bad gateway', ['s1', 's2'], []),
+    (400, 'bad request', [], ['s1', 's2']),
+])
+def test_put_batch_outcomes(wb_main, tmp_path, status, answer, retried, logged):
+    wb = wb_main.WB(api_key='key')
+    wb.session = FakeSession(answer=response(status, answer))
+    filename = tmp_path / 'failed.jsonl'
+    wb.failures = wb_main.FailureLog(filename=str(filename), owner=dict(warehouse_id=1), id_field='sku')
+    retry = wb.put_batch(url='https://wb.test/stocks/1', records=wb_records('s1', 's2'))
+    assert [record['sku'] for record, errors in retry] == retried
+    lines = filename.read_text(encoding='utf-8').splitlines() if filename.exists() else []
+    assert [json.loads(el)['sku'] for el in lines] == logged
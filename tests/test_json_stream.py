@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+DOCUMENT = ' [ ["451873", "12"], ["НС-1155801", 12.5] ,{"a": [1, 2, {"b": "]"}]}, 7, -0.25e3, "с,]\\"", true, null,\n[] ]\n'
+
+
+@pytest.fixture(params=('sp_armtek', 'sp_artem', 'side_proj'))
+def json_stream(request, script):
+    return script(request.param, 'json_stream')
+
+
+def chunked(data: bytes, size: int) -> list:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_every_split_point(json_stream):
+    data = DOCUMENT.encode()
+    expected = json.loads(DOCUMENT)
+    # one border at every byte, in the middle of numbers, strings, separators and multibyte letters
+    for border in range(len(data) + 1):
+        assert list(json_stream.iter_array(chunks=[data[:border], data[border:]])) == expected, border
+
+
+@pytest.mark.parametrize('size', (1, 2, 3, 7, 64))
+def test_small_chunks(json_stream, size):
+    data = DOCUMENT.encode()
+    assert list(json_stream.iter_array(chunks=chunked(data, size))) == json.loads(DOCUMENT)
+
+
+def test_number_cut_by_the_border_is_not_handed_out_early(json_stream):
+    assert list(json_stream.iter_array(chunks=[b'[12', b'.5, 3', b'4]'])) == [12.5, 34]
+
+
+def test_elements_are_handed_out_while_chunks_arrive(json_stream):
+    def chunks():
+        yield b'[1, 2,'
+        raise ConnectionError('the rest never came')
+
+    rows = json_stream.iter_array(chunks=chunks())
+    assert [next(rows), next(rows)] == [1, 2]
+    with pytest.raises(ConnectionError):
+        next(rows)
+
+
+def test_other_encoding(json_stream):
+    data = '[["артикул", 1]]'.encode('cp1251')
+    assert list(json_stream.iter_array(chunks=chunked(data, 1), encoding='cp1251')) == [['артикул', 1]]
+
+
+@pytest.mark.parametrize('document', ('[]', ' [ ] ', '[\n]\n'))
+def test_empty_array(json_stream, document):
+    assert list(json_stream.iter_array(chunks=[document.encode()])) == []
+
+
+@pytest.mark.parametrize('document', ('{"a": 1}', '[1, 2', '[1 2]', '[1,, 2]', '[1] x', '[,1]', '', '[1, {"a": ]'))
+def test_broken_documents(json_stream, document):
+    with pytest.raises(ValueError):
+        list(json_stream.iter_array(chunks=chunked(document.encode(), 3)))
@@ -0,0 +1,124 @@
+import pytest
+
+
+@pytest.fixture(scope='module')
+def daemon(script):
+    return script('multi_supplier')
+
+
+TABLES = [dict(a=1, b=5), dict(b=2, c=0), dict(a=4, d=7)]
+
+
+@pytest.mark.parametrize('strategy, expected', [
+    ('sum', dict(a=5, b=7, c=0, d=7)),
+    ('max', dict(a=4, b=5, c=0, d=7)),
+    ('priority', dict(a=1, b=5, c=0, d=7)),
+])
+def test_strategies(daemon, strategy, expected):
+    assert daemon.merge_stocks(tables=TABLES, strategy=strategy) == expected
+
+
+def test_tables_are_not_changed(daemon):
+    tables = [dict(a=1), dict(a=2)]
+    daemon.merge_stocks(tables=tables, strategy='sum')
+    assert tables == [dict(a=1), dict(a=2)]
+
+
+def test_no_tables(daemon):
+    assert daemon.merge_stocks(tables=[], strategy='sum') == {}
+
+
+def test_stock_numbers_skip_cells_that_are_not_numbers(daemon):
+    assert daemon.stock_numbers({'a': '3', 1001: 2.0, 'c': None, 'd': 'нет', 'e': '4.9'}) == {'a': 3, '1001': 2, 'e': 4}
+
+
+class FakeOzon:
+    def __init__(self, pushed: list) -> None:
+        self.pushed = pushed
+        self.batchers = dict(stocks=self, prices=self)
+
+    @staticmethod
+    def batches(records: list) -> list:
+        return [records]
+
+    def update_stock(self, list_send, len_list: int, price_flag: bool = False) -> None:
+        self.pushed.extend(el for batch in list_send for el in batch)
+
+
+class FakeSnapshot:
+    cycles = 0
+    kinds = ()
+
+    def start_cycle(self, kinds: tuple = ('stocks', 'prices')) -> None:
+        self.cycles += 1
+        self.kinds = kinds
+
+    @staticmethod
+    def changed(kind: str, records: list) -> list:
+        return records
+
+    def save(self) -> None:
+        pass
+
+
+class FakeAdapter:
+    """Supplier whose fetch returns `table` or raises it when it is an exception"""
+    account, warehouse, name = 'c', '1', 'fake'
+    settings = type('Settings', (), dict(OZON_WAREHOUSE_ID=1))
+    price_reader = None
+
+    def __init__(self, table, pushed: list) -> None:
+        self.table = table
+        self.pushed = pushed
+        self.last_merged = None
+
+    def fetch(self):
+        if isinstance(self.table, Exception):
+            raise self.table
+        return self.table
+
+    def ozon_api(self, **kwargs) -> FakeOzon:
+        return FakeOzon(pushed=self.pushed)
+
+    @staticmethod
+    def stock_values(oa, table) -> dict:
+        return table
+
+    @staticmethod
+    def price_records(oa, stock_list: list, table) -> list:
+        return []
+
+
+CATALOG = [dict(offer_id='a', product_id=1), dict(offer_id='b', product_id=2)]
+
+
+def test_failed_supplier_without_a_table_stops_the_push(daemon, monkeypatch):
+    monkeypatch.setattr(daemon.settings, 'MERGE_STRATEGY', 'sum')
+    pushed, snapshot = [], FakeSnapshot()
+    adapters = [FakeAdapter(dict(a=1, b=2), pushed), FakeAdapter(ConnectionError('down'), pushed)]
+    daemon.merged_group(adapters=adapters, stock_list=CATALOG, session=None, snapshot=snapshot)
+    assert pushed == []
+    assert snapshot.cycles == 0
+
+
+def test_failed_supplier_takes_part_with_its_last_table(daemon, monkeypatch):
+    monkeypatch.setattr(daemon.settings, 'MERGE_STRATEGY', 'sum')
+    pushed, snapshot = [], FakeSnapshot()
+    adapters = [FakeAdapter(dict(a=1, b=2), pushed), FakeAdapter(dict(a=10), pushed)]
+    daemon.merged_group(adapters=adapters, stock_list=CATALOG, session=None, snapshot=snapshot)
+    adapters[1].table = ConnectionError('down')
+    adapters[0].table = dict(a=2, b=2)
+    daemon.merged_group(adapters=adapters, stock_list=CATALOG, session=None, snapshot=snapshot)
+    assert {el['offer_id']: el['stock'] for el in pushed[2:]} == dict(a=12, b=2)
+    assert snapshot.cycles == 2
+
+
+def test_price_cycles_are_counted_only_when_a_supplier_has_prices(daemon, monkeypatch):
+    monkeypatch.setattr(daemon.settings, 'MERGE_STRATEGY', 'sum')
+    pushed, snapshot = [], FakeSnapshot()
+    adapters = [FakeAdapter(dict(a=1), pushed), FakeAdapter(dict(b=2), pushed)]
+    daemon.merged_group(adapters=adapters, stock_list=CATALOG, session=None, snapshot=snapshot)
+    assert snapshot.kinds == ('stocks',)
+    adapters[1].price_reader = type('PriceReader', (), dict(get_prices_dict=lambda self: {}))()
+    daemon.merged_group(adapters=adapters, stock_list=CATALOG, session=None, snapshot=snapshot)
+    assert snapshot.kinds == ('stocks', 'prices')
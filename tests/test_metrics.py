@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier, Thread
+
+import pytest
+
+
+@pytest.fixture
+def metrics(script):
+    module = script('', 'metrics')
+    yield module
+    module.ACTIVE.set(None)
+
+
+def stage_values(cycle) -> dict:
+    return {el['stage']: el['bytes_saved'] for el in cycle.report()['stages']}
+
+
+def test_threads_of_one_cycle_count_into_their_own_stage(metrics):
+    cycle = metrics.start_cycle(name='test')
+    # both stages are open at the same time, each thread adds only to its own
+    barrier = Barrier(2)
+
+    def work(name: str, value: int) -> None:
+        with cycle.stage(name):
+            barrier.wait()
+            for _ in range(100):
+                cycle.add(bytes_saved=value)
+            barrier.wait()
+
+    threads = [Thread(target=metrics.bind(work), args=('upload_stocks', 1)),
+               Thread(target=metrics.bind(work), args=('matching', 2))]
+    for el in threads:
+        el.start()
+    for el in threads:
+        el.join()
+    cycle.finish()
+    assert stage_values(cycle) == dict(upload_stocks=100, matching=200)
+
+
+def test_bound_workers_see_the_open_stage(metrics):
+    cycle = metrics.start_cycle(name='test')
+    with metrics.stage('upload_prices'), ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(metrics.bind(lambda value: metrics.add(bytes_saved=value)), range(10)))
+    cycle.finish()
+    assert stage_values(cycle) == dict(upload_prices=45)
+
+
+def test_unbound_thread_does_not_see_the_cycle(metrics):
+    cycle = metrics.start_cycle(name='test')
+    with metrics.stage('matching'):
+        thread = Thread(target=lambda: metrics.add(bytes_saved=1))
+        thread.start()
+        thread.join()
+    cycle.finish()
+    assert stage_values(cycle) == dict(matching=0)
+
+
+def test_nested_stages_and_other(metrics):
+    cycle = metrics.start_cycle(name='test')
+    with metrics.stage('outer'):
+        with metrics.stage('inner'):
+            metrics.add(bytes_saved=1)
+        metrics.add(bytes_saved=2)
+    metrics.add(bytes_saved=4)
+    cycle.finish()
+    assert stage_values(cycle) == dict(outer=2, inner=1, other=4)
+    assert metrics.ACTIVE.get() is None
+
+
+@pytest.mark.parametrize('directory', ('', 'rusklimat'))
+def test_failed_runner_still_publishes_its_cycle(script, monkeypatch, directory):
+    main = script(directory)
+
+    def broken_sync(**kwargs):
+        with main.metrics.stage('upload_stocks'):
+            raise RuntimeError('ozon is down')
+
+    monkeypatch.setattr(main, 'sync_accounts', broken_sync)
+    if directory:
+        monkeypatch.setattr(main.TableGetter, 'jwt_requester', staticmethod(lambda: 'jwt'))
+        monkeypatch.setattr(main.TableGetter, 'table_requester', staticmethod(lambda jwt: []))
+        monkeypatch.setattr(main.TableGetter, 'process_table', staticmethod(lambda product_list: []))
+    else:
+        monkeypatch.setattr(main.TableGetter, 'get_table', lambda self: [])
+    with pytest.raises(RuntimeError):
+        main.runner_stock(accounts=['account'])
+    report = main.metrics.LAST_CYCLES['runner_stock']
+    assert 'upload_stocks' in [el['stage'] for el in report['stages']]
+    assert main.metrics.ACTIVE.get() is None
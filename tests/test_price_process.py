@@ -0,0 +1,79 @@
+import random
+
+import numpy as np
+import pytest
+from openpyxl import Workbook
+
+# (price, (markup percent, delivery)), results that end exactly on .5 before rounding and the edges of the rules
+BOUNDARY = [
+    (0, (0.0, 0.0)),
+    (0, (25.0, 0.5)),
+    (1, (50.0, 0.0)),
+    (3, (50.0, 0.0)),
+    (5, (-50.0, 0.0)),
+    (7, (-50.0, 0.0)),
+    (100, (-100.0, 0.0)),
+    (100, (-100.0, -0.5)),
+    (100, (0.0, 0.5)),
+    (101, (0.0, -0.5)),
+    (250, (0.2, 0.0)),
+    (2500, (0.02, 0.0)),
+    (199, (0.5, 0.005)),
+    (1, (0.0, 1.5)),
+    (1, (0.0, 2.5)),
+    (999999999, (12.3456, 9999.9999)),
+]
+
+
+@pytest.fixture(params=('', 'rusklimat'))
+def price_reader(request, script):
+    return script(request.param, 'prices_reader').PriceReader
+
+
+def random_rules(seed: int, size: int) -> list:
+    rnd = random.Random(seed)
+    rules = []
+    for _ in range(size):
+        price = rnd.choice((rnd.randint(0, 10), rnd.randint(0, 100000), round(rnd.uniform(0, 100000), 2)))
+        # rules are rounded to 4 digits when the workbook is loaded
+        markup = round(rnd.choice((rnd.uniform(-100, 300), float(rnd.randint(-100, 300)), rnd.randint(-20, 20) / 2)), 4)
+        delivery = round(rnd.choice((rnd.uniform(-500, 5000), float(rnd.randint(0, 1000)), rnd.randint(0, 40) / 2)), 4)
+        rules.append((price, (markup, delivery)))
+    return rules
+
+
+def check_equal(price_reader, rules: list) -> None:
+    batch = price_reader.price_process_batch(prices=[el[0] for el in rules], markups=[el[1][0] for el in rules],
+                                             deliveries=[el[1][1] for el in rules])
+    assert batch.dtype == np.int64
+    for (price, prices_tuple), value in zip(rules, batch.tolist()):
+        assert str(value) == price_reader.price_process(price=price, prices_tuple=prices_tuple), (price, prices_tuple)
+
+
+def test_batch_matches_scalar_on_boundaries(price_reader):
+    check_equal(price_reader, BOUNDARY)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_batch_matches_scalar_on_random_rules(price_reader, seed):
+    check_equal(price_reader, random_rules(seed=seed, size=20000))
+
+
+def test_halves_round_to_even(price_reader):
+    values = price_reader.price_process_batch(prices=[1, 3, 5, 7], markups=[50.0, 50.0, -50.0, -50.0],
+                                              deliveries=[0.0, 0.0, 0.0, 0.0])
+    assert values.tolist() == [2, 4, 2, 4]
+
+
+def test_empty_columns(price_reader):
+    assert price_reader.price_process_batch(prices=[], markups=[], deliveries=[]).tolist() == []
+
+
+def test_rules_are_keyed_by_the_article_as_a_string(price_reader, tmp_path):
+    workbook = Workbook()
+    for row in (('артикул', 'наценка', 'доставка'), (452001, 25, 100), ('НС-1155801', 12.5, 0), (None, 1, 1)):
+        workbook.active.append(row)
+    workbook.save(tmp_path / 'prices.xlsx')
+    reader = price_reader(filename=str(tmp_path / 'prices.xlsx'), start_rows=2, article_col='A',
+                          prices_delta_col='B', delivery_col='C')
+    assert reader.get_prices_dict() == {'452001': (25.0, 100.0), 'НС-1155801': (12.5, 0.0)}
@@ -0,0 +1,29 @@
+import pytest
+
+
+def table_dict(table) -> dict:
+    prices = table.prices.tolist() if table.prices is not None else [None] * len(table)
+    return {offer_id: (stock, price) for offer_id, stock, price in zip(table.offer_ids, table.stocks.tolist(), prices)}
+
+
+def test_invask_keeps_the_stock_of_offers_with_a_bad_price(script):
+    main = script('')
+    no_price = main.SupplierTable.NO_PRICE
+    table = main.TableGetter.process_table(product_list=[
+        dict(cat_number='a', quantityLabel=5, regular_price=1200),
+        dict(cat_number='b', quantityLabel='>10', regular_price='по запросу'),
+        dict(cat_number='c', quantityLabel=2, regular_price=None),
+        dict(cat_number='d', quantityLabel=3, regular_price='990.00'),
+        dict(cat_number='e', quantityLabel=4, regular_price=float('nan')),
+        dict(cat_number='f', quantityLabel=1, regular_price=[]),
+    ])
+    assert table_dict(table) == dict(a=(5, 1200), b=(11, no_price), c=(2, no_price), d=(3, 990), e=(4, no_price),
+                                     f=(1, no_price))
+
+
+@pytest.mark.parametrize('directory', ('sp_armtek', 'sp_artem', 'side_proj'))
+def test_armavir_skips_rows_with_a_bad_stock(script, directory):
+    main = script(directory)
+    table = main.TableGetter.process_table(product_list=[['a', '5'], ['b', 'нет'], ['c', 2.0], [101, None],
+                                                         ['d', 'inf'], ['e', '7.9']])
+    assert table_dict(table) == dict(a=(5, None), c=(2, None), e=(7, None))
@@ -0,0 +1,137 @@
+from datetime import datetime, time as dtime, timedelta
+
+import pytest
+
+DIRECTORIES = ('', 'rusklimat', 'hevesh', 'heveshWB', 'sp_armtek', 'sp_artem', 'side_proj', 'multi_supplier')
+
+
+@pytest.fixture(params=DIRECTORIES)
+def scheduler(request, script):
+    return script(request.param, 'scheduler')
+
+
+def test_fixed_rate_counts_from_the_planned_start(scheduler):
+    trigger = scheduler.make_trigger(spec='10m', period=60)
+    start = datetime(2024, 5, 1, 10, 0)
+    assert trigger.first_run(now=start) == start
+    assert trigger.next_run(after=start) == datetime(2024, 5, 1, 10, 10)
+
+
+@pytest.mark.parametrize('spec, seconds', [('', 600), ('90', 90), ('45s', 45), ('10m', 600), ('6h', 21600),
+                                           ('1d', 86400), ('1.5h', 5400)])
+def test_every_specs(scheduler, spec, seconds):
+    trigger = scheduler.make_trigger(spec=spec, period=600)
+    assert isinstance(trigger, scheduler.EveryTrigger)
+    assert trigger.period == timedelta(seconds=seconds)
+
+
+def test_bad_specs(scheduler):
+    with pytest.raises(ValueError):
+        scheduler.make_trigger(spec='0m', period=600)
+    with pytest.raises(ValueError):
+        scheduler.make_trigger(spec='61 * * * *', period=600)
+    with pytest.raises(ValueError):
+        scheduler.make_trigger(spec='* * * *', period=600)
+
+
+def test_window_waits_for_the_opening(scheduler):
+    trigger = scheduler.EveryTrigger(period=3600, window=(dtime(9), dtime(18)))
+    assert trigger.first_run(now=datetime(2024, 5, 1, 7, 30)) == datetime(2024, 5, 1, 9, 0)
+    assert trigger.first_run(now=datetime(2024, 5, 1, 12, 30)) == datetime(2024, 5, 1, 12, 30)
+    # 17:30 + 1h is past the stop, the next run is the opening of the next day
+    assert trigger.next_run(after=datetime(2024, 5, 1, 17, 30)) == datetime(2024, 5, 2, 9, 0)
+
+
+def test_window_over_midnight(scheduler):
+    trigger = scheduler.EveryTrigger(period=3600, window=(scheduler.parse_clock('22:00'),
+                                                          scheduler.parse_clock('02:00')))
+    assert trigger.in_window(datetime(2024, 5, 1, 23, 0))
+    assert trigger.in_window(datetime(2024, 5, 2, 1, 59))
+    assert not trigger.in_window(datetime(2024, 5, 2, 2, 0))
+    assert trigger.next_run(after=datetime(2024, 5, 2, 1, 30)) == datetime(2024, 5, 2, 22, 0)
+
+
+@pytest.mark.parametrize('expression, after, expected', [
+    ('*/10 * * * *', datetime(2024, 5, 1, 10, 3, 20), datetime(2024, 5, 1, 10, 10)),
+    ('*/10 * * * *', datetime(2024, 5, 1, 10, 10), datetime(2024, 5, 1, 10, 20)),
+    ('0 */6 * * *', datetime(2024, 5, 1, 13, 0), datetime(2024, 5, 1, 18, 0)),
+    ('30 9 * * 1-5', datetime(2024, 5, 3, 10, 0), datetime(2024, 5, 6, 9, 30)),
+    ('0 0 * * 7', datetime(2024, 5, 1, 0, 0), datetime(2024, 5, 5, 0, 0)),
+    ('0 0 1 * *', datetime(2024, 12, 15, 0, 0), datetime(2025, 1, 1, 0, 0)),
+    ('0 0 29 2 *', datetime(2024, 3, 1, 0, 0), datetime(2028, 2, 29, 0, 0)),
+    ('15,45 8-9 * * *', datetime(2024, 5, 1, 8, 45), datetime(2024, 5, 1, 9, 15)),
+    # day and weekday both restricted: either of them will do, 2024-05-04 is a saturday
+    ('0 12 10 * 6', datetime(2024, 5, 1, 0, 0), datetime(2024, 5, 4, 12, 0)),
+])
+def test_cron(scheduler, expression, after, expected):
+    trigger = scheduler.make_trigger(spec=expression, period=600)
+    assert isinstance(trigger, scheduler.CronTrigger)
+    assert trigger.next_run(after=after) == expected
+
+
+def test_cron_that_never_fires(scheduler):
+    with pytest.raises(ValueError):
+        scheduler.CronTrigger('0 0 31 2 *').next_run(after=datetime(2024, 1, 1))
+
+
+class Clock:
+    def __init__(self, now: datetime) -> None:
+        self.now = now
+
+    def patch(self, scheduler, monkeypatch) -> None:
+        clock = self
+
+        class FakeDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return clock.now
+        monkeypatch.setattr(scheduler, 'datetime', FakeDatetime)
+
+
+def test_scheduler_runs_due_jobs_and_skips_missed_slots(scheduler, monkeypatch):
+    clock = Clock(now=datetime(2024, 5, 1, 10, 0))
+    clock.patch(scheduler, monkeypatch)
+    runs = []
+
+    def slow_job():
+        runs.append(clock.now)
+        # the run takes 25 minutes of a 10 minute period
+        clock.now += timedelta(minutes=25)
+
+    sch = scheduler.Scheduler()
+    job = sch.add(name='остатки', func=slow_job, trigger=scheduler.make_trigger(spec='10m', period=600))
+    assert sch.run_pending() == 0
+    assert runs == [datetime(2024, 5, 1, 10, 0)]
+    # 10:10 and 10:20 were missed while it ran, the schedule keeps its grid instead of drifting
+    assert job.next_run == datetime(2024, 5, 1, 10, 30)
+    assert sch.run_pending() == pytest.approx(5 * 60)
+
+
+def test_failed_run_keeps_the_schedule(scheduler, monkeypatch):
+    clock = Clock(now=datetime(2024, 5, 1, 10, 0))
+    clock.patch(scheduler, monkeypatch)
+
+    def broken_job():
+        raise RuntimeError('supplier is down')
+
+    sch = scheduler.Scheduler()
+    job = sch.add(name='цены', func=broken_job, trigger=scheduler.make_trigger(spec='1h', period=600))
+    assert sch.run_pending() == 0
+    assert job.next_run == datetime(2024, 5, 1, 11, 0)
+
+
+def test_first_due_job_runs_first(scheduler, monkeypatch):
+    clock = Clock(now=datetime(2024, 5, 1, 10, 0))
+    clock.patch(scheduler, monkeypatch)
+    runs = []
+    sch = scheduler.Scheduler()
+    prices = sch.add(name='цены', func=lambda: runs.append('цены'),
+                     trigger=scheduler.make_trigger(spec='0 * * * *', period=1))
+    stocks = sch.add(name='остатки', func=lambda: runs.append('остатки'),
+                     trigger=scheduler.make_trigger(spec='15m', period=1))
+    clock.now = datetime(2024, 5, 1, 11, 0)
+    while sch.run_pending() == 0:
+        pass
+    # остатки was due since 10:00 and runs once for all the slots it missed
+    assert runs == ['остатки', 'цены']
+    assert (stocks.next_run, prices.next_run) == (datetime(2024, 5, 1, 11, 15), datetime(2024, 5, 1, 12, 0))
@@ -0,0 +1,87 @@
+import pytest
+
+# every copy of sync_state.py
+DIRECTORIES = ('', 'rusklimat', 'hevesh', 'heveshWB', 'sp_armtek', 'sp_artem', 'side_proj')
+
+
+@pytest.fixture(params=DIRECTORIES)
+def snapshot_cls(request, script):
+    return script(request.param, 'sync_state').SyncSnapshot
+
+
+def stocks(**values) -> list:
+    return [dict(offer_id=offer_id, product_id=1, stock=stock, warehouse_id=7) for offer_id, stock in values.items()]
+
+
+def answer(records: list, failed: tuple = ()) -> dict:
+    return dict(result=[dict(offer_id=el['offer_id'], updated=el['offer_id'] not in failed) for el in records])
+
+
+def test_first_cycle_sends_everything(snapshot_cls, tmp_path):
+    snapshot = snapshot_cls(filename=str(tmp_path / 'snapshot.json'), full_sync_every=10)
+    snapshot.start_cycle()
+    records = stocks(a=1, b=2)
+    assert snapshot.changed(kind='stocks', records=records) == records
+
+
+def test_delta_keeps_only_changed_and_unacknowledged(snapshot_cls, tmp_path):
+    snapshot = snapshot_cls(filename=str(tmp_path / 'snapshot.json'), full_sync_every=10)
+    snapshot.start_cycle()
+    records = stocks(a=1, b=2, c=3)
+    snapshot.acknowledge(kind='stocks', records=records, res_dict=answer(records, failed=('c',)))
+
+    snapshot.start_cycle()
+    changed = snapshot.changed(kind='stocks', records=stocks(a=1, b=5, c=3, d=0))
+    assert [el['offer_id'] for el in changed] == ['b', 'c', 'd']
+
+
+def test_answer_without_result_list_is_ignored(snapshot_cls, tmp_path):
+    snapshot = snapshot_cls(filename=str(tmp_path / 'snapshot.json'), full_sync_every=10)
+    snapshot.start_cycle()
+    records = stocks(a=1)
+    snapshot.acknowledge(kind='stocks', records=records, res_dict=dict(error='bad request'))
+    snapshot.start_cycle()
+    assert snapshot.changed(kind='stocks', records=records) == records
+
+
+def test_full_resync_every_n_cycles(snapshot_cls, tmp_path):
+    snapshot = snapshot_cls(filename=str(tmp_path / 'snapshot.json'), full_sync_every=3)
+    records = stocks(a=1)
+    sent = []
+    for _ in range(7):
+        snapshot.start_cycle()
+        changed = snapshot.changed(kind='stocks', records=records)
+        snapshot.acknowledge(kind='stocks', records=changed, res_dict=answer(changed))
+        sent.append(len(changed))
+    assert sent == [1, 0, 0, 1, 0, 0, 1]
+
+
+def test_stock_and_price_cycles_are_counted_apart(snapshot_cls, tmp_path):
+    snapshot = snapshot_cls(filename=str(tmp_path / 'snapshot.json'), full_sync_every=2)
+    prices = [dict(offer_id='a', price='100')]
+    snapshot.start_cycle(kinds=('prices',))
+    snapshot.acknowledge(kind='prices', records=prices, res_dict=answer(prices))
+    # stock jobs running more often must not move the price resync
+    for _ in range(5):
+        snapshot.start_cycle(kinds=('stocks',))
+    assert snapshot.cycles == dict(stocks=5, prices=1)
+
+    snapshot.start_cycle(kinds=('prices',))
+    assert snapshot.changed(kind='prices', records=prices) == []
+    snapshot.start_cycle(kinds=('prices',))
+    assert snapshot.changed(kind='prices', records=prices) == prices
+
+
+def test_saved_snapshot_is_loaded_back(snapshot_cls, tmp_path):
+    filename = str(tmp_path / 'snapshot.json')
+    snapshot = snapshot_cls(filename=filename, full_sync_every=10)
+    snapshot.start_cycle()
+    records = stocks(a=1, b=2)
+    snapshot.acknowledge(kind='stocks', records=records, res_dict=answer(records))
+    snapshot.save()
+
+    restarted = snapshot_cls(filename=filename, full_sync_every=10)
+    restarted.start_cycle()
+    assert restarted.cycles == dict(stocks=2, prices=2)
+    assert restarted.changed(kind='stocks', records=stocks(a=1, b=3)) == stocks(b=3)
+